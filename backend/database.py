@@ -1,25 +1,82 @@
 import contextlib
 from typing import Any, AsyncIterator
 
-from sqlalchemy import event
+from sqlalchemy import URL, AsyncAdaptedQueuePool, event, make_url
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, create_async_engine, async_sessionmaker
 
+from backend.migrations import migrate
 from backend.settings import settings
-from models.weather import Base
+
+
+def sqlite_pragmas() -> list[str]:
+    # Run on each new connection, the journal mode is kept in the file and the others are per connection
+    return [
+        'PRAGMA foreign_keys=ON',
+        f'PRAGMA journal_mode={settings.sqlite_journal_mode}',
+        f'PRAGMA synchronous={settings.sqlite_synchronous}',
+        f'PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}',
+        f'PRAGMA cache_size=-{settings.sqlite_cache_size_kib}',  # negative values are in KiB
+        f'PRAGMA mmap_size={settings.sqlite_mmap_size}',
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+
+def engine_profile(host: str, profile: str | None = None) -> tuple[URL, dict[str, Any], list[str]]:
+    """
+    Returns the url, the engine kwargs and the statements run on connect of the profile in the settings
+    'auto' selects the profile of the database in the url
+    """
+    url = make_url(host)
+    backend = url.get_backend_name()
+    profile = profile or settings.database_profile
+    if profile == 'auto':
+        profile = backend
+
+    pool_kwargs = {
+        'pool_size': settings.db_pool_size,
+        'max_overflow': settings.db_max_overflow,
+        'pool_timeout': settings.db_pool_timeout,
+    }
+    if profile == 'sqlite' and backend == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return url, {}, sqlite_pragmas()
+        # aiosqlite opens a connection (and a thread) per session by default (NullPool), the pool keeps them with their cache
+        return url, {'poolclass': AsyncAdaptedQueuePool, **pool_kwargs}, sqlite_pragmas()
+
+    if profile == 'postgresql' and backend == 'postgresql':
+        if url.get_driver_name() == 'asyncpg':
+            url = url.update_query_dict({'prepared_statement_cache_size': str(settings.asyncpg_statement_cache_size)})
+        engine_kwargs = {**pool_kwargs, 'pool_recycle': settings.db_pool_recycle, 'pool_pre_ping': settings.db_pool_pre_ping}
+        return url, engine_kwargs, []
+
+    # Engine defaults, only the foreign keys are enabled in SQLite
+    return url, {}, ['PRAGMA foreign_keys=ON'] if backend == 'sqlite' else []
 
 
 class DatabaseSessionManager:
     # Create all necessary handlers for database connection
-    def __init__(self, host: str, engine_kwargs: dict[str, Any] = {}, expire_on_commit: bool = True, test_db=False):
-        self._engine = create_async_engine(host, **engine_kwargs)
+    # The engine is tuned by the profile of the settings (see engine_profile), the given engine_kwargs take precedence
+    def __init__(self, host: str, engine_kwargs: dict[str, Any] = {}, expire_on_commit: bool = True, test_db=False,
+                 profile: str | None = None):
+        url, profile_kwargs, on_connect = engine_profile(host, profile)
+        self._engine = create_async_engine(url, **{**profile_kwargs, **engine_kwargs})
         self._sessionmaker = async_sessionmaker(autocommit=False, bind=self._engine, expire_on_commit=expire_on_commit)
 
-        # Enable foreign key support for SQLite
-        @event.listens_for(self._engine.sync_engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA foreign_keys=ON")
-            cursor.close()
+        if on_connect:
+            @event.listens_for(self._engine.sync_engine, "connect")
+            def set_sqlite_pragma(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for statement in on_connect:
+                    cursor.execute(statement)
+                cursor.close()
+
+    async def close(self):
+        if self._engine is None:
+            raise Exception("DatabaseSessionManager is not initialized")
+        await self._engine.dispose()
+
+        self._engine = None
+        self._sessionmaker = None
 
     @contextlib.asynccontextmanager
     async def connect(self) -> AsyncIterator[AsyncConnection]:
@@ -52,9 +109,17 @@ class DatabaseSessionManager:
 sessionmanager = DatabaseSessionManager(settings.database_url, {"echo": settings.echo_sql})
 test_sessionmanager = DatabaseSessionManager(settings.test_database_url, {"echo": settings.echo_test_sql}, expire_on_commit=False, test_db=True)
 
-async def db_session():
-    async with sessionmanager.connect() as connection:
-        await connection.run_sync(Base.metadata.create_all)
+async def init_schema(manager: DatabaseSessionManager = sessionmanager) -> int | None:
+    # Creates or migrates the schema, runs once when the application starts
+    async with manager.connect() as connection:
+        return await connection.run_sync(migrate)
 
+
+async def db_session():
     async with sessionmanager.session() as session:
         yield session
+
+
+def db_sessionmanager() -> DatabaseSessionManager:
+    # For the streamed responses, that open their own session because db_session is closed before the body is sent
+    return sessionmanager
@@ -0,0 +1,173 @@
+import datetime
+import json
+from typing import Callable
+
+from sqlalchemy import (
+    JSON, Column, Connection, DateTime, Float, Integer, MetaData, SmallInteger, String, Table, UniqueConstraint, cast, func,
+    inspect, select, text,
+)
+
+from models.schema import SchemaVersion
+from models.weather import Base
+
+# Version of the schema defined by the models, increase it when adding a migration
+SCHEMA_VERSION = 6
+# Key of the PostgreSQL advisory lock held while the schema is created or migrated
+SCHEMA_LOCK_KEY = 7_310_425
+
+
+def _add_progress_index(connection: Connection):
+    # Index used by the COUNT/EXISTS progress queries, created by create_all only for new tables
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_weather_data_user_id_request_date ON weather_data (user_id, request_date)'))
+
+
+def _typed_weather_columns(connection: Connection):
+    # Moves the JSON data column of weather_data to typed columns, keeping the last reading of each city per user
+    # The tables are declared here (and not imported from the models) so the migration does not change with them
+    metadata = MetaData()
+    old = Table(
+        'weather_data', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer),
+        Column('request_date', DateTime),
+        Column('data', JSON),
+    )
+    new = Table(
+        'weather_data_v2', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer),
+        Column('request_date', DateTime),
+        Column('city_id', Integer),
+        Column('temperature', Float),
+        Column('humidity', SmallInteger),
+        Column('fetched_at', DateTime),
+        UniqueConstraint('user_id', 'city_id', name='uq_weather_data_user_id_city_id'),
+    )
+    new.create(connection)
+
+    # Cast in SQL, as the JSON may have the same city as a number and as a string (31 and "31") and they are one city in the typed column
+    city_id = cast(old.c.data['city_id'].as_integer(), Integer)
+    last_readings = select(func.max(old.c.id)).where(city_id.is_not(None)).group_by(old.c.user_id, city_id)
+    connection.execute(new.insert().from_select(
+        ['id', 'user_id', 'request_date', 'city_id', 'temperature', 'humidity', 'fetched_at'],
+        select(
+            old.c.id, old.c.user_id, old.c.request_date, city_id,
+            old.c.data['temperature_c'].as_float(), old.c.data['humidity'].as_integer(), old.c.request_date,
+        ).where(old.c.id.in_(last_readings)),
+    ))
+
+    old.drop(connection)
+    connection.execute(text('ALTER TABLE weather_data_v2 RENAME TO weather_data'))
+    connection.execute(text('CREATE INDEX ix_weather_data_user_id_request_date ON weather_data (user_id, request_date)'))
+
+    if connection.dialect.name == 'postgresql':
+        # The ids were copied explicitly, so the sequence of the new table starts after the last of them
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('weather_data', 'id'), coalesce(max(id), 0) + 1, false) FROM weather_data"
+        ))
+
+
+def _keyset_index(connection: Connection):
+    # Adds the id to the progress index, so the results pages are read in (request_date, id) order from the index
+    connection.execute(text('DROP INDEX IF EXISTS ix_weather_data_user_id_request_date'))
+    connection.execute(text('CREATE INDEX ix_weather_data_user_id_request_date_id ON weather_data (user_id, request_date, id)'))
+
+
+def _job_priority(connection: Connection):
+    # Priority class of the jobs, used by the fair scheduler of the upstream requests
+    # The job table may not exist yet (database created before the job queue), then create_all adds it with the column
+    if inspect(connection).has_table('weather_job'):
+        connection.execute(text("ALTER TABLE weather_job ADD COLUMN priority VARCHAR(16) NOT NULL DEFAULT 'normal'"))
+
+
+def _job_city_state(connection: Connection):
+    # State of each city of the jobs, filled for the existing jobs: the cities saved since the job was requested are done
+    metadata = MetaData()
+    job_city = Table(
+        'weather_job_city', metadata,
+        Column('job_id', Integer, primary_key=True),
+        Column('city_id', Integer, primary_key=True),
+        Column('status', String(16)),
+        Column('updated_at', DateTime),
+    )
+    job_city.create(connection)
+    if not inspect(connection).has_table('weather_job'):
+        return
+
+    now = datetime.datetime.utcnow()
+    jobs = connection.execute(text('SELECT id, user_id, cities, created_at FROM weather_job')).all()
+    for job_id, user_id, cities, created_at in jobs:
+        saved = set(connection.scalars(
+            text('SELECT city_id FROM weather_data WHERE user_id = :user_id AND request_date >= :created_at'),
+            {'user_id': user_id, 'created_at': created_at},
+        ))
+        rows = [
+            {'job_id': job_id, 'city_id': city_id, 'status': 'done' if city_id in saved else 'pending', 'updated_at': now}
+            for city_id in dict.fromkeys(json.loads(cities) if isinstance(cities, str) else cities)
+        ]
+        if rows:
+            connection.execute(job_city.insert(), rows)
+
+
+def _job_max_age(connection: Connection):
+    # Max age of the readings of a refresh job, the cached readings older than it are fetched again
+    if inspect(connection).has_table('weather_job'):
+        connection.execute(text('ALTER TABLE weather_job ADD COLUMN max_age INTEGER'))
+
+
+# Each migration upgrades the database from the previous version to its key
+MIGRATIONS: dict[int, Callable[[Connection], None]] = {
+    1: _add_progress_index,
+    2: _typed_weather_columns,
+    3: _keyset_index,
+    4: _job_priority,
+    5: _job_city_state,
+    6: _job_max_age,
+}
+
+
+def get_schema_version(connection: Connection) -> int | None:
+    """
+    This functions returns the current version of the database schema
+    None means an empty database and 0 a database created before the schema versioning
+    """
+    tables = inspect(connection).get_table_names()
+    if SchemaVersion.__tablename__ in tables:
+        return connection.scalar(select(func.max(SchemaVersion.version))) or 0
+
+    return 0 if tables else None
+
+
+def lock_schema(connection: Connection):
+    """
+    This functions takes an exclusive lock until the end of the transaction, so when several processes start at once
+    only one creates or migrates the schema and the others wait and find it in the current version
+    """
+    if connection.dialect.name == 'sqlite':
+        # The driver only begins the transaction before DML, the DDL of the migrations would be committed one by one
+        connection.exec_driver_sql('BEGIN EXCLUSIVE')
+    elif connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+
+
+def migrate(connection: Connection) -> int:
+    """
+    This functions creates or upgrades the database schema to SCHEMA_VERSION and returns the previous version
+    It runs in a single transaction of the given connection: the version detection, the migrations and the version insert
+    are done under the schema lock, and a failed migration leaves the database as it was
+    """
+    lock_schema(connection)
+    current = get_schema_version(connection)
+    if current is not None and current > SCHEMA_VERSION:
+        raise RuntimeError(f'The database schema version ({current}) is newer than the application ({SCHEMA_VERSION})')
+
+    # A new database is created directly in the last version
+    if current is not None:
+        for version in range(current + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[version](connection)
+
+    Base.metadata.create_all(connection)
+    if current != SCHEMA_VERSION:
+        connection.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+
+    return current
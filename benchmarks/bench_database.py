@@ -0,0 +1,133 @@
+"""
+Mixed read/write concurrency on SQLite with the engine profiles of backend/database.py:
+- default: engine defaults, rollback journal (the previous configuration)
+- sqlite: WAL, synchronous=NORMAL, busy_timeout, cache_size and mmap_size
+
+Writers save batches of readings like the jobs (BufferedWeatherWriter, one upsert and one commit per batch)
+and readers poll the progress and the first page of results like the GET endpoints, each query in its own session.
+The writers run in other processes, as the job workers started with python -m services.jobs
+Reports the throughput, the latency of the reads and commits, and the failed operations (database is locked)
+
+Usage: python -m benchmarks.bench_database [--writers 2] [--readers 8] [--duration 5] [--batch-size 50]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from backend.database import DatabaseSessionManager
+from managers.weather import WeatherManager
+from models.weather import Base
+
+
+def percentiles(values: list[float]) -> dict[str, float | None]:
+    # In milliseconds
+    if not values:
+        return {'p50_ms': None, 'p99_ms': None}
+    values = sorted(values)
+    return {
+        'p50_ms': round(statistics.median(values) * 1000, 3),
+        'p99_ms': round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 3),
+    }
+
+
+async def writer(manager: DatabaseSessionManager, user_id: int, batch_size: int, stop: float, stats: dict):
+    city_id = 0
+    while time.perf_counter() < stop:
+        started_at = time.perf_counter()
+        try:
+            async with manager.session() as session:
+                async with WeatherManager(session).buffered_writer(max_rows=batch_size + 1) as buffer:
+                    for _ in range(batch_size):
+                        city_id = (city_id + 1) % 10_000
+                        await buffer.add(user_id, {'city_id': city_id, 'temperature_c': 21.5, 'humidity': 64})
+        except OperationalError:
+            stats['write_errors'] += 1
+            continue
+        stats['commit_times'].append(time.perf_counter() - started_at)
+        stats['rows'] += batch_size
+
+
+async def reader(manager: DatabaseSessionManager, users: int, stop: float, stats: dict):
+    user_id = 0
+    while time.perf_counter() < stop:
+        user_id = (user_id + 1) % users
+        started_at = time.perf_counter()
+        try:
+            async with manager.session() as session:
+                if user_id % 2:
+                    await WeatherManager(session).count_complete_cities(user_id)
+                else:
+                    await WeatherManager(session).get_results_page(user_id, limit=100)
+        except OperationalError:
+            stats['read_errors'] += 1
+            continue
+        stats['read_times'].append(time.perf_counter() - started_at)
+
+
+def writer_process(path: str, profile: str, user_id: int, batch_size: int, duration: float, results: multiprocessing.Queue):
+    async def write():
+        manager = DatabaseSessionManager(f'sqlite+aiosqlite:///{path}', profile=profile)
+        stats = {'rows': 0, 'commit_times': [], 'write_errors': 0}
+        await writer(manager, user_id, batch_size, time.perf_counter() + duration, stats)
+        await manager.close()
+        return stats
+
+    results.put(asyncio.run(write()))
+
+
+async def run(path: str, profile: str, args) -> dict:
+    manager = DatabaseSessionManager(f'sqlite+aiosqlite:///{path}', profile=profile)
+    async with manager.connect() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    writers = [context.Process(target=writer_process, args=(path, profile, user_id, args.batch_size, args.duration, queue))
+               for user_id in range(args.writers)]
+    for process in writers:
+        process.start()
+
+    stats = {'rows': 0, 'commit_times': [], 'read_times': [], 'write_errors': 0, 'read_errors': 0}
+    await asyncio.gather(*[reader(manager, args.writers, time.perf_counter() + args.duration, stats) for _ in range(args.readers)])
+    for _ in writers:
+        written = await asyncio.to_thread(queue.get)
+        stats['rows'] += written['rows']
+        stats['commit_times'] += written['commit_times']
+        stats['write_errors'] += written['write_errors']
+    for process in writers:
+        process.join()
+    await manager.close()
+
+    return {
+        'rows_per_s': round(stats['rows'] / args.duration, 1),
+        'commits': {'per_s': round(len(stats['commit_times']) / args.duration, 1), **percentiles(stats['commit_times'])},
+        'reads': {'per_s': round(len(stats['read_times']) / args.duration, 1), **percentiles(stats['read_times'])},
+        'errors': {'write': stats['write_errors'], 'read': stats['read_errors']},
+    }
+
+
+async def main(args):
+    results = {'params': vars(args)}
+    with tempfile.TemporaryDirectory() as folder:
+        for profile in ('default', 'sqlite'):
+            results[profile] = await run(os.path.join(folder, f'{profile}.sqlite3'), profile, args)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=2, help='processes saving readings')
+    parser.add_argument('--readers', type=int, default=8, help='concurrent progress and results pollers')
+    parser.add_argument('--duration', type=float, default=5, help='in seconds, for each profile')
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
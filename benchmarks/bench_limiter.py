@@ -0,0 +1,93 @@
+"""
+Compares the old 0.5s polling loop of RequestLimiter with the event driven AsyncRateLimiter
+
+For each acquisition after the first window is used, the latency is the time between the moment the
+slot freed (oldest acquisition + period) and the moment the waiter got it.
+It also measures the overhead of an acquisition with a free slot, for the in memory and the SQLite (shared
+between processes) sliding windows.
+
+Usage: python -m benchmarks.bench_limiter [--waiters 1000] [--limit 200] [--period 1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from collections import deque
+
+from services.limiter import AsyncRateLimiter, SQLiteSlidingWindow, SlidingWindow
+
+
+class PollingLimiter:
+    # Copy of the previous RequestLimiter implementation, used as baseline
+    def __init__(self, limit, period, interval=0.5):
+        self.limit = limit
+        self.period = period
+        self.interval = interval
+        self.queue = deque(maxlen=limit)
+        self.wakeups = 0
+
+    async def acquire(self):
+        while len(self.queue) == self.limit and time.time() - self.queue[0] < self.period:
+            await asyncio.sleep(self.interval)
+            self.wakeups += 1
+        self.queue.append(time.time())
+
+
+async def run(limiter, waiters: int, limit: int, period: float, clock) -> dict:
+    acquired_at = []
+
+    async def acquire():
+        await limiter.acquire()
+        acquired_at.append(clock())
+
+    started_at = clock()
+    await asyncio.gather(*[acquire() for _ in range(waiters)])
+    elapsed = clock() - started_at
+
+    acquired_at.sort()
+    latencies = [acquired_at[i] - (acquired_at[i - limit] + period) for i in range(limit, len(acquired_at))]
+    latencies.sort()
+
+    return {
+        'wakeups': limiter.wakeups,
+        'elapsed_s': round(elapsed, 4),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+
+async def acquire_overhead(limiter: AsyncRateLimiter, acquisitions: int = 5000) -> float:
+    # Mean time in microseconds of an acquisition that does not wait
+    started_at = time.perf_counter()
+    for _ in range(acquisitions):
+        await limiter.acquire()
+    return round((time.perf_counter() - started_at) / acquisitions * 1_000_000, 2)
+
+
+async def main(waiters: int, limit: int, period: float):
+    results = {
+        'waiters': waiters,
+        'limit': limit,
+        'period': period,
+        'polling': await run(PollingLimiter(limit, period), waiters, limit, period, time.time),
+        'event_driven': await run(AsyncRateLimiter(SlidingWindow(limit, period)), waiters, limit, period, time.monotonic),
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        results['acquire_overhead_us'] = {
+            'memory': await acquire_overhead(AsyncRateLimiter(SlidingWindow(10 ** 9, 60))),
+            'sqlite': await acquire_overhead(AsyncRateLimiter(SQLiteSlidingWindow(10 ** 9, 60, os.path.join(folder, 'limiter.sqlite3')), clock=time.time)),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--waiters', type=int, default=1000)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--period', type=float, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.waiters, args.limit, args.period))
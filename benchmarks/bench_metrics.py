@@ -0,0 +1,85 @@
+"""
+Overhead of the instrumentation (services/metrics.py) on the fetch and persist path
+
+Measures the time of the metric updates and spans done for each city, with the tracing off (default)
+and logging the spans, and compares it with the CPU time per city of bench_pipeline against a stub
+without latency (the worst case, where the instrumentation is the largest part of the work)
+
+Usage: python -m benchmarks.bench_metrics [--cities 2000] [--repeat 100000]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+import time
+
+from backend.settings import settings
+from benchmarks import bench_pipeline
+from services.metrics import (
+    cities_processed, limiter_wait_seconds, persist_queue_depth, span, upstream_in_flight, upstream_request_seconds,
+)
+
+
+def instrument_city():
+    # The metric updates and spans of one city in WeatherService and AsyncRateLimiter
+    limiter_wait_seconds.observe(0)
+    with span('openweather.fetch', city_id=1):
+        upstream_in_flight.inc()
+        with span('openweather.request', endpoint='weather'):
+            pass
+        upstream_in_flight.dec()
+        upstream_request_seconds.labels('weather', 200).observe(0.02)
+    persist_queue_depth.set(0)
+    cities_processed.labels('done').inc()
+
+
+def per_city_us(repeat: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        instrument_city()
+    return round((time.perf_counter() - started_at) / repeat * 1_000_000, 3)
+
+
+async def pipeline_cpu_per_city_us(cities: int) -> float:
+    args = argparse.Namespace(latency_ms=0, error_rate=0, rate_limit=10 ** 9, max_attempts=1, retry_base_delay=0,
+                              max_in_flight=settings.open_weather_max_in_flight)
+    settings.cache_enabled = False
+    with tempfile.TemporaryDirectory() as folder:
+        started_at = time.process_time()
+        await bench_pipeline.run(folder, cities, args)
+        # The stub runs in the same process, so its CPU time is included (the real path is slower, the overhead lower)
+        return round((time.process_time() - started_at) / cities * 1_000_000, 3)
+
+
+async def main(cities: int, repeat: int):
+    tracing_off_us = per_city_us(repeat)
+
+    # Logs the spans to a handler that drops them, to measure the cost of the spans and not of the output
+    settings.tracing = 'log'
+    logging.getLogger('services.metrics').addHandler(logging.NullHandler())
+    logging.getLogger('services.metrics').setLevel(logging.INFO)
+    logging.getLogger('services.metrics').propagate = False
+    tracing_log_us = per_city_us(repeat // 10)
+    settings.tracing = 'off'
+
+    pipeline_us = await pipeline_cpu_per_city_us(cities)
+    results = {
+        'cities': cities,
+        'pipeline_cpu_per_city_us': pipeline_us,
+        'instrumentation_per_city_us': {'tracing_off': tracing_off_us, 'tracing_log': tracing_log_us},
+        'overhead': {
+            'tracing_off': round(tracing_off_us / pipeline_us, 4),
+            'tracing_log': round(tracing_log_us / pipeline_us, 4),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=100_000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.cities, args.repeat))
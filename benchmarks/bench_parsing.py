@@ -0,0 +1,105 @@
+"""
+Parsing of the OpenWeather responses, per payload:
+- previous: httpx Response.json() and a dict with the saved fields
+- full decode of the raw bytes with the json module and with orjson (if installed), building a WeatherRecord
+- fast path of services/parsing.py, reading only id, main.temp and main.humidity from the bytes (used without orjson)
+- parse_weather, with the backend of this environment
+and the memory of 10k WeatherRecord against 10k dicts
+All of them include building the httpx Response, as in the real path (its cost is also reported)
+
+The payloads have the shape and size of the real responses, with different cities
+
+Usage: python -m benchmarks.bench_parsing [--repeat 50000]
+"""
+import argparse
+import importlib.util
+import json
+import time
+import tracemalloc
+
+import httpx
+
+from services import parsing
+from services.parsing import WeatherRecord, _scan_weather, parse_weather, parse_weather_group, weather_record
+from tests.stub_server import city_payload
+
+
+def payloads(count: int) -> list[bytes]:
+    contents = []
+    for city_id in range(count):
+        payload = city_payload(3400000 + city_id)
+        payload['name'] = f'City {city_id}'
+        payload['main'] = {**payload['main'], 'temp': round(-10 + city_id % 45 + 0.37, 2), 'humidity': city_id % 100}
+        contents.append(json.dumps(payload).encode())
+    return contents
+
+
+def previous(content: bytes) -> dict:
+    data = httpx.Response(200, content=content).json()
+    return {'city_id': data['id'], 'temperature_c': data['main']['temp'], 'humidity': data['main']['humidity'], 'fetched_at': time.time()}
+
+
+def timed(fn, contents: list[bytes], repeat: int) -> float:
+    # Mean time per payload in microseconds
+    started_at = time.perf_counter()
+    for i in range(repeat):
+        fn(contents[i % len(contents)])
+    return round((time.perf_counter() - started_at) / repeat * 1_000_000, 3)
+
+
+def memory(build, count: int) -> int:
+    # Bytes allocated to keep `count` results
+    tracemalloc.start()
+    results = [build(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return size
+
+
+def main(repeat: int):
+    contents = payloads(100)
+    group = [json.dumps({'cnt': 20, 'list': [json.loads(content) for content in contents[start:start + 20]]}).encode()
+             for start in range(0, 100, 20)]
+
+    def body(content: bytes) -> bytes:
+        return httpx.Response(200, content=content).content
+
+    single = {
+        'httpx_response_us': timed(body, contents, repeat),
+        'previous_us': timed(previous, contents, repeat),
+        'json_full_decode_us': timed(lambda content: weather_record(json.loads(body(content)), time.time()), contents, repeat),
+        'fast_path_us': timed(lambda content: _scan_weather(body(content)), contents, repeat),
+        'parse_weather_us': timed(lambda content: parse_weather(body(content)), contents, repeat),
+    }
+    if importlib.util.find_spec('orjson') is not None:
+        import orjson
+        single['orjson_full_decode_us'] = timed(lambda content: weather_record(orjson.loads(body(content)), time.time()), contents, repeat)
+
+    def previous_group(content: bytes) -> dict:
+        data = httpx.Response(200, content=content).json()
+        return {int(city['id']): {'city_id': city['id'], 'temperature_c': city['main']['temp'], 'humidity': city['main']['humidity'],
+                                  'fetched_at': time.time()} for city in data['list']}
+
+    results = {
+        'json_backend': parsing.loads.__module__,
+        'payload_bytes': round(sum(len(content) for content in contents) / len(contents)),
+        'single_city': single,
+        'group_20_cities': {
+            'previous_us': timed(previous_group, group, repeat // 20),
+            'parse_weather_group_us': timed(lambda content: parse_weather_group(body(content)), group, repeat // 20),
+        },
+        'memory_10k_bytes': {
+            'dict': memory(lambda i: {'city_id': i, 'temperature_c': 21.5 + i, 'humidity': 64, 'fetched_at': time.time()}, 10_000),
+            'record': memory(lambda i: WeatherRecord(i, 21.5 + i, 64, time.time()), 10_000),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=50_000)
+    args = parser.parse_args()
+
+    main(args.repeat)
@@ -0,0 +1,66 @@
+"""
+Compares the rows/sec of WeatherManager.save_city_weather (one commit per row)
+with the BufferedWeatherWriter (one multi-row INSERT per batch) on aiosqlite
+
+Usage: python -m benchmarks.bench_persistence [--rows 2000] [--batch-size 50]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from backend.database import DatabaseSessionManager
+from managers.weather import WeatherManager
+from models.weather import Base
+
+def city_data(city_id: int) -> dict:
+    return {'city_id': city_id, 'temperature_c': 21.5, 'humidity': 64}
+
+
+async def create_database(path: str) -> DatabaseSessionManager:
+    manager = DatabaseSessionManager(f'sqlite+aiosqlite:///{path}')
+    async with manager.connect() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+    return manager
+
+
+async def per_row(manager: DatabaseSessionManager, rows: int) -> float:
+    async with manager.session() as session:
+        weather_manager = WeatherManager(session)
+        started_at = time.perf_counter()
+        for city_id in range(rows):
+            await weather_manager.save_city_weather(1, city_data(city_id))
+        return time.perf_counter() - started_at
+
+
+async def batched(manager: DatabaseSessionManager, rows: int, batch_size: int) -> float:
+    async with manager.session() as session:
+        started_at = time.perf_counter()
+        async with WeatherManager(session).buffered_writer(max_rows=batch_size) as writer:
+            for city_id in range(rows):
+                await writer.add(1, city_data(city_id))
+        return time.perf_counter() - started_at
+
+
+async def main(rows: int, batch_size: int):
+    results = {'rows': rows, 'batch_size': batch_size}
+    with tempfile.TemporaryDirectory() as folder:
+        for name, write in [('per_row', lambda m: per_row(m, rows)), ('batched', lambda m: batched(m, rows, batch_size))]:
+            manager = await create_database(os.path.join(folder, f'{name}.sqlite3'))
+            elapsed = await write(manager)
+            results[name] = {'elapsed_s': round(elapsed, 4), 'rows_per_s': round(rows / elapsed, 1)}
+            await manager.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.batch_size))
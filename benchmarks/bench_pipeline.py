@@ -0,0 +1,210 @@
+"""
+End to end benchmark of WeatherService.get_openweather_data against a local OpenWeather stub server
+with configurable latency and error rate (the errors are retried by the retry policy)
+
+For each number of cities it reports the throughput, the latency per city (limiter wait, retries and
+request) and per request, the rows/sec of the database writes and the overhead of the rate limiter.
+The limiter quota is not the bottleneck by default (--rate-limit), to measure the pipeline itself.
+
+The results can be saved (--output) and compared with a previous run (--baseline), the script exits
+with status 1 when the throughput or the p99 latency regressed more than --tolerance
+
+Usage: python -m benchmarks.bench_pipeline [--cities 5 167 10000] [--latency-ms 20] [--error-rate 0.01]
+                                           [--output results.json] [--baseline previous.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from backend.settings import settings
+from benchmarks.bench_persistence import create_database
+from managers.weather import BufferedWeatherWriter
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.retry import CircuitBreaker, RetryPolicy
+from services.weather import WeatherService
+from tests.stub_server import FaultyOpenWeatherStub
+
+
+class TimedRateLimiter(AsyncRateLimiter):
+    # Records the time spent in each acquisition
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquire_times = []
+
+    async def acquire(self):
+        started_at = time.perf_counter()
+        await super().acquire()
+        self.acquire_times.append(time.perf_counter() - started_at)
+
+
+class TimedWeatherService(WeatherService):
+    # Records the latency of each city (from the first attempt until the data arrives) and of each request
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.city_latencies = []
+        self.request_latencies = []
+
+    async def _get_weather(self, city_id, client):
+        started_at = time.perf_counter()
+        try:
+            return await super()._get_weather(city_id, client)
+        finally:
+            self.city_latencies.append(time.perf_counter() - started_at)
+
+    async def _get_weather_group(self, batch, pending, finished, client):
+        started_at = time.perf_counter()
+        await super()._get_weather_group(batch, pending, finished, client)
+        self.city_latencies.extend([time.perf_counter() - started_at] * len(batch))
+
+    async def _request(self, url, params, client):
+        started_at = time.perf_counter()
+        try:
+            return await super()._request(url, params, client)
+        finally:
+            self.request_latencies.append(time.perf_counter() - started_at)
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    # In milliseconds
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': None, 'p99_ms': None}
+    return {
+        'p50_ms': round(statistics.median(values) * 1000, 3),
+        'p99_ms': round(values[max(0, int(len(values) * 0.99) - 1)] * 1000, 3),
+    }
+
+
+async def run(folder: str, cities: int, args) -> dict:
+    manager = await create_database(os.path.join(folder, f'pipeline_{cities}.sqlite3'))
+    flushes = []
+    original_flush = BufferedWeatherWriter.flush
+
+    async def timed_flush(writer):
+        rows, started_at = len(writer.rows), time.perf_counter()
+        await original_flush(writer)
+        flushes.append((rows, time.perf_counter() - started_at))
+
+    BufferedWeatherWriter.flush = timed_flush
+    try:
+        async with FaultyOpenWeatherStub(latency=args.latency_ms / 1000, error_rate=args.error_rate, seed=cities) as stub:
+            settings.open_weather_url, settings.open_weather_group_url = stub.url, stub.group_url
+            limiter = TimedRateLimiter(SlidingWindow(limit=args.rate_limit, period=1))
+            retry_policy = RetryPolicy(max_attempts=args.max_attempts, base_delay=args.retry_base_delay,
+                                       breaker=CircuitBreaker(failure_threshold=10 ** 9, reset_timeout=1))
+
+            async with manager.session() as session:
+                service = TimedWeatherService(session=session, user_id=1, request_limiter=limiter, cities=list(range(1, cities + 1)),
+                                              max_in_flight=args.max_in_flight, retry_policy=retry_policy)
+                started_at = time.perf_counter()
+                results = await service.get_openweather_data()
+                elapsed = time.perf_counter() - started_at
+    finally:
+        BufferedWeatherWriter.flush = original_flush
+    await manager.close()
+
+    written, write_time = sum(rows for rows, _ in flushes), sum(elapsed for _, elapsed in flushes)
+    acquire_times = limiter.acquire_times
+    return {
+        'cities': cities,
+        'saved': len(results),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_cities_per_s': round(len(results) / elapsed, 1),
+        'city_latency': percentiles(service.city_latencies),
+        'request_latency': percentiles(service.request_latencies),
+        'requests': len(stub.requests),
+        'retries': retry_policy.retries,
+        'db_write': {
+            'rows': written,
+            'flushes': len(flushes),
+            'rows_per_s': round(written / write_time, 1) if write_time else None,
+        },
+        'limiter': {
+            'acquisitions': len(acquire_times),
+            'mean_overhead_us': round(statistics.mean(acquire_times) * 1_000_000, 2) if acquire_times else None,
+            'share_of_elapsed': round(sum(acquire_times) / elapsed, 4),
+        },
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Compares the runs with the same number of cities
+    previous = {run['cities']: run for run in baseline['runs']}
+    found = []
+    for current in results['runs']:
+        old = previous.get(current['cities'])
+        if old is None:
+            continue
+        if current['throughput_cities_per_s'] < old['throughput_cities_per_s'] * (1 - tolerance):
+            found.append(f"{current['cities']} cities: throughput {old['throughput_cities_per_s']} -> {current['throughput_cities_per_s']} cities/s")
+        old_p99, new_p99 = old['city_latency']['p99_ms'], current['city_latency']['p99_ms']
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + tolerance):
+            found.append(f"{current['cities']} cities: p99 city latency {old_p99} -> {new_p99} ms")
+    return found
+
+
+async def main(args) -> int:
+    # The stub answers every city, the cache would hide the pipeline
+    settings.cache_enabled = False
+
+    with tempfile.TemporaryDirectory() as folder:
+        runs = [await run(folder, cities, args) for cities in args.cities]
+
+    results = {
+        'benchmark': 'pipeline',
+        'created_at': datetime.datetime.utcnow().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {
+            'latency_ms': args.latency_ms,
+            'error_rate': args.error_rate,
+            'max_in_flight': args.max_in_flight,
+            'batch_size': settings.open_weather_batch_size,
+            'write_batch_size': settings.weather_write_batch_size,
+            'rate_limit': args.rate_limit,
+        },
+        'runs': runs,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            results['regressions'] = regressions(results, json.load(file), args.tolerance)
+        exit_code = 1 if results['regressions'] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cities', type=int, nargs='+', default=[5, 167, 10_000])
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--max-in-flight', type=int, default=settings.open_weather_max_in_flight)
+    parser.add_argument('--rate-limit', type=int, default=10 ** 9, help='requests per second allowed by the limiter')
+    parser.add_argument('--max-attempts', type=int, default=settings.retry_max_attempts)
+    parser.add_argument('--retry-base-delay', type=float, default=0.01)
+    parser.add_argument('--output', help='file to save the results')
+    parser.add_argument('--baseline', help='results of a previous run, to detect regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+
+    sys.exit(asyncio.run(main(parser.parse_args())))
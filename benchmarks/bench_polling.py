@@ -0,0 +1,122 @@
+"""
+Load test of the progress endpoint (GET /weather?user_id=X) under a polling storm
+
+`--clients` concurrent clients poll a few users as fast as they can, through the ASGI app (routers, dependencies
+and serialization, without the network) with a SQLite database. Reports the req/s, the p50/p99 latency and the
+number of progress queries for each mode:
+- per_request: each request runs its own query (previous behavior)
+- coalesced: concurrent requests of a user share the query in flight (progress_cache_ttl=0)
+- cached: coalesced and the answer is kept for progress_cache_ttl seconds
+- etag: cached, and the clients send the ETag back (If-None-Match) and receive 304 without body
+
+Usage: python -m benchmarks.bench_polling [--clients 1000] [--users 10] [--duration 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+import constants
+from backend import database
+from backend.database import DatabaseSessionManager, init_schema
+from backend.settings import settings
+from main import app
+from managers.jobs import JobManager
+from managers.weather import WeatherManager
+from routers import weather
+from services.cache import ResponseCache
+
+
+class PerRequest:
+    # Without coalescing, each request runs its own query
+    def __init__(self):
+        self.misses = 0
+
+    async def get_or_fetch(self, key, fetch):
+        self.misses += 1
+        return await fetch()
+
+    def stats(self) -> dict[str, int]:
+        return {'misses': self.misses}
+
+
+async def create_database(path: str, users: int) -> DatabaseSessionManager:
+    # Each user has a job with all the cities and a part of them saved
+    manager = DatabaseSessionManager(f'sqlite+aiosqlite:///{path}', expire_on_commit=False)
+    await init_schema(manager)
+    async with manager.session() as session:
+        for user_id in range(users):
+            job = await JobManager(session).enqueue(user_id, cities=constants.CITIES_IDs)
+            async with WeatherManager(session).buffered_writer(job_id=job.id) as writer:
+                for city_id in constants.CITIES_IDs[:(user_id + 1) * 10]:
+                    await writer.add(user_id, {'city_id': city_id, 'temperature_c': 21.5, 'humidity': 64})
+    return manager
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    # In milliseconds
+    values = sorted(values)
+    return {
+        'p50_ms': round(statistics.median(values) * 1000, 3),
+        'p99_ms': round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 3),
+    }
+
+
+async def poll(client: httpx.AsyncClient, user_id: int, revalidate: bool, stop: float, latencies: list, statuses: dict):
+    etag = None
+    while time.perf_counter() < stop:
+        headers = {'If-None-Match': etag} if revalidate and etag else {}
+        started_at = time.perf_counter()
+        response = await client.get('/weather', params={'user_id': user_id}, headers=headers)
+        latencies.append(time.perf_counter() - started_at)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        etag = response.headers.get('etag')
+
+
+async def run(mode: str, args) -> dict:
+    cache = PerRequest() if mode == 'per_request' else ResponseCache(
+        ttl=0 if mode == 'coalesced' else settings.progress_cache_ttl, max_entries=settings.progress_cache_max_entries)
+    weather.progress_cache = cache
+
+    latencies, statuses = [], {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        stop = time.perf_counter() + args.duration
+        started_at = time.perf_counter()
+        await asyncio.gather(*[poll(client, i % args.users, mode == 'etag', stop, latencies, statuses) for i in range(args.clients)])
+        elapsed = time.perf_counter() - started_at
+
+    return {
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        **percentiles(latencies),
+        'statuses': statuses,
+        'queries': cache.stats()['misses'],
+    }
+
+
+async def main(args):
+    results = {'params': {**vars(args), 'progress_cache_ttl': settings.progress_cache_ttl}}
+    with tempfile.TemporaryDirectory() as folder:
+        manager = await create_database(os.path.join(folder, 'polling.sqlite3'), args.users)
+        # Replaces the global manager instead of a dependency override, that FastAPI analyzes again at each request
+        database.sessionmanager = manager
+        for mode in ('per_request', 'coalesced', 'cached', 'etag'):
+            results[mode] = await run(mode, args)
+        await manager.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=10, help='users polled by the clients')
+    parser.add_argument('--duration', type=float, default=5, help='in seconds, for each mode')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,63 @@
+"""
+Compares the progress and user check queries when a user has many rows:
+loading all the WeatherData objects (previous implementation) against COUNT/EXISTS on the
+(user_id, request_date, id) index
+
+Usage: python -m benchmarks.bench_progress [--rows 100000] [--repeat 20]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from sqlalchemy import select, text
+
+from benchmarks.bench_persistence import city_data, create_database
+from managers.weather import WeatherManager
+from models.weather import WeatherData
+
+
+async def timed(fn, repeat: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        await fn()
+    return round((time.perf_counter() - started_at) / repeat * 1000, 3)
+
+
+async def main(rows: int, repeat: int):
+    with tempfile.TemporaryDirectory() as folder:
+        manager = await create_database(os.path.join(folder, 'progress.sqlite3'))
+        async with manager.session() as session:
+            weather_manager = WeatherManager(session)
+            async with weather_manager.buffered_writer(max_rows=300) as writer:
+                for city_id in range(rows):
+                    await writer.add(1, city_data(city_id))
+
+            async def load_all():
+                # Previous get_percentage/check_user implementation
+                processed = await session.scalars(select(WeatherData).where(WeatherData.user_id == 1).order_by(WeatherData.request_date))
+                len(processed.all())
+                session.expunge_all()
+
+            plan = await session.execute(text('EXPLAIN QUERY PLAN SELECT count(*) FROM weather_data WHERE user_id = 1'))
+            results = {
+                'rows': rows,
+                'load_all_ms': await timed(load_all, max(1, repeat // 10)),
+                'count_ms': await timed(lambda: weather_manager.count_complete_cities(1), repeat),
+                'exists_ms': await timed(lambda: weather_manager.check_user(1), repeat),
+                'count_query_plan': [row[-1] for row in plan],
+            }
+        await manager.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.repeat))
@@ -0,0 +1,82 @@
+"""
+Reading the results of a user with many rows:
+- memory peak (tracemalloc) of loading all the WeatherData objects (get_complete_cities) against the
+  NDJSON export streamed from the database cursor, for each number of rows
+- time of the first and the last page with keyset pagination against LIMIT/OFFSET
+
+Usage: python -m benchmarks.bench_results [--rows 10000 100000] [--page-size 100]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.bench_persistence import city_data, create_database
+from managers.weather import WeatherManager, results_query
+from services.results import export_results
+
+
+async def memory_peak(fn) -> float:
+    # Peak of the memory allocated while fn runs, in MB
+    tracemalloc.start()
+    await fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024 / 1024, 2)
+
+
+async def timed(fn, repeat: int = 20) -> float:
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        await fn()
+    return round((time.perf_counter() - started_at) / repeat * 1000, 3)
+
+
+async def run(folder: str, rows: int, page_size: int) -> dict:
+    manager = await create_database(os.path.join(folder, f'results_{rows}.sqlite3'))
+    async with manager.session() as session:
+        weather_manager = WeatherManager(session)
+        async with weather_manager.buffered_writer(max_rows=300) as writer:
+            for city_id in range(rows):
+                await writer.add(1, city_data(city_id))
+
+        async def load_all():
+            len(await weather_manager.get_complete_cities(1))
+            session.expunge_all()
+
+        async def export():
+            async for _ in export_results(manager, 1, 'ndjson', batch_size=1000):
+                pass
+
+        last_page = (await weather_manager.get_results_page(1, limit=rows))[-page_size - 1]
+        offset_query = results_query(1).limit(page_size).offset(rows - page_size)
+
+        results = {
+            'rows': rows,
+            'load_all_peak_mb': await memory_peak(load_all),
+            'export_peak_mb': await memory_peak(export),
+            'keyset_first_page_ms': await timed(lambda: weather_manager.get_results_page(1, limit=page_size)),
+            'keyset_last_page_ms': await timed(lambda: weather_manager.get_results_page(
+                1, limit=page_size, after=(last_page.request_date, last_page.id))),
+            'offset_last_page_ms': await timed(lambda: session.execute(offset_query)),
+        }
+    await manager.close()
+    return results
+
+
+async def main(rows: list[int], page_size: int):
+    with tempfile.TemporaryDirectory() as folder:
+        results = {'page_size': page_size, 'runs': [await run(folder, count, page_size) for count in rows]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.page_size))
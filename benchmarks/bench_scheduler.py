@@ -0,0 +1,108 @@
+"""
+Simulation of concurrent jobs of mixed sizes sharing the OpenWeather quota, with the limiter in FIFO order
+(previous behavior) and with the fair scheduler (services/scheduler.py), for the sliding window of RequestLimiter
+(the slots of a window are used in bursts) and for GCRA (one slot per second)
+
+Big jobs (all the 167 cities) start first and small jobs (5 cities) arrive while they run, some of them
+with the high priority class. Each job runs like WeatherService: `--max-in-flight` workers that take a slot
+of the limiter and wait the upstream latency.
+
+The quota is scaled up (--speedup) so the simulation takes seconds, the reported times are converted
+back to the real quota of 60 requests per minute
+
+Usage: python -m benchmarks.bench_scheduler [--big 4] [--small 10] [--max-in-flight 10] [--speedup 40]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import constants
+from backend.settings import settings
+from services.limiter import GCRA, AsyncRateLimiter, SlidingWindow
+from services.scheduler import FairScheduler, priority_weight
+
+REAL_LIMIT = 60  # requests per minute
+REAL_LATENCY = 0.2  # seconds per request
+
+
+async def run_job(limiter, cities: int, max_in_flight: int, latency: float) -> float:
+    # Returns the time to fetch all the cities of the job
+    pending = list(range(cities))
+    started_at = time.monotonic()
+
+    async def worker():
+        while pending:
+            pending.pop()
+            await limiter.acquire()
+            await asyncio.sleep(latency)
+
+    await asyncio.gather(*[worker() for _ in range(min(max_in_flight, cities))])
+    return time.monotonic() - started_at
+
+
+class FlowLimiter:
+    # The limiter of one job with the fair scheduler (SchedulerFlow without the call_external_api wrapper)
+    def __init__(self, scheduler: FairScheduler, key: int, weight: int):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+
+    async def acquire(self):
+        await self.scheduler.acquire(self.key, self.weight)
+
+
+ALGORITHMS = {
+    'sliding_window': lambda scale: SlidingWindow(limit=REAL_LIMIT, period=60 / scale),
+    'gcra': lambda scale: GCRA(limit=REAL_LIMIT, period=60 / scale, burst=1),
+}
+
+
+async def simulate(algorithm: str, fair: bool, args) -> dict:
+    scale = args.speedup
+    limiter = AsyncRateLimiter(ALGORITHMS[algorithm](scale))
+    scheduler = FairScheduler(limiter)
+    latency = REAL_LATENCY / scale
+    jobs = []
+
+    def start(key: int, kind: str, cities: int, weight: int):
+        job_limiter = FlowLimiter(scheduler, key, weight) if fair else limiter
+        jobs.append((kind, asyncio.create_task(run_job(job_limiter, cities, args.max_in_flight, latency))))
+
+    for key in range(args.big):
+        start(key, 'big', len(constants.CITIES_IDs), priority_weight('normal'))
+    # The small jobs arrive one every --small-interval seconds (real time), every third one with high priority
+    for i in range(args.small):
+        await asyncio.sleep(args.small_interval / scale)
+        high = i % 3 == 2
+        start(args.big + i, 'small_high' if high else 'small', args.small_cities, priority_weight('high' if high else 'normal'))
+
+    durations: dict[str, list[float]] = {}
+    for kind, task in jobs:
+        durations.setdefault(kind, []).append(await task * scale)
+
+    return {
+        kind: {'jobs': len(values), 'p50_s': round(statistics.median(values), 1), 'max_s': round(max(values), 1)}
+        for kind, values in durations.items()
+    }
+
+
+async def main(args):
+    results = {'params': {**vars(args), 'quota_per_minute': REAL_LIMIT, 'latency_s': REAL_LATENCY, 'weights': settings.scheduler_weights}}
+    for algorithm in ALGORITHMS:
+        results[algorithm] = {'fifo': await simulate(algorithm, False, args), 'fair': await simulate(algorithm, True, args)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--big', type=int, default=4, help='jobs with all the cities, started first')
+    parser.add_argument('--small', type=int, default=10, help='jobs arriving while the big ones run')
+    parser.add_argument('--small-cities', type=int, default=5)
+    parser.add_argument('--small-interval', type=float, default=17, help='seconds between the small jobs')
+    parser.add_argument('--max-in-flight', type=int, default=10)
+    parser.add_argument('--speedup', type=float, default=40)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
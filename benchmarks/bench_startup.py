@@ -0,0 +1,74 @@
+"""
+Measures the schema initialisation at startup and the per request overhead of the database dependency of
+GET /weather (db_sessionmanager), running create_all in every request (previous implementation) or only at startup
+The progress cache is disabled (ttl 0), so each request reads the database
+
+Usage: python -m benchmarks.bench_startup [--requests 500]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from httpx import AsyncClient
+
+from backend.database import DatabaseSessionManager, db_sessionmanager, init_schema
+from backend.settings import settings
+from main import app
+from models.weather import Base
+from routers import weather
+from services.cache import ResponseCache
+
+
+async def timed_requests(client: AsyncClient, requests: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(requests):
+        await client.get('/weather', params={'user_id': 1})
+    return round((time.perf_counter() - started_at) / requests * 1000, 3)
+
+
+async def main(requests: int):
+    with tempfile.TemporaryDirectory() as folder:
+        manager = DatabaseSessionManager(f"sqlite+aiosqlite:///{os.path.join(folder, 'startup.sqlite3')}")
+
+        started_at = time.perf_counter()
+        await init_schema(manager)
+        new_database_ms = (time.perf_counter() - started_at) * 1000
+
+        started_at = time.perf_counter()
+        await init_schema(manager)
+        existing_database_ms = (time.perf_counter() - started_at) * 1000
+
+        async def create_all_per_request():
+            async with manager.connect() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            return manager
+
+        def manager_only():
+            return manager
+
+        results = {
+            'requests': requests,
+            'startup_new_database_ms': round(new_database_ms, 3),
+            'startup_existing_database_ms': round(existing_database_ms, 3),
+        }
+        weather.progress_cache = ResponseCache(ttl=0, max_entries=settings.progress_cache_max_entries)
+        async with AsyncClient(app=app, base_url='http://bench') as client:
+            for name, dependency in [('create_all_per_request_ms', create_all_per_request), ('startup_only_ms', manager_only)]:
+                app.dependency_overrides[db_sessionmanager] = dependency
+                await timed_requests(client, 10)  # warm up
+                results[name] = await timed_requests(client, requests)
+        app.dependency_overrides.clear()
+        await manager.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.requests))
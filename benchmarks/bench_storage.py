@@ -0,0 +1,91 @@
+"""
+Compares the storage size and the read/write time of the weather readings stored as a JSON
+blob (previous layout, schema version 1) and as typed columns (current WeatherData)
+Both tables have about the same size on disk: the JSON keys saved by the typed columns are spent on the
+(user_id, city_id) unique index and the fetched_at column. The typed table is faster to read and slower to
+write, as each insert also updates the unique index
+
+Usage: python -m benchmarks.bench_storage [--rows 100000]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import time
+
+from sqlalchemy import JSON, Column, DateTime, Index, Integer, MetaData, Table, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from models.weather import WeatherData
+
+legacy_metadata = MetaData()
+legacy_table = Table(
+    'weather_data', legacy_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('request_date', DateTime),
+    Column('data', JSON),
+    Index('ix_weather_data_user_id_request_date', 'user_id', 'request_date'),
+)
+
+
+def legacy_row(city_id: int, now: datetime.datetime) -> dict:
+    return {'user_id': 1, 'request_date': now, 'data': {'city_id': city_id, 'temperature_c': 21.5, 'humidity': 64}}
+
+
+def typed_row(city_id: int, now: datetime.datetime) -> dict:
+    return {'user_id': 1, 'request_date': now, 'city_id': city_id, 'temperature': 21.5, 'humidity': 64, 'fetched_at': now}
+
+
+async def run(path: str, table: Table, make_row, columns, values, rows: int) -> dict:
+    engine = create_async_engine(f'sqlite+aiosqlite:///{path}')
+    async with engine.begin() as connection:
+        await connection.run_sync(table.create)
+
+    now = datetime.datetime.utcnow()
+    started_at = time.perf_counter()
+    for start in range(0, rows, 1000):
+        async with engine.begin() as connection:
+            await connection.execute(table.insert(), [make_row(city_id, now) for city_id in range(start, min(start + 1000, rows))])
+    write = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    async with engine.connect() as connection:
+        result = await connection.execute(select(*columns))
+        # Reads the three values of each reading, as the results endpoint does
+        checksum = sum(sum(values(row)) for row in result)
+    read = time.perf_counter() - started_at
+    await engine.dispose()
+
+    return {
+        'file_bytes': os.path.getsize(path),
+        'bytes_per_row': round(os.path.getsize(path) / rows, 1),
+        'write_rows_per_s': round(rows / write, 1),
+        'read_rows_per_s': round(rows / read, 1),
+        'checksum': checksum,
+    }
+
+
+async def main(rows: int):
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = await run(
+            os.path.join(folder, 'legacy.sqlite3'), legacy_table, legacy_row, [legacy_table.c.data],
+            lambda row: (row[0]['city_id'], row[0]['temperature_c'], row[0]['humidity']), rows,
+        )
+        typed_table = WeatherData.__table__
+        typed = await run(
+            os.path.join(folder, 'typed.sqlite3'), typed_table, typed_row,
+            [typed_table.c.city_id, typed_table.c.temperature, typed_table.c.humidity], lambda row: row, rows,
+        )
+
+    print(json.dumps({'rows': rows, 'json_blob': legacy, 'typed_columns': typed}, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows))
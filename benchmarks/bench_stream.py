@@ -0,0 +1,59 @@
+"""
+Load test of the progress stream fan-out: N watchers follow the same job while it publishes one
+event per city, and the CPU time of the process is reported per watcher and per delivered event
+
+Usage: python -m benchmarks.bench_stream [--watchers 1000 5000] [--cities 167]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from services.progress import JobRegistry, format_sse, stream_events
+
+
+async def run(watchers: int, cities: int) -> dict:
+    registry = JobRegistry()
+    progress = registry.start(user_id=1, total=cities)
+    received = 0
+
+    async def watcher():
+        nonlocal received
+        subscription = registry.subscribe(1, max_events=cities + 1)
+        async for _ in stream_events(registry, subscription, format_sse('progress', {'progress': progress.snapshot()}), heartbeat=15):
+            received += 1
+
+    tasks = [asyncio.create_task(watcher()) for _ in range(watchers)]
+    await asyncio.sleep(0)  # All the watchers are connected
+
+    cpu_started_at, started_at = time.process_time(), time.perf_counter()
+    for city_id in range(cities):
+        progress.city_done()
+        registry.publish(1, 'city', {'city_id': city_id, 'data': {'city_id': city_id, 'temperature_c': 21.5, 'humidity': 64}, 'progress': progress.snapshot()})
+        await asyncio.sleep(0)  # Let the watchers run between the cities, as in a real job
+    registry.finish(progress)
+    await asyncio.gather(*tasks)
+    cpu, elapsed = time.process_time() - cpu_started_at, time.perf_counter() - started_at
+
+    return {
+        'watchers': watchers,
+        'events_delivered': received,
+        'elapsed_s': round(elapsed, 4),
+        'cpu_s': round(cpu, 4),
+        'cpu_ms_per_watcher': round(cpu / watchers * 1000, 4),
+        'cpu_us_per_event': round(cpu / received * 1_000_000, 3),
+    }
+
+
+async def main(watchers: list[int], cities: int):
+    results = {'cities': cities, 'runs': [await run(count, cities) for count in watchers]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--watchers', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--cities', type=int, default=167)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.watchers, args.cities))
@@ -4,11 +4,15 @@ import pytest
 import pytest_asyncio
 from httpx import AsyncClient
 
-from backend.database import db_session
+from backend.database import db_session, db_sessionmanager
 from backend.database import test_sessionmanager
 from main import app
 from managers.weather import WeatherManager
 from models.weather import Base
+from services.cache import progress_cache, weather_cache
+from services.metrics import registry
+from services.progress import job_registry
+from services.retry import circuit_breakers
 
 
 # Basic configuration to run the tests, with data and Session mocks
@@ -26,14 +30,14 @@ async def create_data_in_database(create_test_session):
     user_id = 1
     data = {
         'city_id': 12345,
-        'temp_c': 35,
+        'temperature_c': 35,
         'humidity': 48
     }
     data_1 = await WeatherManager(create_test_session).save_city_weather(user_id, data)
 
     data = {
-        'city_id': 12345,
-        'temp_c': 24,
+        'city_id': 12346,
+        'temperature_c': 24,
         'humidity': 76
     }
     data_2 = await WeatherManager(create_test_session).save_city_weather(user_id, data)
@@ -59,6 +63,17 @@ async def create_test_session():
 def override_db_session(create_test_session):
     # Overrides the database session, in this case using test_sessionmanager.
     app.dependency_overrides[db_session] = lambda: create_test_session
+    app.dependency_overrides[db_sessionmanager] = lambda: test_sessionmanager
+
+
+@pytest.fixture(scope='function', autouse=True)
+def clear_job_registry():
+    # Each test starts without jobs, cached responses, circuit breakers and metrics in memory
+    job_registry.clear()
+    weather_cache.clear()
+    progress_cache.clear()
+    circuit_breakers.clear()
+    registry.clear()
 
 
 @pytest_asyncio.fixture(scope='function', autouse=True)
@@ -1,6 +1,29 @@
+import asyncio
+import contextlib
+
 from fastapi import FastAPI
+
+from backend.database import init_schema, sessionmanager
 from backend.settings import settings
-from routers import weather
+from routers import metrics, weather
+from services.http import http_client_manager
+from services.jobs import job_worker
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create or migrate the database schema once, instead of in each request
+    await init_schema()
+    await http_client_manager.start()
+    worker = asyncio.create_task(job_worker.run()) if settings.job_worker_in_app else None
+    yield
+    if worker is not None:
+        worker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await worker
+    await http_client_manager.close()
+    await sessionmanager.close()
+
 
 # Configuration of the FastAPI
 app = FastAPI(
@@ -9,7 +32,9 @@ app = FastAPI(
     version=settings.project_version,
     swagger_ui_parameters={"defaultModelsExpandDepth": -1},
     docs_url="/",
+    lifespan=lifespan,
 )
 
 # Add the router to the app
-app.include_router(weather.router)
\ No newline at end of file
+app.include_router(weather.router)
+app.include_router(metrics.router)
@@ -0,0 +1,163 @@
+import datetime
+
+from sqlalchemy import and_, case, delete, func, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.settings import settings
+from models.weather import WeatherJob, WeatherJobCity
+
+
+class JobManager:
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def enqueue(self, user_id: int, cities: list[int], priority: str = 'normal', max_age: int | None = None,
+                      fetch_cities: list[int] | None = None) -> WeatherJob:
+        """
+        This functions adds a new pending job for the user, max_age is given for a refresh
+        Only fetch_cities (the stale ones of a refresh) are fetched if given, the job keeps all the cities
+        """
+        job = WeatherJob(user_id=user_id, cities=cities, status='pending', attempts=0, priority=priority, max_age=max_age)
+        self.session.add(job)
+        await self.session.flush()
+        await self._add_cities(job.id, cities if fetch_cities is None else fetch_cities)
+        await self.session.commit()
+
+        return job
+
+    async def requeue(self, user_id: int, cities: list[int], priority: str = 'normal', max_age: int | None = None,
+                      fetch_cities: list[int] | None = None) -> WeatherJob | None:
+        """
+        This functions returns the finished job of the user to the queue with a new list of cities (refresh),
+        returns None if the job is still pending or running
+        Only fetch_cities (the stale ones) are fetched if given, the job keeps all the cities for the next refresh
+        """
+        update_stmt = (
+            update(WeatherJob)
+            .where(WeatherJob.user_id == user_id, WeatherJob.status.in_(('done', 'failed')))
+            .values(cities=cities, status='pending', attempts=0, priority=priority, max_age=max_age, created_at=datetime.datetime.utcnow(),
+                    finished_at=None, lease_owner=None, lease_expires_at=None)
+            .returning(WeatherJob)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        job = await self.session.scalar(update_stmt)
+        if job is None:
+            await self.session.rollback()
+            return None
+
+        self.session.expunge(job)
+        await self.session.execute(delete(WeatherJobCity).where(WeatherJobCity.job_id == job.id))
+        await self._add_cities(job.id, cities if fetch_cities is None else fetch_cities)
+        await self.session.commit()
+
+        return job
+
+    async def _add_cities(self, job_id: int, cities: list[int]):
+        # One pending row per city, with a single INSERT
+        now = datetime.datetime.utcnow()
+        rows = [{'job_id': job_id, 'city_id': city_id, 'status': 'pending', 'updated_at': now} for city_id in dict.fromkeys(cities)]
+        if rows:
+            await self.session.execute(insert(WeatherJobCity), rows)
+
+    async def get_city_ids(self, job_id: int) -> set[int]:
+        """
+        This functions gets the cities to fetch of the job, from weather_job_city
+        """
+        select_stmt = select(WeatherJobCity.city_id).where(WeatherJobCity.job_id == job_id)
+
+        result = await self.session.scalars(select_stmt)
+        return set(result.all())
+
+    async def get_job(self, user_id: int) -> WeatherJob | None:
+        """
+        This functions gets the job of the user, if there is one
+        """
+        select_stmt = select(WeatherJob).where(WeatherJob.user_id == user_id)
+
+        return await self.session.scalar(select_stmt)
+
+    async def count_by_status(self) -> dict[str, int]:
+        """
+        This functions counts the jobs of each status, using the (status, id) index
+        """
+        select_stmt = select(WeatherJob.status, func.count()).group_by(WeatherJob.status)
+
+        result = await self.session.execute(select_stmt)
+        return {status: count for status, count in result.all()}
+
+    async def claim(self, worker_id: str, lease_seconds: float, priorities: tuple[str, ...] | None = None) -> WeatherJob | None:
+        """
+        This functions claims the oldest pending job of the highest priority, or a running job whose lease expired
+        (the worker died), with a single UPDATE so two workers never claim the same job
+        Only the jobs of the given priorities are claimed, if given
+        """
+        now = datetime.datetime.utcnow()
+        claimable = or_(
+            WeatherJob.status == 'pending',
+            and_(WeatherJob.status == 'running', WeatherJob.lease_expires_at < now),
+        )
+        if priorities is not None:
+            claimable = and_(claimable, WeatherJob.priority.in_(priorities))
+        # Ranked by the weight of the priority in the scheduler
+        rank = case(settings.scheduler_weights, value=WeatherJob.priority, else_=0)
+        next_job = (
+            select(WeatherJob.id).where(claimable).order_by(rank.desc(), WeatherJob.id).limit(1)
+            .with_for_update(skip_locked=True).scalar_subquery()
+        )
+        update_stmt = (
+            update(WeatherJob)
+            .where(WeatherJob.id == next_job, claimable)
+            .values(
+                status='running',
+                lease_owner=worker_id,
+                lease_expires_at=now + datetime.timedelta(seconds=lease_seconds),
+                attempts=WeatherJob.attempts + 1,
+            )
+            .returning(WeatherJob)
+            .execution_options(synchronize_session=False)
+        )
+
+        job = await self.session.scalar(update_stmt)
+        if job is not None:
+            # Detached, so the claimed values are kept after the commit
+            self.session.expunge(job)
+        await self.session.commit()
+
+        return job
+
+    async def renew_lease(self, job_id: int, worker_id: str, lease_seconds: float) -> bool:
+        """
+        This functions extends the lease of a running job, returns False if the worker lost the job
+        """
+        update_stmt = (
+            update(WeatherJob)
+            .where(WeatherJob.id == job_id, WeatherJob.lease_owner == worker_id, WeatherJob.status == 'running')
+            .values(lease_expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds))
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session.execute(update_stmt)
+        await self.session.commit()
+
+        return result.rowcount == 1
+
+    async def finish(self, job_id: int, worker_id: str, status: str = 'done'):
+        """
+        This functions marks the job as done or failed
+        """
+        await self._release(job_id, worker_id, status=status, finished_at=datetime.datetime.utcnow())
+
+    async def retry(self, job_id: int, worker_id: str):
+        """
+        This functions returns the job to the queue, to be claimed again
+        """
+        await self._release(job_id, worker_id, status='pending')
+
+    async def _release(self, job_id: int, worker_id: str, **values):
+        update_stmt = (
+            update(WeatherJob)
+            .where(WeatherJob.id == job_id, WeatherJob.lease_owner == worker_id)
+            .values(lease_owner=None, lease_expires_at=None, **values)
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(update_stmt)
+        await self.session.commit()
@@ -1,9 +1,65 @@
-from typing import Any
+import asyncio
+import datetime
+from typing import Any, AsyncIterator
 
-from sqlalchemy import select
+from sqlalchemy import Row, exists, func, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from models.weather import WeatherData
+from backend.settings import settings
+from models.weather import WeatherData, WeatherJob, WeatherJobCity
+from services.metrics import db_commit_seconds, span
+from services.parsing import WeatherRecord
+
+
+def weather_row(user_id: int, data: WeatherRecord | dict[str, Any]) -> dict[str, Any]:
+    # Maps the data of a city (see services/parsing.py) to the columns of weather_data
+    if not isinstance(data, WeatherRecord):
+        data = WeatherRecord.from_dict(data)
+
+    now = datetime.datetime.utcnow()
+    return {
+        'user_id': user_id,
+        'request_date': now,
+        'city_id': data.city_id,
+        'temperature': data.temperature_c,
+        'humidity': data.humidity,
+        'fetched_at': datetime.datetime.utcfromtimestamp(data.fetched_at) if data.fetched_at else now,
+    }
+
+
+def upsert_weather(dialect: str, rows: list[dict[str, Any]]):
+    # INSERT that updates the reading when the city was already saved for the user, so re-fetches are idempotent
+    insert_stmt = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(WeatherData).values(rows)
+    return insert_stmt.on_conflict_do_update(
+        index_elements=['user_id', 'city_id'],
+        set_={column: insert_stmt.excluded[column] for column in ('request_date', 'temperature', 'humidity', 'fetched_at')},
+    )
+
+
+def mark_job_cities(job_id: int, city_ids, status: str):
+    # Status of a set of cities of the job, in one UPDATE
+    return (
+        update(WeatherJobCity)
+        .where(WeatherJobCity.job_id == job_id, WeatherJobCity.city_id.in_(city_ids))
+        .values(status=status, updated_at=datetime.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def results_query(user_id: int, after: tuple[datetime.datetime, int] | None = None):
+    # Readings of the user in (request_date, id) order, after the given key (keyset pagination)
+    # Only the columns are selected, so the rows are not kept in the session identity map
+    select_stmt = (
+        select(WeatherData.id, WeatherData.request_date, WeatherData.city_id, WeatherData.temperature,
+               WeatherData.humidity, WeatherData.fetched_at)
+        .where(WeatherData.user_id == user_id)
+        .order_by(WeatherData.request_date, WeatherData.id)
+    )
+    if after is not None:
+        select_stmt = select_stmt.where(tuple_(WeatherData.request_date, WeatherData.id) > tuple_(*after))
+
+    return select_stmt
 
 
 class WeatherManager:
@@ -16,24 +72,38 @@ class WeatherManager:
          If exists, return True, that indicates that the user already made a request
             and the user must be unique for each request
         """
-        select_stmt = select(WeatherData).where(WeatherData.user_id == user_id)
-
-        result = await self.session.scalars(select_stmt)
-        result = result.all()
+        select_stmt = select(exists().where(WeatherData.user_id == user_id))
 
-        return True if result else False
+        return await self.session.scalar(select_stmt)
 
-    async def save_city_weather(self, user_id: int, data: dict[str, Any]):
+    async def save_city_weather(self, user_id: int, data: WeatherRecord | dict[str, Any]):
         """
         This functions saves the weather data to the database
         """
-        weather = WeatherData(user_id=user_id, data=data)
-        self.session.add(weather)
-        await self.session.commit()
+        upsert_stmt = (
+            upsert_weather(self.session.bind.dialect.name, [weather_row(user_id, data)])
+            .returning(WeatherData)
+            .execution_options(populate_existing=True)
+        )
+        with db_commit_seconds.labels('save_city_weather').time():
+            weather = await self.session.scalar(upsert_stmt)
+            await self.session.commit()
         await self.session.refresh(weather)
 
         return weather
 
+    def buffered_writer(self, max_rows: int | None = None, max_delay: float | None = None,
+                        job_id: int | None = None) -> 'BufferedWeatherWriter':
+        """
+        This functions creates a writer that saves the weather data in batches, and the state of the cities of the job if given
+        """
+        return BufferedWeatherWriter(
+            self.session,
+            max_rows=max_rows or settings.weather_write_batch_size,
+            max_delay=max_delay if max_delay is not None else settings.weather_write_flush_interval_ms / 1000,
+            job_id=job_id,
+        )
+
     async def get_complete_cities(self, user_id: int):
         """
         This functions gets the percentage of processed cities
@@ -44,3 +114,169 @@ class WeatherManager:
         processed = processed.all()
 
         return processed
+
+    async def get_results_page(self, user_id: int, limit: int, after: tuple[datetime.datetime, int] | None = None) -> list[Row]:
+        """
+        This functions gets one page of readings of the user, starting after the (request_date, id) key of the previous page
+        """
+        result = await self.session.execute(results_query(user_id, after).limit(limit))
+
+        return list(result.all())
+
+    async def stream_results(self, user_id: int, batch_size: int) -> AsyncIterator[list[Row]]:
+        """
+        This functions reads all the readings of the user from a database cursor, in lists of up to batch_size rows
+        """
+        result = await self.session.stream(results_query(user_id).execution_options(yield_per=batch_size))
+        async for rows in result.partitions():
+            yield rows
+
+    async def get_saved_city_ids(self, user_id: int) -> set[int]:
+        """
+        This functions gets the ids of the cities already saved for the user, with a single query
+        """
+        select_stmt = select(WeatherData.city_id).where(WeatherData.user_id == user_id)
+
+        result = await self.session.scalars(select_stmt)
+        return set(result.all())
+
+    async def get_stale_city_ids(self, user_id: int, city_ids: list[int], max_age: float) -> list[int]:
+        """
+        This functions gets the cities without a reading fetched in the last max_age seconds, keeping the given order,
+        with a single query for the fresh ones
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        select_stmt = select(WeatherData.city_id).where(WeatherData.user_id == user_id, WeatherData.fetched_at >= cutoff)
+
+        fresh = set((await self.session.scalars(select_stmt)).all())
+        return [city_id for city_id in city_ids if city_id not in fresh]
+
+    async def get_pending_city_ids(self, job_id: int) -> set[int]:
+        """
+        This functions gets the cities of the job that are not done (pending or failed)
+        The cities saved since the job was requested are marked as done first, with one UPDATE
+        """
+        saved = (
+            select(WeatherData.city_id)
+            .join(WeatherJob, WeatherJob.user_id == WeatherData.user_id)
+            .where(WeatherJob.id == job_id, WeatherData.request_date >= WeatherJob.created_at)
+        )
+        await self.session.execute(mark_job_cities(job_id, saved, 'done').where(WeatherJobCity.status != 'done'))
+        await self.session.commit()
+
+        select_stmt = select(WeatherJobCity.city_id).where(WeatherJobCity.job_id == job_id, WeatherJobCity.status != 'done')
+        result = await self.session.scalars(select_stmt)
+        return set(result.all())
+
+    async def count_job_cities(self, job_id: int) -> dict[str, int]:
+        """
+        This functions counts the cities of the job by status, using the primary key (job_id, city_id)
+        """
+        select_stmt = (
+            select(WeatherJobCity.status, func.count())
+            .where(WeatherJobCity.job_id == job_id)
+            .group_by(WeatherJobCity.status)
+        )
+
+        result = await self.session.execute(select_stmt)
+        return {status: count for status, count in result.all()}
+
+    async def count_complete_cities(self, user_id: int) -> int:
+        """
+        This functions counts the processed cities, using only the (user_id, request_date, id) index
+        """
+        select_stmt = select(func.count()).select_from(WeatherData).where(WeatherData.user_id == user_id)
+
+        return await self.session.scalar(select_stmt)
+
+
+class BufferedWeatherWriter:
+    """
+    Collects the weather data and saves it with one multi-row INSERT (upsert) and one commit
+    The buffer is flushed when it has max_rows rows or when the oldest row waited max_delay seconds,
+    and a final flush runs when the writer is closed (use it as an async context manager)
+    A failed flush keeps its rows in the buffer, the error of a timed flush is raised by the next add() or when closing
+
+    With a job, the saved and the failed cities are marked in weather_job_city in the same commit as the rows
+    """
+
+    def __init__(self, session: AsyncSession, max_rows: int, max_delay: float, job_id: int | None = None):
+        self.session = session
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.job_id = job_id
+        # Indexed by (user_id, city_id), a city added twice before a flush is saved once
+        self.rows: dict[tuple[int, int], dict[str, Any]] = {}
+        self.failed: set[int] = set()
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+        self._error: Exception | None = None  # Of the last timed flush, if it failed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._raise_error()
+        await self.flush()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    async def add(self, user_id: int, data: WeatherRecord | dict[str, Any]):
+        self._raise_error()
+        # The request date is the time the data arrived, not the time it was flushed
+        row = weather_row(user_id, data)
+        self.rows[(user_id, row['city_id'])] = row
+
+        if len(self.rows) >= self.max_rows:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def add_failed(self, city_id: int):
+        # Only recorded with a job, saved with the next flush
+        self._raise_error()
+        if self.job_id is None:
+            return
+
+        self.failed.add(city_id)
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        try:
+            await self.flush()
+        except Exception as e:
+            # Nobody awaits this task, so the error is kept for the writer's user
+            self._error = e
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+            self._timer = None
+
+            rows, self.rows = self.rows, {}
+            failed, self.failed = self.failed, set()
+            if not rows and not failed:
+                return
+
+            try:
+                with span('weather.persist', rows=len(rows)), db_commit_seconds.labels('flush').time():
+                    if rows:
+                        await self.session.execute(upsert_weather(self.session.bind.dialect.name, list(rows.values())))
+                    if self.job_id is not None:
+                        if rows:
+                            await self.session.execute(mark_job_cities(self.job_id, [city_id for _, city_id in rows], 'done'))
+                        if failed:
+                            await self.session.execute(mark_job_cities(self.job_id, failed, 'failed'))
+                    await self.session.commit()
+            except Exception:
+                # Back to the buffer (the rows added meanwhile are newer), for the next flush
+                await self.session.rollback()
+                self.rows = {**rows, **self.rows}
+                self.failed |= failed
+                raise
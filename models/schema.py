@@ -0,0 +1,13 @@
+import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from models.weather import SQLModel
+
+
+class SchemaVersion(SQLModel):
+    # One row each time the schema is created or upgraded, the current version is the highest one
+    __tablename__ = 'schema_version'
+
+    version: Mapped[int] = mapped_column('version', primary_key=True, autoincrement=False)
+    applied_at: Mapped[datetime.datetime] = mapped_column('applied_at', default=datetime.datetime.utcnow)
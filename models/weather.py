@@ -1,6 +1,6 @@
 import datetime
 
-from sqlalchemy import Integer, JSON
+from sqlalchemy import Float, Index, Integer, JSON, SmallInteger, String, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, declarative_base
 
 Base = declarative_base()
@@ -12,8 +12,48 @@ class SQLModel(Base):
 
 class WeatherData(SQLModel):
     __tablename__ = 'weather_data'
+    __table_args__ = (
+        # One reading per city for each user, fetching the city again updates the row
+        UniqueConstraint('user_id', 'city_id', name='uq_weather_data_user_id_city_id'),
+        # Covers the progress (COUNT), the user check (EXISTS) and the results pages (keyset on request_date, id)
+        Index('ix_weather_data_user_id_request_date_id', 'user_id', 'request_date', 'id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
     user_id: Mapped[int] = mapped_column('user_id', Integer)
     request_date: Mapped[datetime.datetime] = mapped_column('request_date', default=datetime.datetime.utcnow)
-    data: Mapped[dict] = mapped_column('data', JSON)
\ No newline at end of file
+    city_id: Mapped[int] = mapped_column('city_id', Integer)
+    temperature: Mapped[float] = mapped_column('temperature', Float)  # in Celsius
+    humidity: Mapped[int] = mapped_column('humidity', SmallInteger)  # in %
+    fetched_at: Mapped[datetime.datetime] = mapped_column('fetched_at', default=datetime.datetime.utcnow)  # when it was fetched from OpenWeather
+
+
+class WeatherJob(SQLModel):
+    # Durable queue of the weather requests, processed by the job workers (services/jobs.py)
+    __tablename__ = 'weather_job'
+    __table_args__ = (
+        # Used by the workers to find the next job to claim
+        Index('ix_weather_job_status_id', 'status', 'id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement='auto')
+    user_id: Mapped[int] = mapped_column('user_id', Integer, unique=True)
+    cities: Mapped[list] = mapped_column('cities', JSON)
+    status: Mapped[str] = mapped_column('status', String(16), default='pending')  # pending, running, done or failed
+    attempts: Mapped[int] = mapped_column('attempts', Integer, default=0)
+    priority: Mapped[str] = mapped_column('priority', String(16), default='normal')  # class of the fair scheduler, low, normal or high
+    max_age: Mapped[int | None] = mapped_column('max_age', Integer, nullable=True)  # refresh, in seconds, older cached readings are fetched again
+    lease_owner: Mapped[str | None] = mapped_column('lease_owner', String(64), nullable=True)
+    lease_expires_at: Mapped[datetime.datetime | None] = mapped_column('lease_expires_at', nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column('created_at', default=datetime.datetime.utcnow)  # time of the last request (refresh)
+    finished_at: Mapped[datetime.datetime | None] = mapped_column('finished_at', nullable=True)
+
+
+class WeatherJobCity(SQLModel):
+    # State of each city of a job, so an interrupted job resumes from the cities that are not done
+    __tablename__ = 'weather_job_city'
+
+    job_id: Mapped[int] = mapped_column('job_id', Integer, primary_key=True)
+    city_id: Mapped[int] = mapped_column('city_id', Integer, primary_key=True)
+    status: Mapped[str] = mapped_column('status', String(16), default='pending')  # pending, done or failed
+    updated_at: Mapped[datetime.datetime] = mapped_column('updated_at', default=datetime.datetime.utcnow)
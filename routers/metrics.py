@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.database import db_session
+from managers.jobs import JobManager
+from services.cache import progress_cache, weather_cache
+from services.metrics import cache_entries, jobs_in_queue, registry
+
+router = APIRouter(tags=['Metrics'])
+
+
+@router.get('/metrics', summary='', description='Metrics of the process in the Prometheus text format',
+            response_class=PlainTextResponse)
+async def metrics(
+        session: AsyncSession = Depends(db_session)
+):
+    # The job queue is shared by all the processes, so it is read from the database on each scrape
+    counts = await JobManager(session=session).count_by_status()
+    for status in ('pending', 'running', 'done', 'failed'):
+        jobs_in_queue.labels(status).set(counts.get(status, 0))
+    for cache in (weather_cache, progress_cache):
+        cache_entries.labels(cache.name).set(cache.stats()['size'])
+
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
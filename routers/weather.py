@@ -1,10 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+import datetime
+import hashlib
+from typing import Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from backend.database import db_session
+import constants
+from backend.database import DatabaseSessionManager, db_session, db_sessionmanager
+from backend.settings import settings
+from managers.jobs import JobManager
 from managers.weather import WeatherManager
+from services.cache import progress_cache
+from services.jobs import job_worker
+from services.progress import event_message, format_sse, job_registry, stream_events
+from services.results import EXPORT_MEDIA_TYPES, arrow_available, decode_cursor, encode_cursor, export_results, result_item
 from services.weather import WeatherService
 
 router = APIRouter(prefix='/weather', tags=['Weather'])
@@ -13,6 +26,11 @@ router = APIRouter(prefix='/weather', tags=['Weather'])
 class RequestData(BaseModel):
     user_id: int = Field(..., alias='user_id')
     cities: list[int] | None = Field(None, alias='cities')
+    priority: Literal['low', 'normal', 'high'] = Field('normal', alias='priority',
+                                                       description='Share of the OpenWeather quota while other jobs are running')
+    max_age: int | None = Field(None, alias='max_age', ge=0,
+                                description='Refresh: fetch again only the cities whose last reading is older than max_age seconds '
+                                            '(the cached readings older than that are not reused)')
 
 
 class ResponseData(BaseModel):
@@ -22,22 +40,49 @@ class ResponseData(BaseModel):
 
 class ResponsePercentage(BaseModel):
     percentage: float = Field(..., alias='percentage', description='Percentage of processed cities')
+    eta: float | None = Field(None, alias='eta', description='Estimated seconds to finish, if the job is running in this server')
+
+
+class WeatherResult(BaseModel):
+    id: int
+    city_id: int
+    temperature_c: float
+    humidity: int
+    request_date: datetime.datetime
+    fetched_at: datetime.datetime
+
+
+class ResponseResults(BaseModel):
+    results: list[WeatherResult] = Field(..., alias='results')
+    next_cursor: str | None = Field(None, alias='next_cursor', description='Cursor of the next page, None in the last page')
 
 
 @router.post('', summary='', description='', status_code=status.HTTP_202_ACCEPTED)
 async def weather(
         request: RequestData,
-        background_tasks: BackgroundTasks,
         session: AsyncSession = Depends(db_session)
 ) -> ResponseData:
-    user_exists = await WeatherManager(session=session).check_user(user_id=request.user_id)
-    # Check if the user already request the weather data
+    if request.max_age is not None:
+        return await refresh_weather(request, session)
+
+    # Check if the user already request the weather data (a running job may not have saved any city yet)
+    user_exists = (
+        job_registry.get(request.user_id) is not None
+        or await JobManager(session=session).get_job(request.user_id) is not None
+        or await WeatherManager(session=session).check_user(user_id=request.user_id)
+    )
     if user_exists:
         raise HTTPException(status.HTTP_409_CONFLICT, detail='User already request weather data')
 
-    # Run the request in de background because it takes a long time to complete
-    service = WeatherService(session=session, user_id=request.user_id, cities=request.cities)
-    background_tasks.add_task(service.get_openweather_data)
+    # Add the request to the job queue because it takes a long time to complete, the job workers process it
+    try:
+        await JobManager(session=session).enqueue(request.user_id, cities=request.cities or constants.CITIES_IDs, priority=request.priority)
+    except IntegrityError:
+        # Another request of the same user was added at the same time
+        await session.rollback()
+        raise HTTPException(status.HTTP_409_CONFLICT, detail='User already request weather data')
+    forget_progress(request.user_id)
+    job_worker.notify()
 
     return ResponseData(
         title='Collecting weather data',
@@ -46,14 +91,195 @@ async def weather(
     )
 
 
-@router.get('', summary='', description='')
+async def refresh_weather(request: RequestData, session: AsyncSession) -> ResponseData:
+    # Only the stale cities are fetched again, in the job of the user (the cities of the last request by default)
+    job = await JobManager(session=session).get_job(request.user_id)
+    progress = job_registry.get(request.user_id)
+    if (progress is not None and not progress.finished) or (job is not None and job.status in ('pending', 'running')):
+        raise HTTPException(status.HTTP_409_CONFLICT, detail='The weather data of the user is still being collected')
+
+    cities = request.cities or (job.cities if job is not None else constants.CITIES_IDs)
+    stale = await WeatherManager(session=session).get_stale_city_ids(request.user_id, cities, max_age=request.max_age)
+    if not stale:
+        return ResponseData(title='Weather data is up to date',
+                            message=f'All the {len(cities)} cities have a reading of the last {request.max_age} seconds.')
+
+    try:
+        # The job keeps all the cities, so the next refresh checks all of them again
+        if job is None:
+            await JobManager(session=session).enqueue(request.user_id, cities=cities, priority=request.priority, max_age=request.max_age,
+                                                      fetch_cities=stale)
+        elif await JobManager(session=session).requeue(request.user_id, cities=cities, priority=request.priority,
+                                                       max_age=request.max_age, fetch_cities=stale) is None:
+            raise HTTPException(status.HTTP_409_CONFLICT, detail='The weather data of the user is still being collected')
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status.HTTP_409_CONFLICT, detail='The weather data of the user is still being collected')
+    job_registry.forget(request.user_id)
+    forget_progress(request.user_id)
+    job_worker.notify()
+
+    return ResponseData(
+        title='Refreshing weather data',
+        message=f'{len(stale)} of the {len(cities)} cities are being fetched again.',
+    )
+
+
+async def read_percentage(session_manager: DatabaseSessionManager, user_id: int) -> ResponsePercentage:
+    # Get the percentage of processed cities, from the cities of the job when there is one
+    # Uses its own session, as it is shared by the concurrent requests of the user
+    async with session_manager.session() as session:
+        job = await JobManager(session=session).get_job(user_id)
+        percentage = await WeatherService(session=session, user_id=user_id, cities=job.cities if job else None,
+                                          job_id=job.id if job else None).get_percentage()
+
+    return ResponsePercentage(
+        percentage=percentage
+    )
+
+
+def etag_response(content: BaseModel, if_none_match: str | None, state) -> Response:
+    # The ETag is a hash of the progress state, without the eta that changes at each poll, so it is weak (the body
+    # may differ for the same tag). A client that sends it back receives a 304 without body while the progress does not change
+    tag = f'"{hashlib.blake2b(repr(state).encode(), digest_size=8).hexdigest()}"'
+    headers = {'ETag': f'W/{tag}', 'Cache-Control': 'no-cache'}
+    # Weak comparison, as required for If-None-Match
+    if if_none_match is not None and tag in [sent.strip().removeprefix('W/') for sent in if_none_match.split(',')]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(content.model_dump_json(), media_type='application/json', headers=headers)
+
+
+@router.get('', summary='', description='', response_model=ResponsePercentage)
 async def get_weather(
         request: RequestData = Depends(),
+        if_none_match: str | None = Header(None),
+        session_manager: DatabaseSessionManager = Depends(db_sessionmanager)
+):
+    # Jobs running in this server are answered from memory, without querying the database
+    # The finished ones are read from the database, as another process may have requested them again
+    progress = job_registry.get(request.user_id)
+    if progress is not None and not progress.finished:
+        return etag_response(ResponsePercentage(percentage=progress.percentage, eta=progress.eta), if_none_match,
+                             state=(progress.total, progress.done, progress.failed, progress.finished))
+
+    # Concurrent polls of the user share one query, and its answer for progress_cache_ttl seconds
+    percentage = await progress_cache.get_or_fetch(request.user_id, lambda: read_percentage(session_manager, request.user_id))
+
+    return etag_response(percentage, if_none_match, state=percentage.percentage)
+
+
+def forget_progress(user_id: int):
+    # The answers shared by the polls and the streams of the user are outdated by a new request
+    progress_cache.delete(user_id)
+    progress_cache.delete(('stream', user_id))
+
+
+async def read_progress(session_manager: DatabaseSessionManager, user_id: int) -> dict | None:
+    # Progress of a job not running in this server (pending, in other process or finished), read from the database
+    # None if the user did not request weather data
+    async with session_manager.session() as session:
+        job = await JobManager(session=session).get_job(user_id)
+        if job is None and not await WeatherManager(session=session).check_user(user_id=user_id):
+            return None
+
+        percentage = await WeatherService(session=session, user_id=user_id, cities=job.cities if job else None,
+                                          job_id=job.id if job else None).get_percentage()
+
+    return {'percentage': percentage, 'finished': job is None or job.status in ('done', 'failed')}
+
+
+async def shared_progress(session_manager: DatabaseSessionManager, user_id: int) -> dict | None:
+    # The watchers of the user share one query, and its answer for progress_cache_ttl seconds
+    return await progress_cache.get_or_fetch(('stream', user_id), lambda: read_progress(session_manager, user_id))
+
+
+def poll_progress(session_manager: DatabaseSessionManager, user_id: int, last: dict):
+    # Returns the poll of stream_events, an event each time the progress in the database changes
+    async def poll() -> dict | None:
+        nonlocal last
+        progress = job_registry.get(user_id)
+        if progress is not None and not progress.finished:
+            # Claimed by a worker of this process, the events come from the registry
+            return None
+
+        snapshot = await shared_progress(session_manager, user_id)
+        if snapshot is None or snapshot == last:
+            return None
+        last = snapshot
+        return event_message('finished' if snapshot['finished'] else 'progress', {'progress': snapshot})
+
+    return poll
+
+
+@router.get('/{user_id}/stream', summary='', description='Server-sent events with the progress and the cities of the job',
+            response_class=StreamingResponse)
+async def stream_weather(
+        user_id: int,
+        session_manager: DatabaseSessionManager = Depends(db_sessionmanager)
+):
+    # Subscribe before reading the progress, so no event is lost between both
+    subscription = job_registry.subscribe(user_id)
+
+    poll = None
+    progress = job_registry.get(user_id)
+    if progress is not None and not progress.finished:
+        snapshot, finished = progress.snapshot(), False
+    else:
+        # One query for the first event, then the state is polled until the job finishes
+        snapshot = await shared_progress(session_manager, user_id)
+        if snapshot is None:
+            job_registry.unsubscribe(subscription)
+            raise HTTPException(status.HTTP_404_NOT_FOUND, detail='User did not request weather data')
+        finished = snapshot['finished']
+        poll = poll_progress(session_manager, user_id, snapshot)
+
+    first = format_sse('finished' if finished else 'progress', {'progress': snapshot})
+    if finished:
+        job_registry.unsubscribe(subscription)
+        return StreamingResponse(iter([first]), media_type='text/event-stream')
+
+    return StreamingResponse(
+        stream_events(job_registry, subscription, first, heartbeat=settings.stream_heartbeat_seconds,
+                      poll=poll, poll_interval=settings.stream_poll_interval),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@router.get('/{user_id}/results', summary='', description='Readings of the user, in pages ordered by request date')
+async def weather_results(
+        user_id: int,
+        limit: int = Query(settings.results_page_size, ge=1, le=settings.results_max_page_size),
+        cursor: str | None = None,
         session: AsyncSession = Depends(db_session)
+) -> ResponseResults:
+    # Keyset pagination, each page starts after the (request_date, id) of the last row of the previous one
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    # One extra row tells if there is a next page
+    rows = await WeatherManager(session=session).get_results_page(user_id, limit=limit + 1, after=after)
+
+    return ResponseResults(
+        results=[result_item(row) for row in rows[:limit]],
+        next_cursor=encode_cursor(rows[limit - 1]) if len(rows) > limit else None,
+    )
+
+
+@router.get('/{user_id}/export', summary='', description='All the readings of the user, streamed as NDJSON, columnar JSON or Arrow',
+            response_class=StreamingResponse)
+async def export_weather(
+        user_id: int,
+        export_format: Literal['ndjson', 'columnar', 'arrow'] = Query('ndjson', alias='format'),
+        session_manager: DatabaseSessionManager = Depends(db_sessionmanager)
 ):
-    # Get the percentage of processed cities
-    percentage = await WeatherService(session=session, user_id=request.user_id).get_percentage()
+    if export_format == 'arrow' and not arrow_available():
+        raise HTTPException(status.HTTP_501_NOT_IMPLEMENTED, detail='The arrow format requires the pyarrow package')
 
-    return ResponsePercentage(
-        percentage=percentage
+    return StreamingResponse(
+        export_results(session_manager, user_id, export_format, batch_size=settings.export_batch_size),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
     )
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from backend.settings import settings
+from services.metrics import cache_lookups
+from services.parsing import WeatherRecord, json_default
+
+
+class SQLiteCacheBackend:
+    """
+    Persistent backend for the ResponseCache, so the entries survive restarts
+    Keys and values must be JSON serializable, the writes are not synced to disk because it is only a cache
+    `decode` rebuilds each loaded value from its JSON form, so the restored entries have the same type as the fresh ones
+    """
+
+    def __init__(self, path: str, decode: Callable[[Any], Any] | None = None):
+        self.decode = decode
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+
+    def load(self, now: float) -> list[tuple[Any, Any, float]]:
+        self.connection.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+        rows = self.connection.execute('SELECT key, value, expires_at FROM cache ORDER BY expires_at')
+        decode = self.decode or (lambda value: value)
+        return [(self._key(json.loads(key)), decode(json.loads(value)), expires_at) for key, value, expires_at in rows]
+
+    def save(self, key: Hashable, value: Any, expires_at: float):
+        self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (json.dumps(key), json.dumps(value, default=json_default), expires_at))
+
+    def delete(self, key: Hashable):
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (json.dumps(key),))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM cache')
+
+    @staticmethod
+    def _key(key):
+        # JSON turns the tuple keys into lists
+        return tuple(key) if isinstance(key, list) else key
+
+
+class ResponseCache:
+    """
+    TTL cache with an LRU size bound and single-flight: concurrent misses for the same key wait for
+    the first one, so only one upstream call is made
+    The lookups of a cache with a name are also counted in the metrics (weather_cache_lookups_total)
+    """
+
+    def __init__(self, ttl: float, max_entries: int, backend: SQLiteCacheBackend | None = None, clock=time.time,
+                 name: str | None = None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+
+        if self.backend is not None:
+            for key, value, expires_at in self.backend.load(self.clock()):
+                self._store(key, value, expires_at)
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            self._delete(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def get_many(self, keys: list[Hashable]) -> dict[Hashable, Any]:
+        # Counts the found keys as hits and the others as misses, as the caller fetches them
+        found = {key: value for key in keys if (value := self.get(key)) is not None}
+        self._count('hits', len(found))
+        self._count('misses', len(keys) - len(found))
+        return found
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = self.clock() + self.ttl
+        self._store(key, value, expires_at)
+        if self.backend is not None:
+            self.backend.save(key, value, expires_at)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+
+        if key in self._in_flight:
+            self._count('coalesced')
+            return await asyncio.shield(self._in_flight[key])
+
+        self._count('misses')
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await fetch()
+        except BaseException as e:
+            # The waiters receive the same error, and the future is marked as retrieved
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._in_flight[key]
+
+    def delete(self, key: Hashable):
+        if key in self._entries:
+            self._delete(key)
+
+    def _count(self, result: str, amount: int = 1):
+        setattr(self, result, getattr(self, result) + amount)
+        if self.name is not None and amount:
+            cache_lookups.labels(self.name, result).inc(amount)
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self._entries)}
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.coalesced = 0
+        if self.backend is not None:
+            self.backend.clear()
+
+    def _store(self, key: Hashable, value: Any, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._delete(next(iter(self._entries)))
+
+    def _delete(self, key: Hashable):
+        del self._entries[key]
+        if self.backend is not None:
+            self.backend.delete(key)
+
+
+weather_cache = ResponseCache(
+    name='weather',
+    ttl=settings.cache_ttl,
+    max_entries=settings.cache_max_entries,
+    backend=SQLiteCacheBackend(settings.cache_path, decode=WeatherRecord.from_dict) if settings.cache_path else None,
+)
+
+# Answers of the progress endpoint, kept for a short time and shared by the concurrent polls of each user
+progress_cache = ResponseCache(ttl=settings.progress_cache_ttl, max_entries=settings.progress_cache_max_entries, name='progress')
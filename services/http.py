@@ -0,0 +1,72 @@
+import importlib.util
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+
+import httpx
+
+from backend.settings import Settings, settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HostMetrics:
+    requests: int = 0
+    connections: int = 0  # TCP connections opened
+    tls_handshakes: int = 0
+
+
+class HTTPClientManager:
+    """
+    Owns the httpx client shared by all the jobs, so connections (DNS, TCP and TLS) are reused between them
+    It is started and closed in the application lifespan
+    """
+
+    def __init__(self, config: Settings = settings):
+        self.config = config
+        self.metrics: dict[str, HostMetrics] = defaultdict(HostMetrics)
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient | None:
+        return self._client
+
+    async def start(self):
+        http2 = self.config.http2
+        if http2 and importlib.util.find_spec('h2') is None:
+            logger.warning('HTTP/2 is enabled but the h2 package is not installed, using HTTP/1.1')
+            http2 = False
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=self.config.http_max_connections,
+                max_keepalive_connections=self.config.http_max_keepalive_connections,
+                keepalive_expiry=self.config.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.config.http_timeout, connect=self.config.http_connect_timeout),
+            event_hooks={'request': [self._trace_request]},
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _trace_request(self, request: httpx.Request):
+        # Uses the httpcore trace extension to count the new connections of each host
+        host = self.metrics[request.url.host]
+        host.requests += 1
+
+        async def trace(event_name: str, info: dict):
+            if event_name == 'connection.connect_tcp.complete':
+                host.connections += 1
+            elif event_name == 'connection.start_tls.complete':
+                host.tls_handshakes += 1
+
+        request.extensions['trace'] = trace
+
+
+http_client_manager = HTTPClientManager()
+
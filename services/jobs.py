@@ -0,0 +1,160 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import time
+import uuid
+
+from backend.database import DatabaseSessionManager, init_schema, sessionmanager
+from backend.settings import settings
+from managers.jobs import JobManager
+from models.weather import WeatherJob
+from services.http import http_client_manager
+from services.metrics import job_duration_seconds, jobs_running, span
+from services.weather import WeatherService
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """
+    Processes the jobs of the weather_job table, claiming them with a lease
+    The lease is renewed while the job runs, so if the process dies another worker (in this or in other
+    process) claims the job after the lease expires and resumes it from the last persisted city
+
+    With the scheduler, priority_slots loops only claim high priority jobs, so they start while the
+    concurrency slots are busy with long jobs and take their share of the quota
+    """
+
+    def __init__(self, session_manager: DatabaseSessionManager = sessionmanager, concurrency: int | None = None,
+                 http_client=None, request_limiter=None, lease_seconds: float | None = None, poll_interval: float | None = None,
+                 priority_slots: int | None = None):
+        self.session_manager = session_manager
+        self.concurrency = concurrency or settings.job_concurrency
+        self.priority_slots = settings.job_priority_slots if priority_slots is None else priority_slots
+        self.http_client = http_client
+        self.request_limiter = request_limiter
+        self.lease_seconds = lease_seconds or settings.job_lease_seconds
+        self.poll_interval = poll_interval or settings.job_poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._wakeup = asyncio.Event()
+
+    def notify(self):
+        # Wakes the idle loops when a job is added by this process, the other processes find it when polling
+        self._wakeup.set()
+
+    async def run(self):
+        loops = [self._loop() for _ in range(self.concurrency)]
+        if settings.scheduler_enabled:
+            loops += [self._loop(priorities=('high',)) for _ in range(self.priority_slots)]
+        await asyncio.gather(*loops)
+
+    async def run_once(self, priorities: tuple[str, ...] | None = None) -> bool:
+        # Claims and processes one job (of the given priorities), returns False if there is no job to claim
+        async with self.session_manager.session() as session:
+            job = await JobManager(session).claim(self.worker_id, self.lease_seconds, priorities=priorities)
+        if job is None:
+            return False
+
+        await self._process(job)
+        return True
+
+    async def _loop(self, priorities: tuple[str, ...] | None = None):
+        while True:
+            try:
+                if await self.run_once(priorities):
+                    continue
+            except Exception:
+                logger.exception('Failed to claim a job')
+
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+
+    async def _process(self, job: WeatherJob):
+        # The duration of the job is measured by how it ended: done, retry, failed, lost (lease) or cancelled
+        started_at = time.perf_counter()
+        status = 'cancelled'
+        jobs_running.inc()
+        try:
+            with span('weather.job', job_id=job.id, user_id=job.user_id):
+                status = await self._execute(job)
+        finally:
+            jobs_running.dec()
+            job_duration_seconds.labels(status).observe(time.perf_counter() - started_at)
+
+    async def _execute(self, job: WeatherJob) -> str:
+        processing = asyncio.create_task(self._run_job(job))
+        renewing = asyncio.create_task(self._renew_lease(job, processing))
+        try:
+            await processing
+        except asyncio.CancelledError:
+            if renewing.done():
+                # The lease was lost, another worker owns the job now
+                logger.warning('Lost the lease of job %s', job.id)
+                return 'lost'
+            raise
+        except Exception:
+            logger.exception('Job %s failed (attempt %s)', job.id, job.attempts)
+            async with self.session_manager.session() as session:
+                if job.attempts < settings.job_max_attempts:
+                    await JobManager(session).retry(job.id, self.worker_id)
+                    return 'retry'
+                await JobManager(session).finish(job.id, self.worker_id, status='failed')
+                return 'failed'
+        finally:
+            renewing.cancel()
+
+        async with self.session_manager.session() as session:
+            await JobManager(session).finish(job.id, self.worker_id)
+        return 'done'
+
+    async def _run_job(self, job: WeatherJob):
+        async with self.session_manager.session() as session:
+            cities = job.cities
+            if job.max_age is not None:
+                # A refresh only fetches the stale cities, the ones in weather_job_city
+                fetch_cities = await JobManager(session).get_city_ids(job.id)
+                cities = [city_id for city_id in job.cities if city_id in fetch_cities]
+
+            service = WeatherService(
+                session=session,
+                user_id=job.user_id,
+                cities=cities,
+                http_client=self.http_client or http_client_manager.client,
+                request_limiter=self.request_limiter,
+                priority=job.priority,
+                job_id=job.id,
+                max_age=job.max_age,
+            )
+            # A job claimed more than once was interrupted, the saved cities are not fetched again
+            await service.get_openweather_data(resume=job.attempts > 1)
+
+    async def _renew_lease(self, job: WeatherJob, processing: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            async with self.session_manager.session() as session:
+                if not await JobManager(session).renew_lease(job.id, self.worker_id, self.lease_seconds):
+                    processing.cancel()
+                    return
+
+
+job_worker = JobWorker()
+
+
+async def main():
+    # Standalone worker process, run as many as needed: python -m services.jobs
+    logging.basicConfig(level=logging.INFO)
+    # The worker can start before the application, the schema lock keeps concurrent migrations safe
+    await init_schema()
+    await http_client_manager.start()
+    try:
+        await job_worker.run()
+    finally:
+        await http_client_manager.close()
+        await sessionmanager.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
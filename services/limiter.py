@@ -1,30 +1,302 @@
 import asyncio
+import sqlite3
 import time
 from collections import deque
+from typing import Awaitable, Callable, Mapping
+
+from backend.settings import settings
+from services.metrics import limiter_wait_seconds, limiter_waiters
+from services.retry import UpstreamError, parse_retry_after, rate_limit_headers
+
+
+async def call_with_limiter(acquire: Callable[[], Awaitable[None]], fn, *args, **kwargs):
+    """
+    Calls fn after taking a slot of the limiter with `acquire`
+    UpstreamError is kept as is (the retry policy decides if it is retried), the other errors are raised as RuntimeError
+    """
+    try:
+        await acquire()
+        return await fn(*args, **kwargs)
+    except UpstreamError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Some error occur during execution: {str(e)}")
+
+
+# Rate limit algorithms
+# Each algorithm exposes reserve(now): when a slot is free it is taken and 0 is returned,
+# otherwise nothing is taken and the number of seconds until the next slot frees is returned
+
+class SlidingWindow:
+    # Allows at most `limit` requests in any rolling window of `period` seconds
+    def __init__(self, limit: int, period: float, log: deque | None = None):
+        self.limit = limit
+        self.period = period
+        self.log = log if log is not None else deque(maxlen=limit)
+
+    def reserve(self, now: float) -> float:
+        if len(self.log) >= self.limit:
+            # The limit may have been lowered (adaptive limiter), so the slot frees when the limit-th last request expires
+            wait = self.log[-self.limit] + self.period - now
+            if wait > 0:
+                return wait
+            while len(self.log) >= self.limit:
+                self.log.popleft()
+
+        self.log.append(now)
+        return 0.0
+
+
+class TokenBucket:
+    # Refills `rate` tokens per second up to `capacity`, each request consumes one token
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = None
+
+    def reserve(self, now: float) -> float:
+        if self.updated_at is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class GCRA:
+    # Generic cell rate algorithm, `limit` requests per `period` with a burst of `burst` requests
+    # Only the theoretical arrival time (tat) is stored, so the state is a single float
+    def __init__(self, limit: int, period: float, burst: int | None = None):
+        self.interval = period / limit
+        self.tolerance = self.interval * ((burst or limit) - 1)
+        self.tat = 0.0
+
+    def reserve(self, now: float) -> float:
+        tat = max(self.tat, now)
+        wait = tat - self.tolerance - now
+        if wait > 0:
+            return wait
+
+        self.tat = tat + self.interval
+        return 0.0
+
+
+class SQLiteSlidingWindow:
+    """
+    Sliding window shared by all the processes of the host, stored in a SQLite file
+    Each slot is claimed in an IMMEDIATE transaction, so the check and the claim are atomic between processes
+    The claims never wait for the lock, as they run in the event loop: when another process holds it,
+    nothing is claimed and the wait returned is `lock_retry` seconds, so the limiter tries again
+    The clock is the wall clock (time.time), the same for all the processes
+    """
+
+    def __init__(self, limit: int, period: float, path: str, name: str = 'openweather', lock_retry: float | None = None):
+        self.limit = limit
+        self.period = period
+        self.name = name
+        self.lock_retry = lock_retry if lock_retry is not None else settings.rate_limiter_lock_retry_ms / 1000
+        self.last_claimed_at: float | None = None  # Time of the last slot claimed by this process
+        self.lock_retries = 0
+        # The table is created once, waiting for the other processes, the claims do not wait (busy_timeout=0)
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        # WAL with synchronous=NORMAL does not sync each claim to disk, losing the last claims on a power loss is fine
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS limiter_slot (name TEXT NOT NULL, claimed_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS ix_limiter_slot_name_claimed_at ON limiter_slot (name, claimed_at)')
+        self.connection.execute('PRAGMA busy_timeout=0')
+
+    def reserve(self, now: float) -> float:
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if e.sqlite_errorname != 'SQLITE_BUSY':
+                raise
+            self.lock_retries += 1
+            return self.lock_retry
+
+        try:
+            # The time is read again with the lock, the given time may be old if other process held it
+            now = time.time()
+            self.connection.execute('DELETE FROM limiter_slot WHERE name = ? AND claimed_at <= ?', (self.name, now - self.period))
+            used = self.connection.execute('SELECT count(*) FROM limiter_slot WHERE name = ?', (self.name,)).fetchone()[0]
+
+            if used < self.limit:
+                self.connection.execute('INSERT INTO limiter_slot (name, claimed_at) VALUES (?, ?)', (self.name, now))
+                self.last_claimed_at = now
+                wait = 0.0
+            else:
+                # The slot frees when the limit-th last claim expires (the limit may have been lowered)
+                freed_at = self.connection.execute(
+                    'SELECT claimed_at FROM limiter_slot WHERE name = ? ORDER BY claimed_at DESC LIMIT 1 OFFSET ?',
+                    (self.name, self.limit - 1),
+                ).fetchone()[0]
+                wait = freed_at + self.period - now
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+        return wait
+
+
+class AsyncRateLimiter:
+    """
+    Event driven rate limiter
+    Waiters are queued in FIFO order and a single scheduler task sleeps exactly until the
+    algorithm frees the next slot, so there is no polling and only one sleeping coroutine per limiter
+
+    When adaptive, the limit of the algorithm (sliding windows) follows the answers of the upstream, see on_response
+    """
+
+    def __init__(self, algorithm, clock=time.monotonic, adaptive: bool = False, min_limit: int = 1):
+        self.algorithm = algorithm
+        self.clock = clock
+        self.adaptive = adaptive and hasattr(algorithm, 'limit')
+        self.max_limit = getattr(algorithm, 'limit', None)  # The configured limit, never exceeded
+        self.min_limit = min_limit
+        self.paused_until = 0.0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.wakeups = 0
+        self._successes = 0
+        self._scheduler: asyncio.Task | None = None
+
+    async def acquire(self):
+        # Fast path, no one is waiting and there is a free slot
+        now = self.clock()
+        if not self.waiters and now >= self.paused_until and self.algorithm.reserve(now) == 0:
+            limiter_wait_seconds.observe(0)
+            return
+
+        started_at = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._schedule())
+
+        limiter_waiters.inc()
+        try:
+            await waiter
+        finally:
+            limiter_waiters.dec()
+            limiter_wait_seconds.observe(time.perf_counter() - started_at)
+
+    async def _schedule(self):
+        # Hands the free slots to the waiters in the order they arrived
+        while self.waiters:
+            if self.waiters[0].done():
+                # The waiter gave up (cancelled) before receiving its slot
+                self.waiters.popleft()
+                continue
+
+            now = self.clock()
+            wait = self.paused_until - now
+            if wait <= 0:
+                wait = self.algorithm.reserve(now)
+            if wait > 0:
+                self.wakeups += 1
+                await asyncio.sleep(wait)
+                continue
+
+            self.waiters.popleft().set_result(None)
+
+    def pause(self, seconds: float):
+        # No slot is given before `seconds` from now
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def on_response(self, status_code: int, headers: Mapping[str, str]):
+        """
+        Adapts the limiter to an upstream answer:
+        - 429: pauses for the Retry-After and halves the limit
+        - rate limit headers: the limit follows the quota of the upstream, and it pauses until the reset when nothing remains
+        - other answers: after a full window of them the limit grows by one, up to the configured limit
+        """
+        limit, remaining, reset = rate_limit_headers(headers)
+        if remaining == 0 and reset:
+            self.pause(reset)
+
+        if status_code == 429:
+            retry_after = parse_retry_after(headers.get('retry-after'))
+            if retry_after:
+                self.pause(retry_after)
+
+        if not self.adaptive:
+            return
+
+        if limit is not None:
+            self._set_limit(limit)
+        if status_code == 429:
+            self._successes = 0
+            self._set_limit(self.algorithm.limit // 2)
+        else:
+            self._successes += 1
+            if self._successes >= self.algorithm.limit:
+                self._successes = 0
+                self._set_limit(self.algorithm.limit + 1)
+
+    def _set_limit(self, limit: int):
+        self.algorithm.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    async def call_external_api(self, fn, *args, **kwargs):
+        return await call_with_limiter(self.acquire, fn, *args, **kwargs)
 
 
 class RequestLimiter:
     MAX_REQUESTS_PER_PERIOD = 60
     PERIOD = 60
     REQUEST_QUEUE = deque(maxlen=MAX_REQUESTS_PER_PERIOD)
+    LIMITER: AsyncRateLimiter | None = None
+
+    @staticmethod
+    def get_limiter() -> AsyncRateLimiter:
+        # The class attributes may be overridden (e.g. in tests), so the limiter is rebuilt when they change
+        limiter = RequestLimiter.LIMITER
+        if (limiter is None or limiter.algorithm.log is not RequestLimiter.REQUEST_QUEUE
+                or limiter.max_limit != RequestLimiter.MAX_REQUESTS_PER_PERIOD or limiter.algorithm.period != RequestLimiter.PERIOD):
+            window = SlidingWindow(RequestLimiter.MAX_REQUESTS_PER_PERIOD, RequestLimiter.PERIOD, log=RequestLimiter.REQUEST_QUEUE)
+            RequestLimiter.LIMITER = AsyncRateLimiter(window, clock=time.time, adaptive=settings.rate_limiter_adaptive,
+                                                      min_limit=settings.rate_limiter_min_limit)
+
+        return RequestLimiter.LIMITER
+
+    @staticmethod
+    async def acquire():
+        await RequestLimiter.get_limiter().acquire()
 
     @staticmethod
     async def check_availability():
         # This method controls the access to the resource based in the params
-        # Checks every 0.5s if the maximum number of requests is already used, if it is suspended and checks again until the period passes
-        while len(RequestLimiter.REQUEST_QUEUE) == RequestLimiter.MAX_REQUESTS_PER_PERIOD and time.time() - RequestLimiter.REQUEST_QUEUE[0] < RequestLimiter.PERIOD:
-            await asyncio.sleep(0.5)
+        # Waits (without polling) until the sliding window has a free slot and takes it
+        await RequestLimiter.acquire()
 
-        print(len(RequestLimiter.REQUEST_QUEUE))
-        # When the period passes (or not yet full) add a new request to the queue
-        RequestLimiter.REQUEST_QUEUE.append(time.time())
+    @staticmethod
+    def on_response(status_code: int, headers: Mapping[str, str]):
+        RequestLimiter.get_limiter().on_response(status_code, headers)
 
     @staticmethod
     async def call_external_api(fn, *args, **kwargs):
-        try:
-            # Before execute the function check if the process have a free slot
-            # Uses await so maintains the loop free to other actions
-            await RequestLimiter.check_availability()
-            return await fn(*args, **kwargs)
-        except Exception as e:
-            raise RuntimeError(f"Some error occur during execution: {str(e)}")
+        # Before execute the function check if the process have a free slot
+        # Uses await so maintains the loop free to other actions
+        return await call_with_limiter(RequestLimiter.check_availability, fn, *args, **kwargs)
+
+
+_request_limiter = None
+
+
+def get_request_limiter():
+    """
+    Returns the limiter of this process selected in the settings
+    'memory' limits only this process, 'sqlite' shares the quota with all the processes of the host
+    """
+    global _request_limiter
+    if settings.rate_limiter_backend == 'memory':
+        return RequestLimiter
+
+    if _request_limiter is None:
+        window = SQLiteSlidingWindow(RequestLimiter.MAX_REQUESTS_PER_PERIOD, RequestLimiter.PERIOD, settings.rate_limiter_path)
+        _request_limiter = AsyncRateLimiter(window, clock=time.time, adaptive=settings.rate_limiter_adaptive,
+                                            min_limit=settings.rate_limiter_min_limit)
+    return _request_limiter
@@ -0,0 +1,262 @@
+import bisect
+import contextlib
+import importlib.util
+import logging
+import math
+import time
+from typing import Iterator
+
+from backend.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Default buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Buckets of the job duration, from seconds to hours (a job of 167 cities takes ~3 minutes with the free plan)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+
+# Metrics in the Prometheus text format, without dependencies
+# The values are only changed by the event loop of the process, so there are no locks
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self._children: dict[tuple[str, ...], object] = {}
+        self._lookup: dict[tuple, object] = {}  # Children by the values as given, to skip the str conversion
+
+    def labels(self, *values):
+        # The child of the label values, created on first use
+        child = self._lookup.get(values)
+        if child is None:
+            key = tuple(str(value) for value in values)
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            self._lookup[values] = child
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        # Metric without labels
+        return self.labels()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, child in self._children.items():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> list[str]:
+        return [f'{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}']
+
+    def clear(self):
+        self._children.clear()
+        self._lookup.clear()
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child) -> list[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, values, f'le="{_format_value(float(bound))}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.label_names, values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} already registered')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = MetricsRegistry()
+
+limiter_wait_seconds = registry.histogram('weather_limiter_wait_seconds', 'Time waiting for a slot of the rate limiter')
+limiter_waiters = registry.gauge('weather_limiter_waiters', 'Requests waiting for a slot of the rate limiter')
+upstream_request_seconds = registry.histogram(
+    'weather_upstream_request_seconds', 'Latency of the OpenWeather requests', labels=('endpoint', 'status'))
+upstream_in_flight = registry.gauge('weather_upstream_in_flight', 'OpenWeather requests in flight')
+upstream_retries = registry.counter('weather_upstream_retries_total', 'OpenWeather requests retried after an error')
+db_commit_seconds = registry.histogram(
+    'weather_db_commit_seconds', 'Latency of the weather data writes, statement and commit', labels=('operation',))
+persist_queue_depth = registry.gauge('weather_persist_queue_depth', 'Fetched cities waiting to be saved')
+cities_processed = registry.counter('weather_cities_total', 'Cities processed by the jobs', labels=('result',))
+job_duration_seconds = registry.histogram(
+    'weather_job_duration_seconds', 'Duration of the jobs processed by this process', labels=('status',), buckets=JOB_BUCKETS)
+jobs_running = registry.gauge('weather_jobs_running', 'Jobs running in this process')
+jobs_in_queue = registry.gauge('weather_jobs', 'Jobs in the weather_job table, by status', labels=('status',))
+cache_lookups = registry.counter(
+    'weather_cache_lookups_total', 'Lookups of the response caches, by result (hits, misses or coalesced)', labels=('cache', 'result'))
+cache_entries = registry.gauge('weather_cache_entries', 'Entries of the response caches', labels=('cache',))
+
+
+# Tracing spans of the stages of a job (job, fetch, request, persist)
+# 'log' logs the duration of each span and 'otel' uses the OpenTelemetry API (configured by the application)
+
+_tracer = None
+
+
+def _get_tracer():
+    global _tracer
+    if _tracer is None and settings.tracing == 'otel':
+        if importlib.util.find_spec('opentelemetry') is None:
+            logger.warning('Tracing with otel requires the opentelemetry-api package, the spans are disabled')
+            settings.tracing = 'off'
+            return None
+
+        from opentelemetry import trace
+        _tracer = trace.get_tracer('weather_request')
+    return _tracer
+
+
+_no_span = contextlib.nullcontext()
+
+
+def span(name: str, **attributes):
+    # Without tracing a shared no-op context manager is returned, so the spans cost almost nothing
+    if settings.tracing == 'off':
+        return _no_span
+    return _span(name, attributes)
+
+
+@contextlib.contextmanager
+def _span(name: str, attributes: dict) -> Iterator[None]:
+    tracer = _get_tracer()
+    if tracer is not None:
+        with tracer.start_as_current_span(name, attributes=attributes):
+            yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info('span %s %.3fms %s', name, (time.perf_counter() - started_at) * 1000, attributes)
@@ -0,0 +1,109 @@
+import importlib.util
+import json
+import re
+import time
+from typing import Any
+
+# orjson decodes 3x faster than the json module, it is used when installed (pip install orjson)
+# Without it, the fields of the current weather are read from the raw bytes (_scan_weather), which is faster than json.loads
+if importlib.util.find_spec('orjson') is not None:
+    import orjson
+    loads = orjson.loads
+    SCAN_WEATHER = False
+else:
+    loads = json.loads
+    SCAN_WEATHER = True
+
+
+class WeatherRecord:
+    """
+    Weather of a city, from the OpenWeather response to the database row
+    Uses __slots__, so it is smaller and faster to build than a dict, but it can still be read as one (record['city_id'])
+    """
+    __slots__ = ('city_id', 'temperature_c', 'humidity', 'fetched_at')
+
+    def __init__(self, city_id: int, temperature_c: float, humidity: int, fetched_at: float | None = None):
+        self.city_id = city_id
+        self.temperature_c = temperature_c
+        self.humidity = humidity
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> 'WeatherRecord':
+        # The data of a city as a dict (e.g. restored from the persistent cache)
+        return cls(int(data['city_id']), float(data['temperature_c']), int(data['humidity']), data.get('fetched_at'))
+
+    def as_dict(self) -> dict[str, Any]:
+        return {'city_id': self.city_id, 'temperature_c': self.temperature_c, 'humidity': self.humidity, 'fetched_at': self.fetched_at}
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, WeatherRecord):
+            return NotImplemented
+        return (self.city_id, self.temperature_c, self.humidity) == (other.city_id, other.temperature_c, other.humidity)
+
+    def __repr__(self):
+        return f'WeatherRecord(city_id={self.city_id}, temperature_c={self.temperature_c}, humidity={self.humidity})'
+
+
+def json_default(value):
+    # json.dumps default for the records
+    if isinstance(value, WeatherRecord):
+        return value.as_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# Fast path of the current weather response: only the "main" object and the top level "id" are read from the raw bytes
+# The payload is not validated, when a field is not found (or is ambiguous) the full JSON is decoded instead
+_MAIN = re.compile(rb'"main"\s*:\s*\{([^{}]*)\}')
+_TEMP = re.compile(rb'"temp"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)')
+_HUMIDITY = re.compile(rb'"humidity"\s*:\s*(\d+)')
+_ID = re.compile(rb'"id"\s*:\s*"?(\d+)"?')
+
+
+def _depth(content: bytes, start: int, end: int) -> int:
+    # Change of the object depth between two positions, the braces inside strings are not expected in the payload
+    return content.count(b'{', start, end) - content.count(b'}', start, end)
+
+
+def _scan_weather(content: bytes) -> WeatherRecord | None:
+    main = _MAIN.search(content)
+    if main is None or _depth(content, 0, main.start()) != 1:
+        return None
+    temp, humidity = _TEMP.search(main.group(1)), _HUMIDITY.search(main.group(1))
+    if temp is None or humidity is None:
+        return None
+
+    # The id of the city is the only one at the top level (1), the others are in nested objects (weather, sys)
+    city_id, depth, position = None, 0, 0
+    for match in _ID.finditer(content):
+        depth += _depth(content, position, match.start())
+        position = match.start()
+        if depth == 1:
+            if city_id is not None:
+                return None
+            city_id = match.group(1)
+    if city_id is None:
+        return None
+
+    return WeatherRecord(int(city_id), float(temp.group(1)), int(humidity.group(1)), time.time())
+
+
+def weather_record(city: dict[str, Any], fetched_at: float) -> WeatherRecord:
+    # Keeps the id of the city, the temperature (in the requested units) and the humidity of a decoded response
+    return WeatherRecord(int(city['id']), float(city['main']['temp']), int(city['main']['humidity']), fetched_at)
+
+
+def parse_weather(content: bytes) -> WeatherRecord:
+    # Current weather response of one city
+    if SCAN_WEATHER and (record := _scan_weather(content)) is not None:
+        return record
+    return weather_record(loads(content), time.time())
+
+
+def parse_weather_group(content: bytes) -> dict[int, WeatherRecord]:
+    # Group response, indexed by city id
+    fetched_at = time.time()
+    return {record.city_id: record for record in (weather_record(city, fetched_at) for city in loads(content)['list'])}
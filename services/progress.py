@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from backend.settings import settings
+from services.parsing import json_default
+
+
+def completion_percentage(processed: int, total: int) -> float:
+    # The processed cities are the done and the failed ones, so a finished job is always at 100%
+    # Used by the in-memory progress and by the progress read from the database
+    if not total:
+        return 100.0
+    return (processed / total) * 100
+
+
+@dataclass
+class JobProgress:
+    # Progress of the weather job of one user, updated by the fetch pipeline as each city completes
+    user_id: int
+    total: int
+    done: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+    @property
+    def processed(self) -> int:
+        return self.done + self.failed
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def percentage(self) -> float:
+        return completion_percentage(self.processed, self.total)
+
+    @property
+    def eta(self) -> float | None:
+        # Estimated seconds to finish, based on the average time per processed city
+        if self.finished:
+            return 0.0
+        if not self.processed:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed / self.processed * (self.total - self.processed)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'percentage': self.percentage,
+            'eta': self.eta,
+            'finished': self.finished,
+        }
+
+    def city_done(self):
+        self.done += 1
+
+    def city_failed(self):
+        self.failed += 1
+
+    def finish(self):
+        self.finished_at = time.time()
+
+
+def format_sse(event: str, data: dict[str, Any]) -> bytes:
+    # Server-sent event message
+    return f'event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n'.encode()
+
+
+def event_message(event: str, data: dict[str, Any]) -> dict[str, Any]:
+    # Event of a subscription, with its server-sent event message encoded once
+    return {'event': event, 'data': data, 'sse': format_sse(event, data)}
+
+
+class Subscription:
+    """
+    Events of one user's job for one watcher
+    The queue is bounded, when the watcher is slower than the job the oldest events are dropped
+    (the progress in each event is a full snapshot, so the last event is always right)
+    """
+
+    def __init__(self, user_id: int, max_events: int):
+        self.user_id = user_id
+        self.dropped = 0
+        self._events: deque[dict[str, Any]] = deque(maxlen=max_events)
+        self._ready = asyncio.Event()
+
+    def push(self, event: dict[str, Any]):
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+        self._events.append(event)
+        self._ready.set()
+
+    def get_nowait(self) -> dict[str, Any] | None:
+        return self._events.popleft() if self._events else None
+
+    async def get(self) -> dict[str, Any]:
+        while not self._events:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._events.popleft()
+
+
+class JobRegistry:
+    """
+    In memory registry of the jobs started by this process, read before the database by the progress endpoint while they run
+    Running jobs are always kept, the finished ones are evicted (oldest first) after max_finished jobs
+    It also fans out the job events to the subscribed watchers, with no database query per watcher
+    """
+
+    def __init__(self, max_finished: int = 10_000):
+        self.max_finished = max_finished
+        self._jobs: OrderedDict[int, JobProgress] = OrderedDict()
+        self._subscribers: defaultdict[int, set[Subscription]] = defaultdict(set)
+
+    def start(self, user_id: int, total: int) -> JobProgress:
+        progress = JobProgress(user_id=user_id, total=total)
+        self._jobs.pop(user_id, None)
+        self._jobs[user_id] = progress
+        return progress
+
+    def get(self, user_id: int) -> JobProgress | None:
+        return self._jobs.get(user_id)
+
+    def finish(self, progress: JobProgress):
+        progress.finish()
+        # Keep the finished jobs ordered by finish time, so the oldest are evicted first
+        if self._jobs.get(progress.user_id) is progress:
+            self._jobs.move_to_end(progress.user_id)
+        self._evict()
+        self.publish(progress.user_id, 'finished', {'progress': progress.snapshot()})
+
+    def forget(self, user_id: int):
+        # Drops a finished job, e.g. when the user requests it again, so the progress is read from the database
+        progress = self._jobs.get(user_id)
+        if progress is not None and progress.finished:
+            del self._jobs[user_id]
+
+    def subscribe(self, user_id: int, max_events: int | None = None) -> Subscription:
+        subscription = Subscription(user_id, max_events or settings.stream_max_queued_events)
+        self._subscribers[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id: int, event: str, data: dict[str, Any]):
+        subscribers = self._subscribers.get(user_id)
+        if not subscribers:
+            return
+
+        # Encoded once and shared by all the watchers
+        message = event_message(event, data)
+        for subscription in subscribers:
+            subscription.push(message)
+
+    def clear(self):
+        self._jobs.clear()
+        self._subscribers.clear()
+
+    def _evict(self):
+        finished = [user_id for user_id, job in self._jobs.items() if job.finished]
+        for user_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[user_id]
+
+
+job_registry = JobRegistry()
+
+
+async def stream_events(registry: JobRegistry, subscription: Subscription, first: bytes, heartbeat: float,
+                        poll: Callable[[], Awaitable[dict[str, Any] | None]] | None = None,
+                        poll_interval: float | None = None) -> AsyncIterator[bytes]:
+    """
+    Server-sent events of a subscription, until the job finishes or the watcher disconnects
+    A comment is sent when there is no event for `heartbeat` seconds, so proxies keep the connection open
+
+    The registry only has the events of the jobs run by this process, for the others (pending or claimed by another process)
+    `poll` is called every `poll_interval` seconds and returns an event when the state in the database changed
+    """
+    try:
+        yield first
+        idle_since = time.monotonic()
+        while True:
+            # The queued events are sent without arming the heartbeat timer
+            event = subscription.get_nowait()
+            if event is None:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), timeout=heartbeat if poll is None else poll_interval)
+                except asyncio.TimeoutError:
+                    if poll is not None:
+                        event = await poll()
+                    if event is None:
+                        if poll is None or time.monotonic() - idle_since >= heartbeat:
+                            yield b': heartbeat\n\n'
+                            idle_since = time.monotonic()
+                        continue
+
+            yield event['sse']
+            idle_since = time.monotonic()
+            if event['event'] == 'finished':
+                return
+    finally:
+        registry.unsubscribe(subscription)
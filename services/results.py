@@ -0,0 +1,109 @@
+import base64
+import datetime
+import importlib.util
+import io
+import json
+from typing import Any, AsyncIterable, AsyncIterator
+
+from sqlalchemy import Row
+
+from backend.database import DatabaseSessionManager
+from managers.weather import WeatherManager
+
+# Formats of the bulk export and their media types
+EXPORT_MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',  # one reading per line
+    'columnar': 'application/x-ndjson',  # one batch per line, each column as a list
+    'arrow': 'application/vnd.apache.arrow.stream',  # Arrow IPC stream, requires pyarrow
+}
+
+# Column names of the export, in the order of the columns selected by managers.weather.results_query
+EXPORT_COLUMNS = ('id', 'request_date', 'city_id', 'temperature_c', 'humidity', 'fetched_at')
+
+
+def encode_cursor(row: Row) -> str:
+    # Opaque cursor of the next page, the (request_date, id) key of the last row of the page
+    key = f'{row.request_date.isoformat()}|{row.id}'
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    try:
+        request_date, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(request_date), int(row_id)
+    except ValueError:
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+def result_item(row: Row) -> dict[str, Any]:
+    # Reading of a city as returned by the API, with the same keys as the fetched data
+    return {
+        'id': row.id,
+        'city_id': row.city_id,
+        'temperature_c': row.temperature,
+        'humidity': row.humidity,
+        'request_date': row.request_date,
+        'fetched_at': row.fetched_at,
+    }
+
+
+def arrow_available() -> bool:
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+async def ndjson_export(batches: AsyncIterable[list[Row]]) -> AsyncIterator[bytes]:
+    async for rows in batches:
+        yield ''.join(json.dumps(result_item(row), default=datetime.datetime.isoformat) + '\n' for row in rows).encode()
+
+
+async def columnar_export(batches: AsyncIterable[list[Row]]) -> AsyncIterator[bytes]:
+    async for rows in batches:
+        columns = dict(zip(EXPORT_COLUMNS, zip(*rows)))
+        yield (json.dumps(columns, default=datetime.datetime.isoformat) + '\n').encode()
+
+
+async def arrow_export(batches: AsyncIterable[list[Row]]) -> AsyncIterator[bytes]:
+    # Imported here because pyarrow is optional
+    import pyarrow as pa
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('request_date', pa.timestamp('us')),
+        ('city_id', pa.int64()),
+        ('temperature_c', pa.float64()),
+        ('humidity', pa.int16()),
+        ('fetched_at', pa.timestamp('us')),
+    ])
+    # The writer sends each message to the buffer, which is emptied after each batch
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        async for rows in batches:
+            columns = [pa.array(values, type=column.type) for values, column in zip(zip(*rows), schema)]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            yield _drain(sink)
+    yield _drain(sink)  # End of the stream
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    chunk = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return chunk
+
+
+EXPORTERS = {
+    'ndjson': ndjson_export,
+    'columnar': columnar_export,
+    'arrow': arrow_export,
+}
+
+
+async def export_results(session_manager: DatabaseSessionManager, user_id: int, export_format: str, batch_size: int) -> AsyncIterator[bytes]:
+    """
+    Streams all the readings of the user in the given format, reading batch_size rows at a time from a database cursor
+    Only one batch is in memory at a time, whatever the number of rows of the user
+    """
+    async with session_manager.session() as session:
+        batches = WeatherManager(session).stream_results(user_id, batch_size)
+        async for chunk in EXPORTERS[export_format](batches):
+            yield chunk
@@ -0,0 +1,177 @@
+import asyncio
+import email.utils
+import random
+import time
+from typing import Mapping
+
+import httpx
+
+from backend.settings import settings
+from services.metrics import upstream_retries
+
+# Status codes worth retrying, the upstream may answer them later
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class UpstreamError(RuntimeError):
+    # Failed request to an upstream API, with what the retry policy needs to decide if and when to retry
+    def __init__(self, message: str, status_code: int | None = None, retry_after: float | None = None, retryable: bool = True):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+class CircuitOpenError(UpstreamError):
+    # The circuit of the upstream is open, the request was not sent
+    pass
+
+
+def parse_retry_after(value: str | None, now: float | None = None) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at - (now if now is not None else time.time()))
+
+
+def check_response(response: httpx.Response):
+    # Raises an UpstreamError for the error responses, instead of failing later when reading the body
+    if response.status_code < 400:
+        return
+
+    raise UpstreamError(
+        f'Upstream answered with status {response.status_code}',
+        status_code=response.status_code,
+        retry_after=parse_retry_after(response.headers.get('retry-after')),
+        retryable=response.status_code in RETRYABLE_STATUS,
+    )
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream after `failure_threshold` consecutive failures (the circuit opens) for `reset_timeout` seconds
+    Then a single call probes the upstream (half open): a success closes the circuit and a failure opens it again
+    Only server and network errors are failures, any other answer (including a 429) shows the upstream is up
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = 'closed'  # closed, open or half_open
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        if self.state == 'closed':
+            return
+
+        remaining = self.opened_at + self.reset_timeout - self.clock()
+        if remaining > 0:
+            raise CircuitOpenError('The circuit of the upstream is open', retry_after=remaining)
+
+        # This call is the probe, the others wait another reset_timeout (also if the probe never finishes)
+        self.state = 'half_open'
+        self.opened_at = self.clock()
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = self.clock()
+
+    def record(self, error: UpstreamError):
+        if error.retryable and error.status_code != 429:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    # One circuit breaker per upstream host, shared by all the jobs of the process
+    host = httpx.URL(url).host
+    if host not in circuit_breakers:
+        circuit_breakers[host] = CircuitBreaker(settings.circuit_failure_threshold, settings.circuit_reset_timeout)
+    return circuit_breakers[host]
+
+
+class RetryPolicy:
+    """
+    Retries the calls that fail with a retryable UpstreamError, up to max_attempts calls
+    The delay grows exponentially with full jitter (so the retries of many cities do not arrive together)
+    and it is never shorter than the Retry-After asked by the upstream
+    """
+
+    def __init__(self, max_attempts: int | None = None, base_delay: float | None = None, max_delay: float | None = None,
+                 breaker: CircuitBreaker | None = None, sleep=asyncio.sleep):
+        self.max_attempts = max_attempts or settings.retry_max_attempts
+        self.base_delay = base_delay if base_delay is not None else settings.retry_base_delay
+        self.max_delay = max_delay if max_delay is not None else settings.retry_max_delay
+        self.breaker = breaker
+        self.sleep = sleep
+        self.retries = 0
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0.0)
+
+    async def call(self, fn, *args, **kwargs):
+        attempt = 1
+        while True:
+            try:
+                if self.breaker is not None:
+                    self.breaker.before_call()
+                result = await fn(*args, **kwargs)
+            except UpstreamError as e:
+                if self.breaker is not None and not isinstance(e, CircuitOpenError):
+                    self.breaker.record(e)
+                if not e.retryable or attempt >= self.max_attempts:
+                    raise
+
+                self.retries += 1
+                upstream_retries.inc()
+                await self.sleep(self.backoff(attempt, e.retry_after))
+                attempt += 1
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+
+def rate_limit_headers(headers: Mapping[str, str]) -> tuple[int | None, int | None, float | None]:
+    """
+    Reads the limit, the remaining requests and the seconds until the reset from the rate limit headers
+    Both the X-RateLimit-* and the RateLimit-* (IETF draft) names are accepted, the reset may be an epoch time
+    """
+    def header(name: str) -> float | None:
+        value = headers.get(f'x-ratelimit-{name}') or headers.get(f'ratelimit-{name}')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    limit, remaining, reset = header('limit'), header('remaining'), header('reset')
+    if reset is not None and reset > 1_000_000_000:
+        reset = max(0.0, reset - time.time())
+
+    return (
+        int(limit) if limit is not None else None,
+        int(remaining) if remaining is not None else None,
+        reset,
+    )
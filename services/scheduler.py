@@ -0,0 +1,115 @@
+import asyncio
+from collections import deque
+from typing import Hashable, Mapping
+
+from backend.settings import settings
+from services.limiter import call_with_limiter
+
+
+class _Flow:
+    __slots__ = ('key', 'weight', 'deficit', 'waiters')
+
+    def __init__(self, key: Hashable, weight: int):
+        self.key = key
+        self.weight = weight
+        self.deficit = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+
+class FairScheduler:
+    """
+    Shares the slots of a rate limiter between the jobs of this process with deficit round-robin
+    Each job is a flow with its own queue, in each round a flow receives `weight` slots (its priority class),
+    so a small job is never queued behind all the requests of a big one
+
+    A single dispatcher task takes the slots from the limiter, one at a time, and hands each one to the next flow
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.flows: dict[Hashable, _Flow] = {}
+        self.active: deque[_Flow] = deque()  # Flows with waiters, in the order of the round
+        self._dispatcher: asyncio.Task | None = None
+
+    def flow(self, key: Hashable, priority: str = 'normal') -> 'SchedulerFlow':
+        return SchedulerFlow(self, key, priority_weight(priority))
+
+    async def acquire(self, key: Hashable, weight: int = 1):
+        flow = self.flows.get(key)
+        if flow is None:
+            # New (or idle) flows join at the end of the round
+            flow = self.flows[key] = _Flow(key, weight)
+            self.active.append(flow)
+        flow.weight = max(flow.weight, weight)
+
+        waiter = asyncio.get_running_loop().create_future()
+        flow.waiters.append(waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        await waiter
+
+    async def _dispatch(self):
+        while self.active:
+            await self.limiter.acquire()
+            waiter = self._next()
+            if waiter is not None:
+                waiter.set_result(None)
+            # Otherwise all the waiters gave up (cancelled) while the slot was taken, it is not used
+
+    def _next(self) -> asyncio.Future | None:
+        # Deficit round-robin with a cost of one slot per request
+        while self.active:
+            flow = self.active[0]
+            while flow.waiters and flow.waiters[0].done():
+                flow.waiters.popleft()
+            if not flow.waiters:
+                # Idle flows leave the round and lose their deficit
+                self.active.popleft()
+                del self.flows[flow.key]
+                continue
+
+            if flow.deficit < 1:
+                flow.deficit += flow.weight
+            flow.deficit -= 1
+            waiter = flow.waiters.popleft()
+            if not flow.waiters:
+                # Removed now, so the dispatcher does not take a slot for no one
+                self.active.popleft()
+                del self.flows[flow.key]
+            elif flow.deficit < 1:
+                self.active.rotate(-1)
+            return waiter
+
+        return None
+
+
+class SchedulerFlow:
+    # Requests of one job, used by WeatherService as its request limiter
+    def __init__(self, scheduler: FairScheduler, key: Hashable, weight: int):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+
+    async def acquire(self):
+        await self.scheduler.acquire(self.key, self.weight)
+
+    def on_response(self, status_code: int, headers: Mapping[str, str]):
+        self.scheduler.limiter.on_response(status_code, headers)
+
+    async def call_external_api(self, fn, *args, **kwargs):
+        return await call_with_limiter(self.acquire, fn, *args, **kwargs)
+
+
+def priority_weight(priority: str) -> int:
+    # Unknown classes are scheduled as normal
+    weights = settings.scheduler_weights
+    return max(1, weights.get(priority, weights.get('normal', 1)))
+
+
+def get_scheduler(limiter) -> FairScheduler:
+    # One scheduler per rate limiter, shared by all the jobs that use it (kept in the limiter, so both are released together)
+    scheduler = getattr(limiter, 'fair_scheduler', None)
+    if scheduler is None:
+        scheduler = limiter.fair_scheduler = FairScheduler(limiter)
+    return scheduler
@@ -1,4 +1,7 @@
 import asyncio
+import contextlib
+import logging
+import time
 
 import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -6,48 +9,215 @@ from sqlalchemy.ext.asyncio import AsyncSession
 import constants
 from backend.settings import settings
 from managers.weather import WeatherManager
-from services.limiter import RequestLimiter
+from services.cache import ResponseCache, weather_cache
+from services.limiter import get_request_limiter
+from services.metrics import cities_processed, persist_queue_depth, span, upstream_in_flight, upstream_request_seconds
+from services.parsing import WeatherRecord, parse_weather, parse_weather_group
+from services.progress import JobProgress, completion_percentage, job_registry
+from services.retry import RetryPolicy, UpstreamError, check_response, get_circuit_breaker
+from services.scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
 
 
 class WeatherService:
-    def __init__(self, session: AsyncSession, user_id: int, request_limiter=None, cities=None):
+    def __init__(self, session: AsyncSession, user_id: int, request_limiter=None, cities=None, max_in_flight: int | None = None,
+                 http_client: httpx.AsyncClient | None = None, cache: ResponseCache | None = None, retry_policy: RetryPolicy | None = None,
+                 priority: str = 'normal', job_id: int | None = None, max_age: float | None = None):
         self.session = session
         self.user_id = user_id
+        self.job_id = job_id  # With a job, the state of each city is kept in weather_job_city
         self.weather_manager = WeatherManager(session=self.session)
-        self.request_limiter = request_limiter or RequestLimiter
+        self.request_limiter = request_limiter or get_request_limiter()
+        if settings.scheduler_enabled:
+            # The slots of the limiter are shared fairly with the other jobs, by the priority class of the request
+            self.request_limiter = get_scheduler(self.request_limiter).flow(user_id, priority)
         self.cities = cities or constants.CITIES_IDs
+        self.max_in_flight = max_in_flight or settings.open_weather_max_in_flight
+        self.http_client = http_client
+        self.cache = cache or (weather_cache if settings.cache_enabled else None)
+        self.retry_policy = retry_policy or RetryPolicy(breaker=get_circuit_breaker(settings.open_weather_url))
+        self.max_age = max_age  # Refresh, the cached readings older than max_age seconds are fetched again
+
+    def _is_fresh(self, data: WeatherRecord) -> bool:
+        return self.max_age is None or (data.fetched_at is not None and data.fetched_at >= time.time() - self.max_age)
+
+    async def _request(self, url: str, params: dict, client: httpx.AsyncClient) -> bytes:
+        # The limiter adapts to the status and the rate limit headers, the errors are raised as UpstreamError for the retry policy
+        # The raw body is returned, the parsers read only the fields that are saved
+        endpoint = 'group' if url == settings.open_weather_group_url else 'weather'
+        started_at = time.perf_counter()
+        upstream_in_flight.inc()
+        try:
+            with span('openweather.request', endpoint=endpoint):
+                response = await client.get(url, params=params)
+        except httpx.TransportError as e:
+            upstream_request_seconds.labels(endpoint, 'error').observe(time.perf_counter() - started_at)
+            raise UpstreamError(f'{type(e).__name__}: {e}') from e
+        finally:
+            upstream_in_flight.dec()
 
-    async def _fetch_weather(self, city_id: int, client: httpx.AsyncClient):
+        upstream_request_seconds.labels(endpoint, response.status_code).observe(time.perf_counter() - started_at)
+        self.request_limiter.on_response(response.status_code, response.headers)
+        check_response(response)
+        return response.content
+
+    async def _call_upstream(self, fn, *args):
+        # Each attempt takes a slot of the limiter, the failed ones are retried with backoff while the circuit is closed
+        return await self.retry_policy.call(self.request_limiter.call_external_api, fn, *args)
+
+    async def _fetch_weather(self, city_id: int, client: httpx.AsyncClient) -> WeatherRecord:
         payload = {
             "id": city_id,
             "appid": settings.open_weather_api_key,
-            "units": "metric"
+            "units": settings.open_weather_units
         }
-        response = await client.get(settings.open_weather_url, params=payload)
-        response = response.json()
-        # Create the JSON to save in database with the id of the city, the temperature in Celsius and humidity
-        data = {
-            'city_id': response['id'],
-            'temperature_c': response['main']['temp'],
-            'humidity': response['main']['humidity'],
+        content = await self._request(settings.open_weather_url, payload, client)
+        return parse_weather(content)
+
+    async def _fetch_weather_group(self, city_ids: list[int], client: httpx.AsyncClient) -> dict[int, WeatherRecord]:
+        # The group endpoint returns up to 20 cities in one request, the result is indexed by city id
+        payload = {
+            "id": ",".join(str(city_id) for city_id in city_ids),
+            "appid": settings.open_weather_api_key,
+            "units": settings.open_weather_units
         }
-        # save to the database
-        await self.weather_manager.save_city_weather(self.user_id, data=data)
-        return data
+        content = await self._request(settings.open_weather_group_url, payload, client)
+        return parse_weather_group(content)
+
+    async def _get_weather(self, city_id: int, client: httpx.AsyncClient):
+        # The limiter is only used on cache misses, concurrent misses for the same city share one request
+        def fetch():
+            return self._call_upstream(self._fetch_weather, city_id, client)
+
+        if self.cache is None:
+            return await fetch()
+
+        key = (city_id, settings.open_weather_units)
+        if (cached := self.cache.get(key)) is not None and not self._is_fresh(cached):
+            self.cache.delete(key)
+        return await self.cache.get_or_fetch(key, fetch)
+
+    async def _get_weather_group(self, batch: list[tuple[int, int]], pending: asyncio.Queue, finished: asyncio.Queue,
+                                 client: httpx.AsyncClient):
+        # Cached cities are answered directly, the others are fetched in one request charged once to the limiter
+        missing = batch
+        if self.cache is not None:
+            cached = self.cache.get_many([(city_id, settings.open_weather_units) for _, city_id in batch])
+            missing = []
+            for index, city_id in batch:
+                if (data := cached.get((city_id, settings.open_weather_units))) is not None and self._is_fresh(data):
+                    await finished.put((index, data))
+                else:
+                    missing.append((index, city_id))
 
-    async def get_openweather_data(self):
-        async with httpx.AsyncClient() as client:
-            # Process the list of cities
-            tasks = [await self.request_limiter.call_external_api(self._fetch_weather, city, client) for city in self.cities]
-            results = await asyncio.gather(*[])
-        return results
+        fetched = {}
+        if len(missing) > 1:
+            try:
+                fetched = await self._call_upstream(self._fetch_weather_group, [city_id for _, city_id in missing], client)
+            except RuntimeError as e:
+                logger.warning('Failed to fetch weather for a group of %s cities: %s', len(missing), e)
+
+        for index, city_id in missing:
+            data = fetched.get(city_id)
+            if data is None:
+                # Falls back to the single city request
+                pending.put_nowait([(index, city_id)])
+                continue
+
+            if self.cache is not None:
+                self.cache.set((city_id, settings.open_weather_units), data)
+            await finished.put((index, data))
+
+    async def _fetch_worker(self, pending: asyncio.Queue, finished: asyncio.Queue, client: httpx.AsyncClient):
+        # Each worker keeps one request in flight, the limiter decides when it can be sent
+        while not pending.empty():
+            batch = pending.get_nowait()
+            if len(batch) > 1:
+                with span('openweather.fetch_group', cities=len(batch)):
+                    await self._get_weather_group(batch, pending, finished, client)
+                continue
+
+            index, city_id = batch[0]
+            try:
+                with span('openweather.fetch', city_id=city_id):
+                    data = await self._get_weather(city_id, client)
+            except RuntimeError as e:
+                logger.warning('Failed to fetch weather for city %s: %s', city_id, e)
+                data = None
+            await finished.put((index, data))
+
+    async def _persist_worker(self, finished: asyncio.Queue, results: list, progress: JobProgress):
+        # Single consumer, so the session is never used concurrently
+        async with self.weather_manager.buffered_writer(job_id=self.job_id) as writer:
+            while (item := await finished.get()) is not None:
+                persist_queue_depth.set(finished.qsize())
+                index, data = item
+                if data is not None:
+                    await writer.add(self.user_id, data=data)
+                    progress.city_done()
+                    cities_processed.labels('done').inc()
+                else:
+                    await writer.add_failed(self.cities[index])
+                    progress.city_failed()
+                    cities_processed.labels('failed').inc()
+                results[index] = data
+                job_registry.publish(self.user_id, 'city', {'city_id': self.cities[index], 'data': data, 'progress': progress.snapshot()})
+
+    async def get_openweather_data(self, resume: bool = False):
+        cities = list(enumerate(self.cities))
+        if resume and self.job_id is not None:
+            # Only the cities of the job that are not done (pending, or failed in the previous attempt)
+            pending_ids = await self.weather_manager.get_pending_city_ids(self.job_id)
+            cities = [(index, city_id) for index, city_id in cities if city_id in pending_ids]
+        elif resume:
+            # Skip the cities saved before the job was interrupted
+            saved = await self.weather_manager.get_saved_city_ids(self.user_id)
+            cities = [(index, city_id) for index, city_id in cities if city_id not in saved]
+
+        # Each item is a batch of (index, city_id), with a single city when the group endpoint is not used
+        pending = asyncio.Queue()
+        batch_size = max(1, min(settings.open_weather_batch_size, 20))
+        for start in range(0, len(cities), batch_size):
+            pending.put_nowait(cities[start:start + batch_size])
+
+        # Bounded, so a slow database holds back the fetch workers
+        finished = asyncio.Queue(maxsize=self.max_in_flight)
+        results = [None] * len(self.cities)
+        progress = job_registry.start(self.user_id, total=len(self.cities))
+        progress.done = len(self.cities) - len(cities)
+
+        async with contextlib.AsyncExitStack() as stack:
+            # Use the shared client when there is one, otherwise a client only for this job
+            client = self.http_client or await stack.enter_async_context(httpx.AsyncClient())
+            persist = asyncio.create_task(self._persist_worker(finished, results, progress))
+            workers = asyncio.gather(*[
+                self._fetch_worker(pending, finished, client)
+                for _ in range(min(self.max_in_flight, pending.qsize()))
+            ])
+            try:
+                done, _ = await asyncio.wait({workers, persist}, return_when=asyncio.FIRST_COMPLETED)
+                if persist in done:
+                    # The persistence only stops before the workers when it fails
+                    workers.cancel()
+                    persist.result()
+                await workers
+                await finished.put(None)
+                await persist
+            finally:
+                workers.cancel()
+                persist.cancel()
+                job_registry.finish(progress)
+
+        return [data for data in results if data is not None]
 
     async def get_percentage(self) -> float:
-        # Get the list of processed cities
-        processed_cities = await WeatherManager(session=self.session).get_complete_cities(self.user_id)
+        # Count the processed (done or failed) cities, of the job when there is one (a refresh only counts the cities fetched again)
+        if self.job_id is not None:
+            counts = await self.weather_manager.count_job_cities(self.job_id)
+            if counts:
+                return completion_percentage(counts.get('done', 0) + counts.get('failed', 0), sum(counts.values()))
+        qtd_processed = await self.weather_manager.count_complete_cities(self.user_id)
 
         # Calculate the percentage of processed cities
-        qtd_processed = len(processed_cities) if processed_cities else 0
-        completion_percent = (qtd_processed / len(self.cities)) * 100
-
-        return completion_percent
\ No newline at end of file
+        return completion_percentage(qtd_processed, len(self.cities))
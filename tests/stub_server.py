@@ -0,0 +1,120 @@
+import asyncio
+import json
+import random
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+
+def city_payload(city_id: int) -> dict:
+    # Same shape as the OpenWeather current weather response
+    return {
+        'coord': {'lon': -56.1645, 'lat': -34.9033},
+        'weather': [{'id': 803, 'main': 'Clouds', 'description': 'broken clouds', 'icon': '04d'}],
+        'base': 'stations',
+        'main': {'temp': 21.5, 'feels_like': 21.2, 'temp_min': 20.9, 'temp_max': 22.1, 'pressure': 1015, 'humidity': 64},
+        'visibility': 10000,
+        'wind': {'speed': 5.14, 'deg': 130},
+        'clouds': {'all': 75},
+        'dt': 1700000000,
+        'sys': {'type': 2, 'id': 2030346, 'country': 'UY', 'sunrise': 1699950000, 'sunset': 1700000000},
+        'timezone': -10800,
+        'id': city_id,
+        'name': 'Montevideo',
+        'cod': 200,
+    }
+
+
+class OpenWeatherStub:
+    """
+    Local HTTP/1.1 server (with keep-alive) that answers like the OpenWeather API
+    Counts the TCP connections and the requests, and the responses can be replaced overriding respond()
+    """
+
+    def __init__(self, missing_ids: set[int] = frozenset()):
+        self.missing_ids = missing_ids  # Left out of the group responses
+        self.connections = 0
+        self.requests: list[tuple[str, dict]] = []
+        self._server: asyncio.Server | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}/data/2.5/weather'
+
+    @property
+    def group_url(self) -> str:
+        return self.url.replace('/weather', '/group')
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def respond(self, path: str, params: dict) -> tuple[int, dict, dict] | None:
+        # Returns the status code, the JSON body and extra headers, or None to close the connection without answering
+        if path.endswith('/group'):
+            cities = [city_payload(int(city_id)) for city_id in params['id'].split(',') if int(city_id) not in self.missing_ids]
+            return 200, {'cnt': len(cities), 'list': cities}, {}
+
+        return 200, city_payload(int(params['id'])), {}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while request_line := await reader.readline():
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass  # The stub only receives GET requests, the headers are ignored
+
+                url = urlsplit(request_line.split()[1].decode())
+                params = {key: value[0] for key, value in parse_qs(url.query).items()}
+                self.requests.append((url.path, params))
+
+                response = await self.respond(url.path, params)
+                if response is None:
+                    return
+                status, body, headers = response
+                content = json.dumps(body).encode()
+                head = [f'HTTP/1.1 {status} Stub', f'Content-Length: {len(content)}', 'Content-Type: application/json']
+                head += [f'{name}: {value}' for name, value in headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + content)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class FaultyOpenWeatherStub(OpenWeatherStub):
+    """
+    OpenWeatherStub that injects faults: each request takes the next fault of the list, and `always` after the list ends
+    A fault is a (status, headers) error response or 'drop' to close the connection without answering,
+    None answers normally
+    Every answer can also wait `latency` seconds, and fail with a 503 with probability `error_rate` (used by the benchmarks)
+    """
+
+    def __init__(self, faults: list = (), always=None, missing_ids: set[int] = frozenset(),
+                 latency: float = 0, error_rate: float = 0, seed: int | None = None):
+        super().__init__(missing_ids)
+        self.faults = deque(faults)
+        self.always = always
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    async def respond(self, path: str, params: dict) -> tuple[int, dict, dict] | None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        fault = self.faults.popleft() if self.faults else self.always
+        if fault is None and self.error_rate and self.random.random() < self.error_rate:
+            fault = (503, {})
+        if fault is None:
+            return await super().respond(path, params)
+        if fault == 'drop':
+            return None
+
+        status, headers = fault
+        return status, {'cod': status, 'message': 'Injected fault'}, headers
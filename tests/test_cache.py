@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+import constants
+from backend.database import test_sessionmanager
+from backend.settings import settings
+from services.cache import ResponseCache, SQLiteCacheBackend
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.parsing import WeatherRecord
+from services.weather import WeatherService
+from tests.stub_server import OpenWeatherStub
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_ttl_and_lru():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, max_entries=2, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is the least recently used entry
+    cache.set('c', 3)
+    assert cache.get('b') is None
+
+    clock.now += 10
+    assert cache.get('a') is None
+    assert cache.stats()['size'] == 1
+
+
+@pytest.mark.asyncio
+async def test_cache_coalesces_concurrent_misses():
+    cache = ResponseCache(ttl=10, max_entries=10)
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {'city_id': 1}
+
+    results = await asyncio.gather(*[cache.get_or_fetch((1, 'metric'), fetch) for _ in range(5)])
+    await cache.get_or_fetch((1, 'metric'), fetch)
+
+    assert calls == 1
+    assert all(result == {'city_id': 1} for result in results)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'coalesced': 4, 'size': 1}
+
+
+@pytest.mark.asyncio
+async def test_cache_shares_errors_without_caching_them():
+    cache = ResponseCache(ttl=10, max_entries=10)
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('upstream error')
+
+    results = await asyncio.gather(*[cache.get_or_fetch('a', fetch) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get('a') is None
+
+
+def test_cache_persistent_backend(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = ResponseCache(ttl=10, max_entries=10, backend=SQLiteCacheBackend(path))
+    cache.set((1, 'metric'), {'city_id': 1})
+
+    # A new instance (e.g. after a restart) loads the entries that did not expire
+    restored = ResponseCache(ttl=10, max_entries=10, backend=SQLiteCacheBackend(path))
+    assert restored.get((1, 'metric')) == {'city_id': 1}
+
+
+def test_cache_persistent_backend_restores_the_records(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = ResponseCache(ttl=10, max_entries=10, backend=SQLiteCacheBackend(path, decode=WeatherRecord.from_dict))
+    cache.set((1, 'metric'), WeatherRecord(city_id=1, temperature_c=21.5, humidity=64, fetched_at=1000.0))
+
+    # The restored entries are records like the fresh ones, not the dicts saved as JSON
+    restored = ResponseCache(ttl=10, max_entries=10, backend=SQLiteCacheBackend(path, decode=WeatherRecord.from_dict))
+    record = restored.get((1, 'metric'))
+    assert isinstance(record, WeatherRecord)
+    assert record == WeatherRecord(city_id=1, temperature_c=21.5, humidity=64) and record.fetched_at == 1000.0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_jobs_share_upstream_calls(create_test_session, monkeypatch):
+    async with OpenWeatherStub() as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        cache = ResponseCache(ttl=60, max_entries=100)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1))
+
+        async def run_job(user_id: int):
+            # Each job has its own session, like the jobs started by different requests
+            async with test_sessionmanager.session() as session:
+                service = WeatherService(session=session, user_id=user_id, request_limiter=limiter,
+                                         cities=constants.CITIES_IDs_SHORT, cache=cache)
+                return await service.get_openweather_data()
+
+        # Two jobs run concurrently and a third one later, all with the same cities
+        await asyncio.gather(run_job(1), run_job(2))
+        await run_job(3)
+
+    cities = len(constants.CITIES_IDs_SHORT)
+    assert len(stub.requests) == cities
+    assert cache.stats() == {'hits': cities, 'misses': cities, 'coalesced': cities, 'size': cities}
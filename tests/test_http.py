@@ -0,0 +1,43 @@
+import pytest
+
+import constants
+from backend.settings import settings
+from services.http import HTTPClientManager
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.weather import WeatherService
+from tests.stub_server import OpenWeatherStub
+
+
+async def run_jobs(session, http_client=None, jobs: int = 3):
+    for user_id in range(jobs):
+        service = WeatherService(
+            session=session,
+            user_id=user_id,
+            request_limiter=AsyncRateLimiter(SlidingWindow(limit=100, period=1)),
+            cities=constants.CITIES_IDs[:10],
+            max_in_flight=2,
+            http_client=http_client,
+        )
+        assert len(await service.get_openweather_data()) == 10
+
+
+@pytest.mark.asyncio
+async def test_shared_client_reuses_connections(create_test_session, monkeypatch):
+    async with OpenWeatherStub() as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        monkeypatch.setattr(settings, 'cache_enabled', False)  # Every job calls the upstream
+
+        # A client per job opens new connections for every job
+        await run_jobs(create_test_session, jobs=3)
+        assert stub.connections == 6
+
+        # The shared client only opens one connection per concurrent request, no matter the number of jobs
+        stub.connections = 0
+        manager = HTTPClientManager()
+        await manager.start()
+        await run_jobs(create_test_session, http_client=manager.client, jobs=3)
+        await manager.close()
+
+        assert stub.connections == 2
+        assert manager.metrics['127.0.0.1'].connections == 2
+        assert manager.metrics['127.0.0.1'].requests == 30
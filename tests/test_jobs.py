@@ -0,0 +1,262 @@
+import asyncio
+import contextlib
+import datetime
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import update
+from starlette import status
+
+import constants
+from backend.database import test_sessionmanager
+from backend.settings import settings
+from managers.jobs import JobManager
+from managers.weather import WeatherManager
+from models.weather import WeatherData
+from services import jobs
+from services.jobs import JobWorker
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.progress import job_registry
+from services.weather import WeatherService
+from tests.stub_server import OpenWeatherStub
+
+
+@pytest.fixture
+def worker():
+    return JobWorker(
+        session_manager=test_sessionmanager,
+        request_limiter=AsyncRateLimiter(SlidingWindow(limit=100, period=1)),
+        lease_seconds=30,
+    )
+
+
+@pytest_asyncio.fixture
+async def stub(monkeypatch):
+    async with OpenWeatherStub() as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        monkeypatch.setattr(settings, 'cache_enabled', False)
+        yield stub
+
+
+@pytest.mark.asyncio
+async def test_post_enqueues_job_processed_by_worker(client, create_test_session, worker, stub):
+    response = await client.post('/weather', json={'user_id': 42, 'cities': constants.CITIES_IDs_SHORT})
+    assert response.status_code == status.HTTP_202_ACCEPTED
+
+    # The job is in the queue, so a second request of the user is a conflict
+    response = await client.post('/weather', json={'user_id': 42})
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+    assert await worker.run_once() is True
+    assert await worker.run_once() is False
+
+    job = await JobManager(create_test_session).get_job(42)
+    await create_test_session.refresh(job)
+    assert job.status == 'done' and job.lease_owner is None
+    assert await WeatherManager(create_test_session).count_complete_cities(42) == len(constants.CITIES_IDs_SHORT)
+
+    response = await client.get('/weather', params={'user_id': 42})
+    assert response.json()['percentage'] == 100
+
+
+@pytest.mark.asyncio
+async def test_workers_never_claim_the_same_job(create_test_session):
+    for user_id in range(5):
+        await JobManager(create_test_session).enqueue(user_id, cities=constants.CITIES_IDs_SHORT)
+
+    async def claim(worker_id: str):
+        async with test_sessionmanager.session() as session:
+            return await JobManager(session).claim(worker_id, lease_seconds=30)
+
+    jobs = await asyncio.gather(*[claim(f'worker-{i}') for i in range(8)])
+    claimed = [job.id for job in jobs if job is not None]
+
+    assert len(claimed) == 5
+    assert len(set(claimed)) == 5
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_is_resumed_by_another_worker(create_test_session, worker, stub):
+    cities = constants.CITIES_IDs_SHORT
+    await JobManager(create_test_session).enqueue(7, cities=cities)
+
+    # A worker claims the job, saves two cities and dies before the lease expires
+    assert await JobManager(create_test_session).claim('dead-worker', lease_seconds=0.01) is not None
+    for city_id in cities[:2]:
+        await WeatherManager(create_test_session).save_city_weather(7, {'city_id': city_id, 'temperature_c': 20, 'humidity': 50})
+    await asyncio.sleep(0.02)
+
+    assert await worker.run_once() is True
+
+    # Only the cities missing from the first attempt are fetched
+    assert sorted(int(params['id']) for _, params in stub.requests) == sorted(cities[2:])
+    assert await WeatherManager(create_test_session).get_saved_city_ids(7) == set(cities)
+
+
+@pytest.mark.asyncio
+async def test_post_sets_the_priority_of_the_job(client, create_test_session):
+    response = await client.post('/weather', json={'user_id': 8, 'cities': [1], 'priority': 'high'})
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert (await JobManager(create_test_session).get_job(8)).priority == 'high'
+
+    response = await client.post('/weather', json={'user_id': 9, 'priority': 'urgent'})
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_claim_takes_the_highest_priority_first(create_test_session):
+    for user_id, priority in enumerate(['low', 'normal', 'high', 'normal']):
+        await JobManager(create_test_session).enqueue(user_id, cities=[1], priority=priority)
+
+    assert (await JobManager(create_test_session).claim('worker', lease_seconds=30, priorities=('low',))).user_id == 0
+    claimed = [(await JobManager(create_test_session).claim('worker', lease_seconds=30)).user_id for _ in range(3)]
+    assert claimed == [2, 1, 3]
+
+
+@pytest.mark.asyncio
+async def test_high_priority_job_does_not_wait_for_the_busy_slots(create_test_session, monkeypatch):
+    worker = JobWorker(session_manager=test_sessionmanager, concurrency=1, priority_slots=1, lease_seconds=30, poll_interval=0.01)
+    started, release = [], asyncio.Event()
+
+    async def run_job(job):
+        started.append(job.priority)
+        await release.wait()
+
+    monkeypatch.setattr(worker, '_run_job', run_job)
+    await JobManager(create_test_session).enqueue(1, cities=[1], priority='low')
+    running = asyncio.create_task(worker.run())
+    try:
+        await asyncio.sleep(0.05)
+        await JobManager(create_test_session).enqueue(2, cities=[1], priority='high')
+        await JobManager(create_test_session).enqueue(3, cities=[1], priority='normal')
+        worker.notify()
+        await asyncio.sleep(0.05)
+
+        # The low job takes the only concurrency slot, the high one starts in the priority slot and the normal one waits
+        assert started == ['low', 'high']
+    finally:
+        release.set()
+        running.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await running
+
+
+class MissingCityStub(OpenWeatherStub):
+    # Answers 404 for the cities in `missing`
+    def __init__(self, missing: set[int]):
+        super().__init__()
+        self.missing = missing
+
+    async def respond(self, path: str, params: dict):
+        if int(params['id']) in self.missing:
+            return 404, {'cod': '404', 'message': 'city not found'}, {}
+        return await super().respond(path, params)
+
+
+@pytest.mark.asyncio
+async def test_job_keeps_the_state_of_each_city(create_test_session, worker, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_enabled', False)
+    cities = constants.CITIES_IDs_SHORT
+    job = await JobManager(create_test_session).enqueue(10, cities=cities)
+
+    async with MissingCityStub(missing={cities[0]}) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        assert await worker.run_once() is True
+    assert await WeatherManager(create_test_session).count_job_cities(job.id) == {'done': len(cities) - 1, 'failed': 1}
+    # The failed city is processed, in the registry of this process and in the database read by the others
+    assert job_registry.get(10).percentage == 100
+    assert await WeatherService(session=create_test_session, user_id=10, cities=cities, job_id=job.id).get_percentage() == 100
+
+    # Resuming the job (e.g. after a crash) fetches only the failed city
+    async with MissingCityStub(missing=set()) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        service = WeatherService(session=create_test_session, user_id=10, cities=cities, job_id=job.id,
+                                 request_limiter=AsyncRateLimiter(SlidingWindow(limit=100, period=1)))
+        await service.get_openweather_data(resume=True)
+
+    assert [int(params['id']) for _, params in stub.requests] == [cities[0]]
+    assert await WeatherManager(create_test_session).count_job_cities(job.id) == {'done': len(cities)}
+    assert await service.get_percentage() == 100
+
+
+@pytest.mark.asyncio
+async def test_refresh_fetches_only_the_stale_cities(client, create_test_session, worker, stub):
+    cities = constants.CITIES_IDs_SHORT
+    await client.post('/weather', json={'user_id': 11, 'cities': cities})
+    assert await worker.run_once() is True
+
+    # Refreshing while the readings are fresh does nothing
+    response = await client.post('/weather', json={'user_id': 11, 'max_age': 3600})
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.json()['title'] == 'Weather data is up to date'
+
+    # Two readings are older than one hour
+    await create_test_session.execute(
+        update(WeatherData).where(WeatherData.user_id == 11, WeatherData.city_id.in_(cities[:2]))
+        .values(fetched_at=datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+    )
+    await create_test_session.commit()
+    stub.requests.clear()
+
+    response = await client.post('/weather', json={'user_id': 11, 'max_age': 3600})
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    # The job is in the queue again, so a second refresh is a conflict
+    response = await client.post('/weather', json={'user_id': 11, 'max_age': 3600})
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+    assert await worker.run_once() is True
+    assert sorted(int(params['id']) for _, params in stub.requests) == sorted(cities[:2])
+    assert await WeatherManager(create_test_session).get_stale_city_ids(11, cities, max_age=3600) == []
+
+    response = await client.get('/weather', params={'user_id': 11})
+    assert response.json()['percentage'] == 100
+
+    # The job keeps all the cities, so a second refresh checks them all and not only the ones of the first refresh
+    assert (await JobManager(create_test_session).get_job(11)).cities == cities
+    await create_test_session.execute(
+        update(WeatherData).where(WeatherData.user_id == 11, WeatherData.city_id.in_(cities[2:4]))
+        .values(fetched_at=datetime.datetime.utcnow() - datetime.timedelta(hours=2))
+    )
+    await create_test_session.commit()
+    stub.requests.clear()
+
+    response = await client.post('/weather', json={'user_id': 11, 'max_age': 3600})
+    assert response.json()['title'] == 'Refreshing weather data'
+    assert await worker.run_once() is True
+    assert sorted(int(params['id']) for _, params in stub.requests) == sorted(cities[2:4])
+    assert await WeatherManager(create_test_session).get_stale_city_ids(11, cities, max_age=3600) == []
+
+
+@pytest.mark.asyncio
+async def test_refresh_does_not_reuse_older_cached_readings(client, create_test_session, worker, monkeypatch):
+    monkeypatch.setattr(settings, 'cache_enabled', True)
+    cities = constants.CITIES_IDs_SHORT
+    async with OpenWeatherStub() as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        await client.post('/weather', json={'user_id': 12, 'cities': cities})
+        assert await worker.run_once() is True
+        stub.requests.clear()
+
+        # The readings are in the response cache, but they are older than max_age
+        await asyncio.sleep(0.01)
+        response = await client.post('/weather', json={'user_id': 12, 'max_age': 0})
+        assert response.json()['title'] == 'Refreshing weather data'
+        assert (await JobManager(create_test_session).get_job(12)).max_age == 0
+        assert await worker.run_once() is True
+
+    assert sorted(int(params['id']) for _, params in stub.requests) == sorted(cities)
+
+
+@pytest.mark.asyncio
+async def test_standalone_worker_creates_the_schema_first(monkeypatch):
+    calls = []
+
+    async def record(name):
+        calls.append(name)
+
+    monkeypatch.setattr(jobs, 'init_schema', lambda: record('init_schema'))
+    monkeypatch.setattr(jobs.job_worker, 'run', lambda: record('run'))
+    monkeypatch.setattr(jobs.sessionmanager, 'close', lambda: record('close'))
+    await jobs.main()
+
+    assert calls == ['init_schema', 'run', 'close']
@@ -0,0 +1,173 @@
+import asyncio
+import multiprocessing
+import sqlite3
+import time
+
+import pytest
+
+from services.limiter import AsyncRateLimiter, GCRA, SQLiteSlidingWindow, SlidingWindow, TokenBucket, call_with_limiter
+from services.retry import UpstreamError
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('algorithm, min_elapsed', [
+    (SlidingWindow(limit=5, period=0.5), 1.0),  # 5 at 0s, 5 at 0.5s and 2 at 1s
+    (TokenBucket(rate=10, capacity=5), 0.7),  # burst of 5 and then one every 0.1s
+    (GCRA(limit=5, period=0.5), 0.7),  # same shape as the token bucket
+])
+async def test_limiter_never_exceeds_rate(algorithm, min_elapsed):
+    limiter = AsyncRateLimiter(algorithm)
+    acquired_at = []
+
+    async def acquire():
+        await limiter.acquire()
+        acquired_at.append(time.monotonic())
+
+    started_at = time.monotonic()
+    await asyncio.gather(*[acquire() for _ in range(12)])
+
+    # Small tolerance for the clock resolution
+    assert max(acquired_at) - started_at >= min_elapsed - 0.01
+
+
+@pytest.mark.asyncio
+async def test_sliding_window_limit_in_any_window():
+    limiter = AsyncRateLimiter(SlidingWindow(limit=5, period=0.5))
+    acquired_at = []
+
+    async def acquire():
+        await limiter.acquire()
+        acquired_at.append(time.monotonic())
+
+    await asyncio.gather(*[acquire() for _ in range(12)])
+
+    # In any window of 0.5s there are at most 5 acquisitions
+    acquired_at.sort()
+    for i in range(len(acquired_at) - 5):
+        assert acquired_at[i + 5] - acquired_at[i] >= 0.5 - 0.01
+
+
+@pytest.mark.asyncio
+async def test_limiter_wakes_waiters_in_fifo_order():
+    limiter = AsyncRateLimiter(SlidingWindow(limit=1, period=0.05))
+    order = []
+
+    async def acquire(i):
+        await limiter.acquire()
+        order.append(i)
+
+    tasks = []
+    for i in range(5):
+        tasks.append(asyncio.create_task(acquire(i)))
+        await asyncio.sleep(0)  # Make sure the tasks are queued in creation order
+    await asyncio.gather(*tasks)
+
+    assert order == [0, 1, 2, 3, 4]
+    # The scheduler sleeps once per freed slot instead of polling
+    assert limiter.wakeups == 4
+
+
+@pytest.mark.asyncio
+async def test_limiter_skips_cancelled_waiters():
+    limiter = AsyncRateLimiter(SlidingWindow(limit=1, period=0.05))
+    await limiter.acquire()
+
+    cancelled = asyncio.create_task(limiter.acquire())
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    await asyncio.wait_for(waiting, timeout=1)
+    assert len(limiter.algorithm.log) == 1
+
+
+def test_lowered_limit_waits_for_the_right_slot():
+    window = SlidingWindow(limit=4, period=1)
+    for now in (0, 0.1, 0.2, 0.3):
+        assert window.reserve(now) == 0
+
+    # With the limit lowered to 2 (adaptive limiter) the next slot frees when the 3rd request expires, not the 1st
+    window.limit = 2
+    assert window.reserve(0.3) == pytest.approx(0.9)
+    assert window.reserve(1.2) == 0
+    assert len(window.log) == 2
+
+
+class RecordingWindow(SQLiteSlidingWindow):
+    # Records the time of each claimed slot
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.claims = []
+
+    def reserve(self, now: float) -> float:
+        wait = super().reserve(now)
+        if wait == 0:
+            self.claims.append(self.last_claimed_at)
+        return wait
+
+
+def acquire_in_process(path: str, acquisitions: int, results):
+    # Runs in a child process, with its own event loop and limiter sharing the SQLite window
+    async def acquire():
+        window = RecordingWindow(limit=5, period=0.5, path=path)
+        limiter = AsyncRateLimiter(window, clock=time.time)
+        for _ in range(acquisitions):
+            await limiter.acquire()
+        return window.claims
+
+    results.put(asyncio.run(acquire()))
+
+
+def test_sqlite_window_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'limiter.sqlite3')
+    SQLiteSlidingWindow(limit=5, period=0.5, path=path)  # Creates the table before the processes start
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=acquire_in_process, args=(path, 6, results)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    acquired_at = sorted(t for _ in processes for t in results.get(timeout=30))
+    for process in processes:
+        process.join()
+
+    # Together the processes never take more than 5 slots in any window of 0.5s
+    assert len(acquired_at) == 18
+    for i in range(len(acquired_at) - 5):
+        assert acquired_at[i + 5] - acquired_at[i] >= 0.5
+
+
+def test_sqlite_window_does_not_wait_for_the_lock(tmp_path):
+    path = str(tmp_path / 'limiter.sqlite3')
+    window = SQLiteSlidingWindow(limit=5, period=0.5, path=path, lock_retry=0.005)
+
+    # Another process holds the lock, the claim returns at once with the retry delay and takes no slot
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    started_at = time.perf_counter()
+    assert window.reserve(time.time()) == 0.005
+    assert time.perf_counter() - started_at < 0.1
+    assert window.lock_retries == 1 and window.last_claimed_at is None
+
+    other.execute('COMMIT')
+    assert window.reserve(time.time()) == 0
+
+
+@pytest.mark.asyncio
+async def test_call_with_limiter_takes_a_slot_and_wraps_the_errors():
+    acquired = []
+
+    async def acquire():
+        acquired.append(True)
+
+    async def fail(error):
+        raise error
+
+    assert await call_with_limiter(acquire, asyncio.sleep, 0, result='ok') == 'ok'
+    # The upstream errors are kept for the retry policy, the others are raised as RuntimeError
+    with pytest.raises(UpstreamError):
+        await call_with_limiter(acquire, fail, UpstreamError('503'))
+    with pytest.raises(RuntimeError, match='invalid') as error:
+        await call_with_limiter(acquire, fail, ValueError('invalid'))
+    assert not isinstance(error.value, UpstreamError)
+    assert len(acquired) == 3
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+import pytest
+from starlette import status
+
+import constants
+from backend.settings import settings
+from managers.jobs import JobManager
+from services.cache import progress_cache, weather_cache
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.metrics import MetricsRegistry, span
+from services.weather import WeatherService
+from tests.stub_server import OpenWeatherStub
+
+
+def test_histogram_render():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('request_seconds', 'Latency', labels=('endpoint',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 2):
+        histogram.labels('weather').observe(value)
+    registry.gauge('in_flight', 'Requests in flight').set(3)
+
+    assert registry.render().splitlines() == [
+        '# HELP request_seconds Latency',
+        '# TYPE request_seconds histogram',
+        'request_seconds_bucket{endpoint="weather",le="0.1"} 1',
+        'request_seconds_bucket{endpoint="weather",le="1.0"} 3',
+        'request_seconds_bucket{endpoint="weather",le="+Inf"} 4',
+        'request_seconds_sum{endpoint="weather"} 3.05',
+        'request_seconds_count{endpoint="weather"} 4',
+        '# HELP in_flight Requests in flight',
+        '# TYPE in_flight gauge',
+        'in_flight 3',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, create_test_session, monkeypatch):
+    async with OpenWeatherStub() as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        service = WeatherService(session=create_test_session, user_id=1, cities=constants.CITIES_IDs_SHORT,
+                                 request_limiter=AsyncRateLimiter(SlidingWindow(limit=100, period=1)))
+        await service.get_openweather_data()
+    await JobManager(create_test_session).enqueue(2, cities=[1, 2])
+
+    response = await client.get('/metrics')
+    assert response.status_code == status.HTTP_200_OK
+    lines = response.text.splitlines()
+
+    cities = len(constants.CITIES_IDs_SHORT)
+    assert f'weather_upstream_request_seconds_count{{endpoint="weather",status="200"}} {cities}' in lines
+    assert f'weather_limiter_wait_seconds_count {cities}' in lines
+    assert f'weather_cities_total{{result="done"}} {cities}' in lines
+    assert 'weather_db_commit_seconds_count{operation="flush"} 1' in lines
+    assert 'weather_upstream_in_flight 0' in lines
+    assert 'weather_jobs{status="pending"} 1' in lines
+
+
+@pytest.mark.asyncio
+async def test_metrics_cache_counters(client):
+    weather_cache.set(1, {'temp': 20})
+    weather_cache.get_many([1, 2])
+    await asyncio.gather(*(progress_cache.get_or_fetch('user', lambda: asyncio.sleep(0.01, 50)) for _ in range(3)))
+
+    response = await client.get('/metrics')
+    lines = response.text.splitlines()
+
+    assert 'weather_cache_lookups_total{cache="weather",result="hits"} 1' in lines
+    assert 'weather_cache_lookups_total{cache="weather",result="misses"} 1' in lines
+    assert 'weather_cache_lookups_total{cache="progress",result="misses"} 1' in lines
+    assert 'weather_cache_lookups_total{cache="progress",result="coalesced"} 2' in lines
+    assert 'weather_cache_entries{cache="weather"} 1' in lines
+    assert 'weather_cache_entries{cache="progress"} 1' in lines
+
+
+@pytest.mark.asyncio
+async def test_spans_logged(monkeypatch, caplog):
+    monkeypatch.setattr(settings, 'tracing', 'log')
+    with caplog.at_level(logging.INFO, logger='services.metrics'):
+        with span('weather.persist', rows=3):
+            pass
+
+    assert 'span weather.persist' in caplog.text
+    assert "{'rows': 3}" in caplog.text
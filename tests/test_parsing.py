@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from services import parsing
+from services.parsing import WeatherRecord, _scan_weather, json_default, parse_weather, parse_weather_group
+from tests.stub_server import city_payload
+
+
+def test_parse_weather_reads_only_the_saved_fields():
+    record = parse_weather(json.dumps(city_payload(3441575)).encode())
+
+    assert record == WeatherRecord(3441575, 21.5, 64)
+    assert record['city_id'] == 3441575
+    assert record.fetched_at is not None
+
+
+def test_parse_weather_fast_path_ignores_the_nested_ids():
+    # The top level id is first and the nested objects (weather, sys) have their own ids
+    payload = city_payload(10)
+    payload = {'id': 10, **{key: value for key, value in payload.items() if key != 'id'}}
+    content = json.dumps(payload, indent=2).encode()
+
+    assert _scan_weather(content) == WeatherRecord(10, 21.5, 64)
+
+
+@pytest.mark.parametrize('payload', [
+    {'id': '31', 'main': {'temp': -3.5e0, 'humidity': 90}},  # Id as string and temperature with exponent
+    {'main': {'temp': 1, 'humidity': 2}, 'extra': {'id': 5}, 'id': 31},  # Nested id after the main object
+])
+@pytest.mark.parametrize('scan', [True, False])
+def test_parse_weather_fast_path_and_full_decode_agree(monkeypatch, payload, scan):
+    monkeypatch.setattr(parsing, 'SCAN_WEATHER', scan)
+    content = json.dumps(payload).encode()
+    assert parse_weather(content) == WeatherRecord(31, float(payload['main']['temp']), payload['main']['humidity'])
+
+
+def test_parse_weather_falls_back_to_the_full_decode(monkeypatch):
+    monkeypatch.setattr(parsing, 'SCAN_WEATHER', True)
+    # Two top level ids, the fast path gives up and the full decode keeps the last one (as json.loads does)
+    content = b'{"id": 1, "main": {"temp": 20, "humidity": 50}, "id": 2}'
+    assert _scan_weather(content) is None
+    assert parse_weather(content) == WeatherRecord(2, 20.0, 50)
+
+    # Error payloads still fail
+    with pytest.raises(KeyError):
+        parse_weather(b'{"cod": "404", "message": "city not found"}')
+
+
+def test_parse_weather_group():
+    content = json.dumps({'cnt': 2, 'list': [city_payload(1), city_payload(2)]}).encode()
+    records = parse_weather_group(content)
+
+    assert records == {1: WeatherRecord(1, 21.5, 64), 2: WeatherRecord(2, 21.5, 64)}
+
+
+def test_record_to_json():
+    record = WeatherRecord(1, 21.5, 64, 1700000000.0)
+    assert json.loads(json.dumps({'data': record}, default=json_default)) == {
+        'data': {'city_id': 1, 'temperature_c': 21.5, 'humidity': 64, 'fetched_at': 1700000000.0},
+    }
+    assert WeatherRecord.from_dict(record.as_dict()) == record
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import time
+
+import pytest
+from starlette import status
+
+from backend.settings import settings
+from managers.jobs import JobManager
+from managers.weather import WeatherManager
+from routers import weather
+from services.cache import progress_cache
+from services.progress import JobRegistry, Subscription, job_registry
+
+
+def test_job_progress_percentage_and_eta():
+    progress = JobRegistry().start(user_id=1, total=4)
+    assert progress.percentage == 0
+    assert progress.eta is None
+
+    progress.started_at = time.time() - 2
+    progress.city_done()
+    progress.city_failed()
+
+    # Failed cities count as processed, 2 cities in 2 seconds leaves 2 seconds for the other 2
+    assert progress.percentage == 50
+    assert progress.eta == pytest.approx(2, abs=0.1)
+
+
+def test_job_registry_evicts_oldest_finished_jobs():
+    registry = JobRegistry(max_finished=2)
+    running = registry.start(user_id=1, total=1)
+    for user_id in (2, 3, 4):
+        registry.finish(registry.start(user_id=user_id, total=1))
+
+    assert registry.get(1) is running
+    assert registry.get(2) is None
+    assert registry.get(3).finished and registry.get(4).finished
+
+
+@pytest.mark.asyncio
+async def test_get_endpoint_reads_from_registry(client):
+    progress = job_registry.start(user_id=999, total=4)
+    progress.city_done()
+
+    # The user has no rows in the database, so the answer comes from the registry
+    response = await client.get("/weather", params={'user_id': 999})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['percentage'] == 25
+
+    # A running job blocks a new request for the same user, even before saving any city
+    response = await client.post("/weather", json={'user_id': 999})
+    assert response.status_code == status.HTTP_409_CONFLICT
+
+
+@pytest.mark.asyncio
+async def test_get_endpoint_reads_finished_jobs_from_database(client):
+    # The job may have been requested again by another process, the finished progress in memory is not used
+    job_registry.finish(job_registry.start(user_id=998, total=4))
+
+    response = await client.get("/weather", params={'user_id': 998})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'percentage': 0, 'eta': None}
+
+
+def test_subscription_drops_oldest_events():
+    subscription = Subscription(user_id=1, max_events=2)
+    for i in range(3):
+        subscription.push({'event': 'city', 'data': i})
+
+    assert subscription.dropped == 1
+    assert [event['data'] for event in subscription._events] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_stream_endpoint_pushes_events(client, monkeypatch):
+    monkeypatch.setattr(settings, 'stream_heartbeat_seconds', 0.02)
+    progress = job_registry.start(user_id=50, total=2)
+
+    async def run_job():
+        # Events published while the watcher is connected
+        await asyncio.sleep(0.05)
+        progress.city_done()
+        job_registry.publish(50, 'city', {'city_id': 1, 'data': {'city_id': 1}, 'progress': progress.snapshot()})
+        progress.city_failed()
+        job_registry.publish(50, 'city', {'city_id': 2, 'data': None, 'progress': progress.snapshot()})
+        job_registry.finish(progress)
+
+    job = asyncio.create_task(run_job())
+    response = await client.get('/weather/50/stream')
+    await job
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'].startswith('text/event-stream')
+
+    messages = [message for message in response.text.split('\n\n') if message]
+    events = [message for message in messages if not message.startswith(':')]
+    assert ': heartbeat' in messages
+    assert [event.split('\n')[0] for event in events] == ['event: progress', 'event: city', 'event: city', 'event: finished']
+    assert json.loads(events[-1].split('data: ')[1])['progress']['percentage'] == 100
+
+    # The watcher is removed when the stream ends
+    assert not job_registry._subscribers
+
+
+@pytest.mark.asyncio
+async def test_stream_endpoint_polls_jobs_of_other_processes(client, create_test_session, monkeypatch):
+    monkeypatch.setattr(settings, 'stream_poll_interval', 0.02)
+    monkeypatch.setattr(progress_cache, 'ttl', 0)
+    job = await JobManager(create_test_session).enqueue(60, cities=[1, 2])
+
+    async def run_job():
+        # Another process claims the job, saves the cities and finishes it, nothing is published in this registry
+        await asyncio.sleep(0.05)
+        assert await JobManager(create_test_session).claim('other-process', lease_seconds=30) is not None
+        async with WeatherManager(create_test_session).buffered_writer(job_id=job.id) as writer:
+            await writer.add(60, {'city_id': 1, 'temperature_c': 20, 'humidity': 50})
+        await asyncio.sleep(0.05)
+        await writer.add_failed(2)
+        await writer.flush()
+        await JobManager(create_test_session).finish(job.id, 'other-process')
+
+    other_process = asyncio.create_task(run_job())
+    response = await asyncio.wait_for(client.get('/weather/60/stream'), timeout=5)
+    await other_process
+
+    events = [message for message in response.text.split('\n\n') if message and not message.startswith(':')]
+    progress = [json.loads(event.split('data: ')[1])['progress'] for event in events]
+    assert [event.split('\n')[0] for event in events] == ['event: progress'] * (len(events) - 1) + ['event: finished']
+    # An event for each change read from the database, the last one when the job is finished
+    assert list(dict.fromkeys(snapshot['percentage'] for snapshot in progress)) == [0, 50, 100]
+    assert progress[-1] == {'percentage': 100, 'finished': True}
+    assert not job_registry._subscribers
+
+
+@pytest.mark.asyncio
+async def test_stream_watchers_share_the_polls(client, create_test_session, monkeypatch):
+    monkeypatch.setattr(settings, 'stream_poll_interval', 0.01)
+    monkeypatch.setattr(progress_cache, 'ttl', 0.2)
+    job = await JobManager(create_test_session).enqueue(61, cities=[1, 2])
+
+    reads = 0
+    read_progress = weather.read_progress
+
+    async def counted_read_progress(session_manager, user_id):
+        nonlocal reads
+        reads += 1
+        return await read_progress(session_manager, user_id)
+
+    monkeypatch.setattr(weather, 'read_progress', counted_read_progress)
+
+    async def run_job():
+        await asyncio.sleep(0.1)
+        assert await JobManager(create_test_session).claim('other-process', lease_seconds=30) is not None
+        await JobManager(create_test_session).finish(job.id, 'other-process')
+
+    other_process = asyncio.create_task(run_job())
+    responses = await asyncio.wait_for(asyncio.gather(*(client.get('/weather/61/stream') for _ in range(5))), timeout=5)
+    await other_process
+
+    assert all('event: finished' in response.text for response in responses)
+    # Polled every 10ms by each of the 5 watchers, read about once per progress_cache_ttl
+    assert reads <= 3
+    assert not job_registry._subscribers
+
+
+@pytest.mark.asyncio
+async def test_stream_endpoint_unknown_user(client):
+    response = await client.get('/weather/404/stream')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert not job_registry._subscribers
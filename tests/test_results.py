@@ -0,0 +1,75 @@
+import json
+
+import pytest
+from starlette import status
+
+from managers.weather import WeatherManager
+
+
+async def save_cities(session, user_id: int, cities: int):
+    async with WeatherManager(session).buffered_writer(max_rows=cities) as writer:
+        for city_id in range(cities):
+            await writer.add(user_id, {'city_id': city_id, 'temperature_c': 20 + city_id, 'humidity': 50})
+
+
+@pytest.mark.asyncio
+async def test_results_keyset_pagination(client, create_test_session):
+    await save_cities(create_test_session, user_id=1, cities=5)
+    await save_cities(create_test_session, user_id=2, cities=3)
+
+    pages, cursor = [], None
+    while True:
+        response = await client.get('/weather/1/results', params={'limit': 2, **({'cursor': cursor} if cursor else {})})
+        assert response.status_code == status.HTTP_200_OK
+        pages.append(response.json()['results'])
+        cursor = response.json()['next_cursor']
+        if cursor is None:
+            break
+
+    # Every reading of the user once, in (request_date, id) order and without the other users
+    assert [len(page) for page in pages] == [2, 2, 1]
+    results = [item for page in pages for item in page]
+    assert sorted(item['city_id'] for item in results) == [0, 1, 2, 3, 4]
+    assert [(item['request_date'], item['id']) for item in results] == sorted((item['request_date'], item['id']) for item in results)
+
+
+@pytest.mark.asyncio
+async def test_results_invalid_cursor(client):
+    response = await client.get('/weather/1/results', params={'cursor': 'not-a-cursor'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_export_ndjson(client, create_test_session, monkeypatch):
+    monkeypatch.setattr('backend.settings.settings.export_batch_size', 2)
+    await save_cities(create_test_session, user_id=1, cities=5)
+
+    response = await client.get('/weather/1/export')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line['city_id'] for line in lines) == [0, 1, 2, 3, 4]
+    assert lines[0].keys() == {'id', 'city_id', 'temperature_c', 'humidity', 'request_date', 'fetched_at'}
+
+
+@pytest.mark.asyncio
+async def test_export_columnar(client, create_test_session, monkeypatch):
+    monkeypatch.setattr('backend.settings.settings.export_batch_size', 2)
+    await save_cities(create_test_session, user_id=1, cities=5)
+
+    response = await client.get('/weather/1/export', params={'format': 'columnar'})
+    assert response.status_code == status.HTTP_200_OK
+
+    # One line per batch read from the database cursor
+    batches = [json.loads(line) for line in response.text.splitlines()]
+    assert [len(batch['city_id']) for batch in batches] == [2, 2, 1]
+    assert sorted(city_id for batch in batches for city_id in batch['city_id']) == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_export_arrow_without_pyarrow(client, monkeypatch):
+    monkeypatch.setattr('routers.weather.arrow_available', lambda: False)
+
+    response = await client.get('/weather/1/export', params={'format': 'arrow'})
+    assert response.status_code == status.HTTP_501_NOT_IMPLEMENTED
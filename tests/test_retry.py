@@ -0,0 +1,145 @@
+import httpx
+import pytest
+
+import constants
+from backend.settings import settings
+from services.limiter import AsyncRateLimiter, SlidingWindow
+from services.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, parse_retry_after
+from services.weather import WeatherService
+from tests.stub_server import FaultyOpenWeatherStub
+
+
+class RecordingSleep:
+    # Replaces asyncio.sleep in the retry policy, so the tests do not wait for the backoff
+    def __init__(self):
+        self.delays = []
+
+    async def __call__(self, delay: float):
+        self.delays.append(delay)
+
+
+def weather_service(session, limiter, retry_policy, cities: int):
+    return WeatherService(session=session, user_id=1, request_limiter=limiter, cities=constants.CITIES_IDs[:cities],
+                          max_in_flight=1, retry_policy=retry_policy)
+
+
+@pytest.mark.asyncio
+async def test_retries_server_and_network_errors(create_test_session, monkeypatch):
+    sleep = RecordingSleep()
+    async with FaultyOpenWeatherStub(faults=[(503, {}), 'drop', (500, {})]) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1))
+        service = weather_service(create_test_session, limiter, RetryPolicy(max_attempts=4, base_delay=0.1, sleep=sleep), cities=3)
+
+        results = await service.get_openweather_data()
+
+    # The first city is sent 4 times, the others once, and no city is lost
+    assert len(results) == 3
+    assert len(stub.requests) == 6
+    assert len(sleep.delays) == 3
+    # Full jitter, each delay is between 0 and the exponential delay of its attempt
+    assert all(0 <= delay <= 0.1 * 2 ** attempt for attempt, delay in enumerate(sleep.delays))
+
+
+@pytest.mark.asyncio
+async def test_429_honours_retry_after_and_lowers_the_limit(create_test_session, monkeypatch):
+    sleep = RecordingSleep()
+    async with FaultyOpenWeatherStub(faults=[(429, {'Retry-After': '0.2'})]) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1), adaptive=True)
+        service = weather_service(create_test_session, limiter, RetryPolicy(max_attempts=2, base_delay=0.01, sleep=sleep), cities=2)
+
+        results = await service.get_openweather_data()
+
+    assert len(results) == 2
+    assert sleep.delays[0] >= 0.2
+    # The limiter paused for the Retry-After and halved its budget
+    assert limiter.paused_until > 0
+    assert limiter.algorithm.limit == 50
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried(create_test_session, monkeypatch):
+    sleep = RecordingSleep()
+    async with FaultyOpenWeatherStub(faults=[(404, {})]) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1))
+        service = weather_service(create_test_session, limiter, RetryPolicy(max_attempts=4, sleep=sleep), cities=2)
+
+        results = await service.get_openweather_data()
+
+    # The city with the 404 fails without retries, the other one is saved
+    assert len(results) == 1
+    assert len(stub.requests) == 2
+    assert sleep.delays == []
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_stops_calling_a_failing_upstream(create_test_session, monkeypatch):
+    async with FaultyOpenWeatherStub(always=(500, {})) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1))
+        service = weather_service(create_test_session, limiter, RetryPolicy(max_attempts=1, breaker=breaker), cities=10)
+
+        results = await service.get_openweather_data()
+
+    # After 3 failures the other cities fail without calling the upstream
+    assert results == []
+    assert len(stub.requests) == 3
+    assert breaker.state == 'open'
+
+
+def test_circuit_breaker_half_open_probe():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 10
+
+    # After the timeout one probe is let through, the other calls wait for it
+    now[0] = 10
+    breaker.before_call()
+    assert breaker.state == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # A failed probe opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    now[0] = 20
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+
+def test_adaptive_limiter_follows_the_rate_limit_headers():
+    now = [0.0]
+    limiter = AsyncRateLimiter(SlidingWindow(limit=10, period=1), clock=lambda: now[0], adaptive=True, min_limit=2)
+
+    # The upstream quota is lower than the configured limit
+    limiter.on_response(200, httpx.Headers({'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '4'}))
+    assert limiter.algorithm.limit == 5
+
+    # Nothing remains, no slot is given before the reset
+    limiter.on_response(200, httpx.Headers({'RateLimit-Remaining': '0', 'RateLimit-Reset': '3'}))
+    assert limiter.paused_until == 3
+
+    # Never below min_limit on 429, and it grows by one after a window of successes, never above the configured limit
+    limiter.on_response(429, httpx.Headers())
+    limiter.on_response(429, httpx.Headers())
+    assert limiter.algorithm.limit == 2
+    for _ in range(100):
+        limiter.on_response(200, httpx.Headers())
+    assert limiter.algorithm.limit == 10
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', now=1445412470) == 10
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
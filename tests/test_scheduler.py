@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from services.scheduler import FairScheduler
+
+
+class ManualLimiter:
+    # Gives a slot each time release() is called
+    def __init__(self):
+        self.slots = asyncio.Queue()
+
+    async def acquire(self):
+        await self.slots.get()
+
+    def release(self, count: int = 1):
+        for _ in range(count):
+            self.slots.put_nowait(None)
+
+
+async def served_order(scheduler: FairScheduler, limiter: ManualLimiter, requests: list[tuple[str, int]]) -> list[str]:
+    # Queues all the requests (key, weight) and then gives one slot at a time
+    order = []
+
+    async def request(key: str, weight: int):
+        await scheduler.acquire(key, weight)
+        order.append(key)
+
+    tasks = [asyncio.create_task(request(key, weight)) for key, weight in requests]
+    await asyncio.sleep(0)
+    for _ in requests:
+        limiter.release()
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*tasks)
+    return order
+
+
+@pytest.mark.asyncio
+async def test_small_job_is_not_queued_behind_a_big_one():
+    limiter = ManualLimiter()
+    scheduler = FairScheduler(limiter)
+
+    # The big job queued all its requests first
+    order = await served_order(scheduler, limiter, [('big', 1)] * 10 + [('small', 1)] * 3)
+
+    assert order[:6] == ['big', 'small'] * 3
+    assert order[6:] == ['big'] * 7
+
+
+@pytest.mark.asyncio
+async def test_slots_follow_the_weights():
+    limiter = ManualLimiter()
+    scheduler = FairScheduler(limiter)
+
+    order = await served_order(scheduler, limiter, [('low', 1)] * 6 + [('high', 4)] * 12)
+
+    assert order[:10] == ['low'] + ['high'] * 4 + ['low'] + ['high'] * 4
+    assert order.count('high') == 12 and order[-3:] == ['low'] * 3
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_take_a_slot():
+    limiter = ManualLimiter()
+    scheduler = FairScheduler(limiter)
+
+    cancelled = asyncio.create_task(scheduler.acquire('a'))
+    waiting = asyncio.create_task(scheduler.acquire('b'))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    limiter.release()
+    await asyncio.wait_for(waiting, timeout=1)
+    assert not scheduler.active and not scheduler.flows
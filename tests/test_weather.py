@@ -1,33 +1,41 @@
+import asyncio
+import json
+import sqlite3
 from collections import deque
 from unittest.mock import patch, AsyncMock
 
 import pytest
+from sqlalchemy.exc import OperationalError
 from starlette import status
 
 import constants
+from backend.settings import settings
+from managers.weather import WeatherManager
+from services.cache import progress_cache
+from services.progress import job_registry
 from services.weather import WeatherService
-from services.limiter import RequestLimiter
+from services.limiter import AsyncRateLimiter, RequestLimiter, SlidingWindow
+from tests.stub_server import OpenWeatherStub
 
 
-@pytest.mark.asyncio
-async def test_get_openweather_data(create_test_session):
+class MockResponse:
+    # Answer of the mocked httpx.AsyncClient.get, with what WeatherService reads: the status, the headers and the raw body
+    def __init__(self, city_id):
+        self.status_code = 200
+        self.headers = {}
+        self.content = json.dumps({'id': city_id, 'main': {'temp': 35, 'humidity': 65}}).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+async def mock_get(url, params=None):
     # Mocking the OpenWeather API response
-    async def mock_get(url, params=None):
-        class MockResponse:
-            def json(self):
-                return {
-                    'id': "31",
-                    'main': {
-                        'temp': 35,
-                        'humidity': 65
-                    }
-                }
-
-            async def raise_for_status(self):
-                pass
-
-        return MockResponse()
+    return MockResponse("31")
+
 
+@pytest.mark.asyncio
+async def test_get_openweather_data(create_test_session):
     # Use patch as a synchronous context manager and mock AsyncClient.get method
     with patch('httpx.AsyncClient.get', new_callable=AsyncMock) as mock_get_method:
         mock_get_method.side_effect = mock_get  # Assign the async mock response to the mocked method
@@ -55,6 +63,117 @@ async def test_get_openweather_data(create_test_session):
         assert len(request_limiter.REQUEST_QUEUE) == request_limiter.MAX_REQUESTS_PER_PERIOD
 
 
+@pytest.mark.asyncio
+async def test_get_openweather_data_bounded_concurrency(create_test_session):
+    in_flight = 0
+    max_in_flight = 0
+
+    # Mocking the OpenWeather API response, with some latency to overlap the requests
+    async def mock_get_with_latency(url, params=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+        return MockResponse(params['id'])
+
+    with patch('httpx.AsyncClient.get', new_callable=AsyncMock) as mock_get_method:
+        mock_get_method.side_effect = mock_get_with_latency
+
+        weather_service = WeatherService(
+            session=create_test_session,
+            user_id=789,
+            request_limiter=AsyncRateLimiter(SlidingWindow(limit=100, period=1)),
+            cities=constants.CITIES_IDs[:20],
+            max_in_flight=4,
+        )
+        results = await weather_service.get_openweather_data()
+
+    # All the cities are returned in the requested order and persisted
+    assert [data['city_id'] for data in results] == constants.CITIES_IDs[:20]
+    assert len(await weather_service.weather_manager.get_complete_cities(789)) == 20
+    assert max_in_flight == 4
+
+
+@pytest.mark.asyncio
+async def test_buffered_writer_flushes_by_size_and_time(create_test_session):
+    manager = WeatherManager(create_test_session)
+
+    def data(city_id):
+        return {'city_id': city_id, 'temperature_c': 20, 'humidity': 50}
+
+    async with manager.buffered_writer(max_rows=3, max_delay=0.05) as writer:
+        for city_id in range(4):
+            await writer.add(1, data(city_id))
+        # The first 3 rows are flushed by size, the last one waits for the timer
+        assert len(await manager.get_complete_cities(1)) == 3
+
+        await asyncio.sleep(0.1)
+        assert len(await manager.get_complete_cities(1)) == 4
+
+        await writer.add(1, data(4))
+
+    # The last row is flushed when the writer is closed
+    assert len(await manager.get_complete_cities(1)) == 5
+
+
+@pytest.mark.asyncio
+async def test_buffered_writer_keeps_the_rows_of_a_failed_flush(create_test_session, monkeypatch):
+    manager = WeatherManager(create_test_session)
+    commit = create_test_session.commit
+    failures = 1
+
+    async def locked_commit():
+        # The first commit fails like when another process holds the database lock
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise OperationalError('COMMIT', {}, sqlite3.OperationalError('database is locked'))
+        await commit()
+
+    monkeypatch.setattr(create_test_session, 'commit', locked_commit)
+
+    # The timed flush fails, its error is raised when the writer is closed and the rows are kept
+    with pytest.raises(OperationalError):
+        async with manager.buffered_writer(max_rows=10, max_delay=0.01) as writer:
+            await writer.add(1, {'city_id': 1, 'temperature_c': 20, 'humidity': 50})
+            await writer.add(1, {'city_id': 2, 'temperature_c': 20, 'humidity': 50})
+            await asyncio.sleep(0.05)
+            assert await manager.count_complete_cities(1) == 0
+    assert len(writer.rows) == 2
+
+    await writer.flush()
+    assert await manager.count_complete_cities(1) == 2
+
+
+@pytest.mark.asyncio
+async def test_save_city_weather_is_idempotent(create_test_session):
+    manager = WeatherManager(create_test_session)
+
+    first = await manager.save_city_weather(1, {'city_id': '31', 'temperature_c': 20, 'humidity': 50})
+    async with manager.buffered_writer() as writer:
+        await writer.add(1, {'city_id': 31, 'temperature_c': 22.5, 'humidity': 55})
+        await writer.add(2, {'city_id': 31, 'temperature_c': 22.5, 'humidity': 55})
+
+    # Fetching the city again updates the reading of the user instead of adding a row
+    cities = await manager.get_complete_cities(1)
+    assert len(cities) == 1
+    await create_test_session.refresh(cities[0])
+    assert (cities[0].id, cities[0].city_id, cities[0].temperature, cities[0].humidity) == (first.id, 31, 22.5, 55)
+    assert await manager.count_complete_cities(2) == 1
+
+
+@pytest.mark.asyncio
+async def test_count_and_check_user(create_test_session, create_data_in_database):
+    manager = WeatherManager(create_test_session)
+
+    assert await manager.count_complete_cities(1) == len(create_data_in_database)
+    assert await manager.count_complete_cities(2) == 0
+    assert await manager.check_user(1) is True
+    assert await manager.check_user(2) is False
+
+
 @pytest.mark.asyncio
 async def test_get_percentage(create_test_session, create_data_in_database):
     user_id = 1
@@ -86,22 +205,6 @@ async def test_weather_endpoint_user_already_exists(client, create_data_in_datab
 
 @pytest.mark.asyncio
 async def test_weather_endpoint_new_user(client):
-    async def mock_get(url, params=None):
-        class MockResponse:
-            def json(self):
-                return {
-                    'id': "31",
-                    'main': {
-                        'temp': 35,
-                        'humidity': 65
-                    }
-                }
-
-            async def raise_for_status(self):
-                pass
-
-        return MockResponse()
-
     # Use patch as a synchronous context manager and mock AsyncClient.get method
     with patch('httpx.AsyncClient.get', new_callable=AsyncMock) as mock_get_method:
         mock_get_method.side_effect = mock_get  # Assign the async mock response to the mocked method
@@ -131,20 +234,6 @@ async def test_weather_endpoint_new_user(client):
 
 @pytest.mark.asyncio
 async def test_get_endpoint(client, create_test_session):
-    # Mocking the OpenWeather API response
-    async def mock_get(url, params=None):
-        class MockResponse:
-            def json(self):
-                return {
-                    'id': "31",
-                    'main': {
-                        'temp': 35,
-                        'humidity': 65
-                    }
-                }
-
-        return MockResponse()
-
     # Use patch as a synchronous context manager and mock AsyncClient.get method
     with patch('httpx.AsyncClient.get', new_callable=AsyncMock) as mock_get_method:
         mock_get_method.side_effect = mock_get  # Assign the async mock response to the mocked method
@@ -170,3 +259,73 @@ async def test_get_endpoint(client, create_test_session):
     assert response.status_code == status.HTTP_200_OK
     data = response.json()
     assert 'percentage' in data
+
+
+@pytest.mark.asyncio
+async def test_get_endpoint_shares_the_query_of_concurrent_polls(client, create_data_in_database):
+    responses = await asyncio.gather(*[client.get('/weather', params={'user_id': 1}) for _ in range(20)])
+
+    assert {response.json()['percentage'] for response in responses} == {2 / len(constants.CITIES_IDs) * 100}
+    # One query, the other polls waited for it or read its answer
+    stats = progress_cache.stats()
+    assert stats['misses'] == 1 and stats['hits'] + stats['coalesced'] == 19
+
+
+@pytest.mark.asyncio
+async def test_get_endpoint_etag(client, create_test_session, create_data_in_database):
+    response = await client.get('/weather', params={'user_id': 1})
+    etag = response.headers['etag']
+
+    response = await client.get('/weather', params={'user_id': 1}, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.content == b''
+
+    # A new city changes the answer once the cached one expires
+    await WeatherManager(create_test_session).save_city_weather(1, {'city_id': 12347, 'temperature_c': 20, 'humidity': 50})
+    progress_cache.clear()
+    response = await client.get('/weather', params={'user_id': 1}, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['etag'] != etag
+
+
+@pytest.mark.asyncio
+async def test_get_endpoint_etag_ignores_the_eta(client):
+    progress = job_registry.start(user_id=70, total=4)
+    progress.city_done()
+    response = await client.get('/weather', params={'user_id': 70})
+    etag = response.headers['etag']
+    # Weak, the eta in the body is not part of it
+    assert etag.startswith('W/"')
+
+    # The eta changes at each poll, the ETag only when the progress changes
+    await asyncio.sleep(0.01)
+    response = await client.get('/weather', params={'user_id': 70}, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    # Compared with the weak comparison, with or without the W/ prefix
+    response = await client.get('/weather', params={'user_id': 70}, headers={'If-None-Match': f'"other", {etag.removeprefix("W/")}'})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    progress.city_failed()
+    response = await client.get('/weather', params={'user_id': 70}, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['percentage'] == 50
+
+
+@pytest.mark.asyncio
+async def test_get_openweather_data_group_endpoint(create_test_session, monkeypatch):
+    cities = constants.CITIES_IDs[:45]
+    async with OpenWeatherStub(missing_ids={cities[3]}) as stub:
+        monkeypatch.setattr(settings, 'open_weather_url', stub.url)
+        monkeypatch.setattr(settings, 'open_weather_group_url', stub.group_url)
+        monkeypatch.setattr(settings, 'open_weather_batch_size', 20)
+        limiter = AsyncRateLimiter(SlidingWindow(limit=100, period=1))
+
+        weather_service = WeatherService(session=create_test_session, user_id=321, request_limiter=limiter, cities=cities)
+        results = await weather_service.get_openweather_data()
+
+    # 3 group requests (20, 20 and 5 cities) and a single request for the city missing in the group response
+    assert [path for path, _ in stub.requests].count('/data/2.5/group') == 3
+    path, params = stub.requests[-1]
+    assert path == '/data/2.5/weather' and params['id'] == str(cities[3])
+    assert len(limiter.algorithm.log) == 4
+    assert [data['city_id'] for data in results] == cities